@@ -0,0 +1,129 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks rendering a long template in parallel chunks.
+
+Renders a synthetic template with image overlays spread over its whole
+duration in a single ffmpeg run (the previous behaviour) and then split into
+parallel chunks (see `PARALLEL_CHUNKS`), comparing their wall times.
+
+Chunked rendering stays experimental (and off by default) until this has been
+run on the target instance types: record the results here when it has.
+
+Requires ffmpeg and ffprobe on the PATH, and the runner's requirements.
+Usage:
+
+  python3 chunked_render_benchmark.py --duration 60 --overlays 24 --chunks 0,4
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'runner'))
+
+import config as ConfigService  # pylint: disable=g-import-not-at-top
+import main as RunnerService  # pylint: disable=g-import-not-at-top
+from PIL import Image  # pylint: disable=g-import-not-at-top
+
+
+def _make_template(path, duration, size):
+  subprocess.check_call([
+      'ffmpeg', '-v', 'error',
+      '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30:duration={duration}',
+      '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+      '-c:v', 'libx264', '-g', '60', '-pix_fmt', 'yuv420p',
+      '-c:a', 'aac', '-shortest', '-y', path,
+  ])
+
+
+def _make_content(work_dir, duration, overlays):
+  """Builds content showing `overlays` images spread over the template."""
+  assets = {}
+  content = []
+  window = duration / overlays
+  for index in range(overlays):
+    image_path = os.path.join(work_dir, f'image_{index}.png')
+    Image.new(
+        'RGBA', (400, 400), (index * 37 % 256, 128, 255 - index, 200)
+    ).save(image_path)
+    url = f'https://example.com/image_{index}.png'
+    assets[(RunnerService._ASSET_URL, url)] = image_path  # pylint: disable=protected-access
+    content.append(
+        RunnerService.PvaLiteRenderMessageContent(
+            offset_s=index * window,
+            duration_s=window * 2,
+            placements=[{
+                'element_id': f'image_{index}',
+                'image_url': url,
+                'offset_x': 40 * (index % 10),
+                'offset_y': 30 * (index % 8),
+                'image_width': 320,
+                'image_height': 320,
+                'rotation_angle': 15 * (index % 4),
+            }],
+        )
+    )
+  return content, assets
+
+
+def _run(name, chunks, template, content, assets, work_dir):
+  ConfigService.PARALLEL_CHUNKS = chunks
+  output_path = os.path.join(work_dir, f'out_{chunks}.mp4')
+  start = time.perf_counter()
+  RunnerService.process_video_batch(
+      [content], work_dir, template, [output_path], None, assets
+  )
+  elapsed = time.perf_counter() - start
+  print(f'{name:<24} {elapsed:>10.3f}s')
+  return elapsed
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--duration', type=float, default=60)
+  parser.add_argument('--size', default='1920x1080')
+  parser.add_argument('--overlays', type=int, default=24)
+  parser.add_argument(
+      '--chunks',
+      default='0',
+      help='Comma-separated chunk counts to compare, 0 for one per core.',
+  )
+  args = parser.parse_args()
+
+  work_dir = tempfile.mkdtemp()
+  template = os.path.join(work_dir, 'template.mp4')
+  _make_template(template, args.duration, args.size)
+  content, assets = _make_content(work_dir, args.duration, args.overlays)
+  ConfigService.SMART_RENDER = False
+
+  print(
+      f'{args.duration}s {args.size} template, {args.overlays} overlays,'
+      f' {RunnerService._available_cores()} cores'  # pylint: disable=protected-access
+  )
+  print(f'{"mode":<24} {"wall":>11}')
+  single = _run('single process', 1, template, content, assets, work_dir)
+  for chunks in [int(c) for c in args.chunks.split(',')]:
+    elapsed = _run(
+        f'{chunks or "auto"} chunks', chunks, template, content, assets,
+        work_dir
+    )
+    print(f'{"":<24} {single / elapsed:>10.2f}x')
+
+
+if __name__ == '__main__':
+  main()
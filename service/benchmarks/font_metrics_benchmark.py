@@ -0,0 +1,101 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the font metrics lookups done while laying out text placements.
+
+Compares the number of ImageMagick subprocesses (and wall time) spent on font
+metrics for a render with many text placements, probing once per placement
+(the previous behaviour) versus going through `FontMetricsCache`, both on a
+cold instance and on a warm one that finds the sidecar file.
+
+Requires ImageMagick's `convert` on the PATH. Usage:
+
+  python3 font_metrics_benchmark.py --placements 200 --font /path/font.ttf
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'runner'))
+
+import text_rendering as TextService  # pylint: disable=g-import-not-at-top
+
+
+class _CountingPopen(subprocess.Popen):
+  """Counts every process spawned through the subprocess module."""
+
+  count = 0
+
+  def __init__(self, *args, **kwargs):
+    _CountingPopen.count += 1
+    super().__init__(*args, **kwargs)
+
+
+def _run(name, sizes, lookup):
+  _CountingPopen.count = 0
+  start = time.perf_counter()
+  for size in sizes:
+    lookup(size)
+  elapsed = time.perf_counter() - start
+  print(
+      f'{name:<24} {_CountingPopen.count:>12} {elapsed:>10.3f}s'
+      f' {1000 * elapsed / len(sizes):>10.2f}ms'
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--placements', type=int, default=200)
+  parser.add_argument('--font', default=None, help='Font file to measure.')
+  parser.add_argument(
+      '--sizes',
+      default='14,24,48',
+      help='Comma-separated text sizes cycled through by the placements.',
+  )
+  args = parser.parse_args()
+
+  distinct_sizes = [float(s) for s in args.sizes.split(',')]
+  sizes = [
+      distinct_sizes[i % len(distinct_sizes)] for i in range(args.placements)
+  ]
+  subprocess.Popen = _CountingPopen
+  sidecar_path = os.path.join(tempfile.mkdtemp(), 'font_metrics.json')
+
+  print(f'{args.placements} text placements, {len(distinct_sizes)} sizes')
+  print(f'{"mode":<24} {"subprocesses":>12} {"wall":>11} {"per item":>12}')
+  _run(
+      'probe per placement',
+      sizes,
+      lambda size: TextService.probe_font_metrics(args.font, size),
+  )
+  cold_cache = TextService.FontMetricsCache(sidecar_path)
+  _run(
+      'cache (cold instance)',
+      sizes,
+      lambda size: cold_cache.get_metrics(args.font, size),
+  )
+  warm_cache = TextService.FontMetricsCache(sidecar_path)
+  _run(
+      'cache (warm sidecar)',
+      sizes,
+      lambda size: warm_cache.get_metrics(args.font, size),
+  )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,461 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks each stage of a render over a matrix of synthetic messages.
+
+Generates a template (ffmpeg testsrc2 and sine), images and render messages of
+varying size - number of placements and segments, rotated or not, with
+wrapped text or not, with background removal or not - and renders each of
+them stage by stage, with caches emptied between runs:
+
+  remove_backgrounds  `_remove_backgrounds` (only with background removal)
+  layout              `_layout_overlays`, which renders and measures text
+  prescale            `ImagePrescaler.prescale`
+  filters             `precompose_layers`, `filter_strings`, `share_inputs`
+  ffmpeg              `run_ffmpeg_batch`
+
+For every stage it reports the wall time, the CPU time of the runner and of
+the processes it waited for, the number of subprocesses spawned and the peak
+RSS of the runner. `children_max_rss_kb` is the largest RSS of any process
+waited for so far, as reported by getrusage, rather than per stage.
+
+Results are printed and, with --output, written as JSON that can be diffed
+between commits, or passed back as --baseline to print relative changes.
+
+Requires ffmpeg on the PATH (unless the ffmpeg stage is skipped), the
+runner's requirements and, for text, a font (--font). Usage:
+
+  python3 render_stages_benchmark.py --placements 1,20,200 --segments 1,20 \
+      --rotation off,on --font /path/font.ttf --output stages.json
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'runner'))
+
+import background_removal as BackgroundService  # pylint: disable=g-import-not-at-top
+import config as ConfigService  # pylint: disable=g-import-not-at-top
+import image_scaling as ScalingService  # pylint: disable=g-import-not-at-top
+import main as RunnerService  # pylint: disable=g-import-not-at-top
+import pva_video as VideoService  # pylint: disable=g-import-not-at-top
+import storage as StorageService  # pylint: disable=g-import-not-at-top
+import text_rendering as TextService  # pylint: disable=g-import-not-at-top
+from PIL import Image  # pylint: disable=g-import-not-at-top
+
+_RESULTS_VERSION = 1
+_STAGES = ('remove_backgrounds', 'layout', 'prescale', 'filters', 'ffmpeg')
+_FONT_PATH = 'benchmark/font.ttf'
+_WORDS = (
+    'fresh deals on summer shoes and bags for the whole family with free'
+    ' delivery over fifty euros only this week while stocks last'
+).split()
+
+
+class _CountingPopen(subprocess.Popen):
+  """Counts every process spawned through the subprocess module."""
+
+  count = 0
+
+  def __init__(self, *args, **kwargs):
+    _CountingPopen.count += 1
+    super().__init__(*args, **kwargs)
+
+
+class _RssSampler(threading.Thread):
+  """Samples the RSS of this process until stopped, keeping the peak."""
+
+  def __init__(self, interval_s=0.005):
+    super().__init__(daemon=True)
+    self.interval_s = interval_s
+    self.peak_kb = _current_rss_kb()
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.wait(self.interval_s):
+      self.peak_kb = max(self.peak_kb, _current_rss_kb())
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+    self.peak_kb = max(self.peak_kb, _current_rss_kb())
+    return self.peak_kb
+
+
+def _current_rss_kb():
+  try:
+    with open('/proc/self/statm') as statm:
+      pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+  except (OSError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _cpu_s(usage):
+  return usage.ru_utime + usage.ru_stime
+
+
+@contextlib.contextmanager
+def _measure(stage, results):
+  """Records the metrics of the enclosed stage into `results`."""
+  sampler = _RssSampler()
+  sampler.start()
+  _CountingPopen.count = 0
+  self_before = resource.getrusage(resource.RUSAGE_SELF)
+  children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    wall = time.perf_counter() - start
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results[stage] = {
+        'wall_s': wall,
+        'cpu_s': _cpu_s(self_after) - _cpu_s(self_before),
+        'children_cpu_s': _cpu_s(children_after) - _cpu_s(children_before),
+        'subprocesses': _CountingPopen.count,
+        'peak_rss_kb': sampler.stop(),
+        'children_max_rss_kb': children_after.ru_maxrss,
+    }
+
+
+def _make_template(path, duration, size):
+  subprocess.check_call([
+      'ffmpeg', '-v', 'error',
+      '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30:duration={duration}',
+      '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+      '-c:v', 'libx264', '-g', '60', '-pix_fmt', 'yuv420p',
+      '-c:a', 'aac', '-shortest', '-y', path,
+  ])
+
+
+def _make_images(work_dir, count, seed):
+  """Writes `count` images of assorted formats and sizes, keyed by URL."""
+  rng = random.Random(seed)
+  assets = {}
+  for index in range(count):
+    size = (rng.choice([320, 800, 1600]), rng.choice([240, 600, 1200]))
+    color = tuple(rng.randrange(256) for _ in range(3))
+    image = Image.linear_gradient('L').resize(size).convert('RGBA')
+    image.paste(color + (255,), (size[0] // 4, size[1] // 4,
+                                 3 * size[0] // 4, 3 * size[1] // 4))
+    if index % 2:
+      path = os.path.join(work_dir, f'image_{index}.jpg')
+      image.convert('RGB').save(path, quality=90)
+    else:
+      path = os.path.join(work_dir, f'image_{index}.png')
+      image.save(path)
+    url = f'https://example.com/image_{index}.{path.rsplit(".", 1)[1]}'
+    assets[(RunnerService._ASSET_URL, url)] = path  # pylint: disable=protected-access
+  return assets
+
+
+def _make_message(scenario, duration, image_urls, font, seed):
+  """Builds a render message for a scenario of the benchmark matrix."""
+  rng = random.Random(seed)
+  segments = scenario['segments']
+  window = duration / segments
+  content = []
+  for segment in range(segments):
+    placements = []
+    count = scenario['placements'] // segments + (
+        segment < scenario['placements'] % segments
+    )
+    for index in range(count):
+      placement = {
+          'element_id': f'element_{segment}_{index}',
+          'offset_x': rng.randrange(0, 1600),
+          'offset_y': rng.randrange(0, 900),
+          'rotation_angle': (
+              rng.choice([5, 15, 30, 90]) if scenario['rotation'] else 0
+          ),
+      }
+      if index % 2 and image_urls:
+        placement.update({
+            'image_url': image_urls[rng.randrange(len(image_urls))],
+            'image_width': rng.choice([120, 240, 480]),
+            'image_height': rng.choice([120, 240, 480]),
+            'keep_ratio': bool(index % 3),
+            'remove_background': 'Yes' if scenario['rembg'] else 'No',
+        })
+      else:
+        words = rng.randint(2, 12 if scenario['wrap'] else 5)
+        placement.update({
+            'text_value': ' '.join(rng.choice(_WORDS) for _ in range(words)),
+            'text_size': rng.choice([24, 36, 48]),
+            'text_color': rng.choice(['white', 'black', '#ffcc00']),
+            'text_alignment': rng.choice(['left', 'center', 'right']),
+            'text_font': _FONT_PATH if font else None,
+            'text_width': 16 if scenario['wrap'] else None,
+            'hyphenation_language': 'en_US' if scenario['wrap'] else None,
+        })
+      placements.append(placement)
+    content.append({
+        'offset_s': segment * window,
+        'duration_s': window,
+        'placements': placements,
+    })
+  return RunnerService.PvaLiteRenderMessage(
+      output_path='benchmark/output.mp4',
+      ad_group='benchmark',
+      template_video='benchmark/template.mp4',
+      content=content,
+  )
+
+
+def _reset_caches(cache_dir):
+  """Replaces the runner's caches with empty ones, so every run is cold."""
+  max_bytes = 1 << 40
+  RunnerService._FONT_METRICS = TextService.FontMetricsCache()  # pylint: disable=protected-access
+  RunnerService._TEXT_CACHE = TextService.RenderedTextCache(  # pylint: disable=protected-access
+      StorageService.LocalFileCache(
+          os.path.join(cache_dir, 'text'), max_bytes
+      )
+  )
+  RunnerService._IMAGE_PRESCALER = ScalingService.ImagePrescaler(  # pylint: disable=protected-access
+      StorageService.LocalFileCache(
+          os.path.join(cache_dir, 'prescale'), max_bytes
+      ),
+      ConfigService.PRESCALE_PROCESSES,
+  )
+  RunnerService._BACKGROUND_REMOVER = BackgroundService.BackgroundRemover(  # pylint: disable=protected-access
+      StorageService.LocalFileCache(
+          os.path.join(cache_dir, 'rembg'), max_bytes
+      ),
+      ConfigService.REMBG_MODEL,
+      ConfigService.REMBG_PROCESSES,
+      ConfigService.REMBG_THREADS,
+  )
+
+
+def _run_stages(message, assets, template, stages, work_dir):
+  """Renders a message stage by stage, returning the metrics of each."""
+  results = {}
+  run_dir = tempfile.mkdtemp(dir=work_dir)
+  _reset_caches(os.path.join(run_dir, 'cache'))
+  assets = dict(assets)
+  content = message.content
+
+  if _uses_rembg(message) and 'remove_backgrounds' in stages:
+    with _measure('remove_backgrounds', results):
+      RunnerService._remove_backgrounds([message], assets)  # pylint: disable=protected-access
+
+  with _measure('layout', results):
+    images, texts = RunnerService._layout_overlays(content, run_dir, assets)  # pylint: disable=protected-access
+
+  if 'prescale' in stages:
+    prescaler = RunnerService._IMAGE_PRESCALER  # pylint: disable=protected-access
+    with _measure('prescale', results):
+      images = prescaler.prescale(images, run_dir)
+      # Pool workers are only accounted for once they exit.
+      if prescaler._pool is not None:  # pylint: disable=protected-access
+        prescaler._pool.shutdown()  # pylint: disable=protected-access
+
+  with _measure('filters', results):
+    if ConfigService.PRECOMPOSE_LAYERS:
+      images, texts = VideoService.precompose_layers(images, texts, run_dir)
+    filters, text_imgs, _ = VideoService.filter_strings(
+        images,
+        texts,
+        ConfigService.TEXT_RENDERER,
+        RunnerService._TEXT_CACHE,  # pylint: disable=protected-access
+        input_label='src%d',
+        output_dir=run_dir,
+    )
+    _, input_filters = VideoService.share_inputs(
+        VideoService.overlay_inputs(images, text_imgs), label='src%d'
+    )
+  results['filters']['filters'] = len(input_filters) + len(filters)
+
+  if 'ffmpeg' in stages:
+    job = RunnerService._build_render_job(  # pylint: disable=protected-access
+        [content],
+        run_dir,
+        template,
+        [os.path.join(run_dir, 'output.mp4')],
+        assets=assets,
+        audio_codec=VideoService.probe_audio_codec(template),
+    )
+    with _measure('ffmpeg', results):
+      VideoService.run_ffmpeg_batch(**job)
+  return results
+
+
+def _uses_rembg(message):
+  return any(
+      getattr(placement, 'remove_background', 'No') == 'Yes'
+      for content in message.content
+      for placement in content.placements
+  )
+
+
+def _median_results(runs):
+  """Takes the median of every metric over repeated runs of a scenario."""
+  return {
+      stage: {
+          metric: statistics.median(run[stage][metric] for run in runs)
+          for metric in runs[0][stage]
+      }
+      for stage in runs[0]
+  }
+
+
+def _scenario_name(scenario):
+  return (
+      f'p{scenario["placements"]}-s{scenario["segments"]}'
+      + ''.join(
+          f'-{flag}' for flag in ('rotation', 'wrap', 'rembg') if scenario[flag]
+      )
+  )
+
+
+def _print_results(scenarios, baseline):
+  print(
+      f'{"scenario":<28} {"stage":<19} {"wall":>10} {"cpu":>9}'
+      f' {"children":>9} {"procs":>6} {"rss MB":>7} {"vs base":>8}'
+  )
+  for scenario in scenarios:
+    base_stages = baseline.get(scenario['name'], {})
+    for stage, metrics in scenario['stages'].items():
+      change = ''
+      base_wall = base_stages.get(stage, {}).get('wall_s')
+      if base_wall:
+        change = f'{metrics["wall_s"] / base_wall:>7.2f}x'
+      print(
+          f'{scenario["name"]:<28} {stage:<19}'
+          f' {metrics["wall_s"]:>9.3f}s {metrics["cpu_s"]:>8.3f}s'
+          f' {metrics["children_cpu_s"]:>8.3f}s {metrics["subprocesses"]:>6}'
+          f' {metrics["peak_rss_kb"] / 1024:>7.1f} {change:>8}'
+      )
+
+
+def _flags(value):
+  return [v.strip().lower() in ('on', 'true', 'yes', '1')
+          for v in value.split(',')]
+
+
+def _ints(value):
+  return [int(v) for v in value.split(',')]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--placements', type=_ints, default=[1, 20, 200])
+  parser.add_argument('--segments', type=_ints, default=[1, 20])
+  parser.add_argument('--rotation', type=_flags, default=[False, True])
+  parser.add_argument('--wrap', type=_flags, default=[False])
+  parser.add_argument('--rembg', type=_flags, default=[False])
+  parser.add_argument('--images', type=int, default=8,
+                      help='Number of distinct images shared by placements.')
+  parser.add_argument('--duration', type=float, default=20)
+  parser.add_argument('--size', default='1920x1080')
+  parser.add_argument('--font', default=None, help='Font file for text.')
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='Runs per scenario, reporting the median.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--stages', default=','.join(_STAGES),
+                      help='Comma-separated optional stages to run.')
+  parser.add_argument('--output', default=None, help='JSON file to write.')
+  parser.add_argument('--baseline', default=None,
+                      help='JSON file of a previous run to compare to.')
+  args = parser.parse_args()
+
+  stages = set(args.stages.split(','))
+  subprocess.Popen = _CountingPopen
+  work_dir = tempfile.mkdtemp()
+  template = os.path.join(work_dir, 'template.mp4')
+  if 'ffmpeg' in stages:
+    _make_template(template, args.duration, args.size)
+  assets = _make_images(work_dir, args.images, args.seed)
+  image_urls = sorted(url for _, url in assets)
+  if args.font:
+    assets[(RunnerService._ASSET_GCS, _FONT_PATH)] = args.font  # pylint: disable=protected-access
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline = {
+          s['name']: s['stages'] for s in json.load(baseline_file)['scenarios']
+      }
+
+  scenarios = []
+  for placements, segments, rotation, wrap, rembg in itertools.product(
+      args.placements, args.segments, args.rotation, args.wrap, args.rembg
+  ):
+    scenario = {
+        'placements': placements,
+        'segments': min(segments, placements),
+        'rotation': rotation,
+        'wrap': wrap,
+        'rembg': rembg,
+    }
+    name = _scenario_name(scenario)
+    if any(s['name'] == name for s in scenarios):
+      continue
+    message = _make_message(
+        scenario, args.duration, image_urls, args.font, args.seed
+    )
+    runs = [
+        _run_stages(message, assets, template, stages, work_dir)
+        for _ in range(args.repeat)
+    ]
+    scenarios.append({
+        'name': name,
+        'params': scenario,
+        'stages': _median_results(runs),
+    })
+
+  _print_results(scenarios, baseline)
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(
+          {
+              'version': _RESULTS_VERSION,
+              'environment': {
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'cpu_count': os.cpu_count(),
+                  'duration_s': args.duration,
+                  'size': args.size,
+                  'repeat': args.repeat,
+                  'seed': args.seed,
+                  'text_renderer': ConfigService.TEXT_RENDERER,
+                  'text_supersampling': ConfigService.TEXT_SUPERSAMPLING,
+                  'prescale_processes': ConfigService.PRESCALE_PROCESSES,
+                  'precompose_layers': ConfigService.PRECOMPOSE_LAYERS,
+                  'encoding_profile': ConfigService.ENCODING_PROFILE,
+              },
+              'scenarios': scenarios,
+          },
+          output_file,
+          indent=2,
+          sort_keys=True,
+      )
+
+
+if __name__ == '__main__':
+  main()
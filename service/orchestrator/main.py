@@ -18,78 +18,510 @@ This file is the target of a "Cloud Storage" Trigger (Finalize/Create) Cloud
 Function, with `gcs_file_uploaded` as the main entry point.
 """
 
+import codecs
+import hashlib
 import json
 import logging
 import os
 import pathlib
-from concurrent import futures
-from typing import Any, Callable, Collection, Dict
+import threading
+import time
+from typing import (
+    Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
+)
 
 import functions_framework
 from google.cloud import logging as cloudlogging
 from google.cloud import pubsub_v1, storage
 
 
-def get_callback(
-    publish_future: pubsub_v1.publisher.futures.Future, data: str
-) -> Callable[[pubsub_v1.publisher.futures.Future], None]:
-  """Gets a callback function to check the status of message publishing.
+# Maximum number of rows sharing a template to group into one render message.
+RENDER_BATCH_SIZE = max(1, int(os.environ.get("RENDER_BATCH_SIZE", 1)))
+# Pub/Sub client-side batching and flow control.
+PUBLISH_BATCH_MAX_MESSAGES = int(
+    os.environ.get("PUBLISH_BATCH_MAX_MESSAGES", 100)
+)
+PUBLISH_BATCH_MAX_BYTES = int(
+    os.environ.get("PUBLISH_BATCH_MAX_BYTES", 1024 * 1024)
+)
+PUBLISH_BATCH_MAX_LATENCY_S = float(
+    os.environ.get("PUBLISH_BATCH_MAX_LATENCY_S", 0.05)
+)
+PUBLISH_FLOW_CONTROL_MAX_MESSAGES = int(
+    os.environ.get("PUBLISH_FLOW_CONTROL_MAX_MESSAGES", 1000)
+)
+PUBLISH_FLOW_CONTROL_MAX_BYTES = int(
+    os.environ.get("PUBLISH_FLOW_CONTROL_MAX_BYTES", 10 * 1024 * 1024)
+)
+PUBLISH_TIMEOUT_S = float(os.environ.get("PUBLISH_TIMEOUT_S", 300))
+# Size of the chunks config files are streamed from GCS in.
+CONFIG_READ_CHUNK_BYTES = int(
+    os.environ.get("CONFIG_READ_CHUNK_BYTES", 1024 * 1024)
+)
+# Number of individual publish errors to include in the aggregated report.
+PUBLISH_ERROR_SAMPLES = 10
+# Only publish the rows that changed since the folder's previous config.
+INCREMENTAL_RENDER = (
+    os.environ.get("INCREMENTAL_RENDER", "true").lower() == "true"
+)
+# Delete the videos of rows removed since the folder's previous config.
+DELETE_REMOVED_OUTPUTS = (
+    os.environ.get("DELETE_REMOVED_OUTPUTS", "false").lower() == "true"
+)
+# Name of the manifest stored next to each config.json.
+MANIFEST_FILE_NAME = os.environ.get(
+    "MANIFEST_FILE_NAME", ".pva_lite_manifest.json"
+)
+# Bump whenever the row hash changes in a way that makes old manifests stale.
+MANIFEST_VERSION = 2
 
-    Args:
-        publish_future (pubsub_v1.publisher.futures.Future): Future object to
-          check write status.
-        data (str): Data sent to the topic.
 
+class PublishError(Exception):
+  """Raised when some messages could not be published."""
 
-    Returns:
-        Callable[[pubsub_v1.publisher.futures.Future], None]: A callback
-          function.
-    """
+  def __init__(self, failed: int, total: int, samples: List[str]):
+    super().__init__(
+        f"Failed to publish {failed} of {total} messages. First errors:"
+        f" {samples}"
+    )
+    self.failed = failed
+    self.total = total
+    self.samples = samples
 
-  def callback(publish_future: pubsub_v1.publisher.futures.Future) -> None:
-    try:
-      # Wait 60 seconds for the publish call to succeed.
-      print(publish_future.result(timeout=60))
-    except futures.TimeoutError:
-      logging.error("Publishing %s timed out.", data)
 
-  return callback
+class _PublishTracker:
+  """Tracks the outcome of publish futures without holding on to them."""
+
+  def __init__(self):
+    self.published = 0
+    self.failed = 0
+    self.samples = []
+    self._pending = 0
+    self._condition = threading.Condition()
+
+  def track(
+      self, publish_future: pubsub_v1.publisher.futures.Future, message_id: int
+  ) -> None:
+    with self._condition:
+      self._pending += 1
+    publish_future.add_done_callback(
+        lambda f: self._on_done(f, message_id)
+    )
+
+  def _on_done(
+      self, publish_future: pubsub_v1.publisher.futures.Future, message_id: int
+  ) -> None:
+    error = publish_future.exception()
+    with self._condition:
+      if error is None:
+        self.published += 1
+      else:
+        self.failed += 1
+        if len(self.samples) < PUBLISH_ERROR_SAMPLES:
+          self.samples.append(f"message {message_id}: {error!r}")
+      self._pending -= 1
+      self._condition.notify_all()
+
+  def wait(self, timeout: float) -> int:
+    """Waits for all tracked futures, returning how many are still pending."""
+    with self._condition:
+      self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+      return self._pending
+
+
+def create_publisher() -> pubsub_v1.PublisherClient:
+  """Creates a publisher client batching messages and applying flow control.
+
+    Publishing blocks while too many messages or bytes are outstanding, so
+    large configs are fanned out as fast as Pub/Sub accepts them without
+    buffering them all in memory.
+
+    Returns:
+        pubsub_v1.PublisherClient: The publisher client.
+    """
+  batch_settings = pubsub_v1.types.BatchSettings(
+      max_messages=PUBLISH_BATCH_MAX_MESSAGES,
+      max_bytes=PUBLISH_BATCH_MAX_BYTES,
+      max_latency=PUBLISH_BATCH_MAX_LATENCY_S,
+  )
+  flow_control = pubsub_v1.types.PublishFlowControl(
+      message_limit=PUBLISH_FLOW_CONTROL_MAX_MESSAGES,
+      byte_limit=PUBLISH_FLOW_CONTROL_MAX_BYTES,
+      limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+  )
+  return pubsub_v1.PublisherClient(
+      batch_settings,
+      publisher_options=pubsub_v1.types.PublisherOptions(
+          flow_control=flow_control
+      ),
+  )
 
 
 def publish_messages(
     publisher: pubsub_v1.PublisherClient, topic_path: str,
-    messages: Collection[str]
-) -> None:
+    messages: Iterable[str]
+) -> int:
   """Publishes messages to a Pub/Sub topic.
 
+    Waits for all messages to be published and logs throughput metrics.
 
     Args:
         publisher (pubsub_v1.PublisherClient): The PubSub publisher client.
         topic_path (str): Pub/Sub topic path.
-        messages (Collection[str]): A collection of messages to publish.
+        messages (Iterable[str]): The messages to publish, consumed lazily.
+
+    Returns:
+        int: The number of published messages.
+
+    Raises:
+        PublishError: If any message failed to publish or timed out.
     """
   logging.info("BEGIN - Writing messages to topic: %s...", topic_path)
+  start = time.monotonic()
+  tracker = _PublishTracker()
+  total_messages = 0
+  total_bytes = 0
   for message_id, message_body in enumerate(messages):
-    logging.info("Writing Message %d ...", message_id)
-    # When you publish a message, the client returns a future.
-    publish_future = publisher.publish(topic_path, message_body.encode("utf-8"))
-    # Non-blocking. Publish failures are handled in the callback function.
-    publish_future.add_done_callback(get_callback(publish_future, message_body))
-    publish_futures = []
-    publish_futures.append(publish_future)
+    data = message_body.encode("utf-8")
+    # Non-blocking unless flow control limits are reached. Publish failures
+    # are collected by the tracker.
+    tracker.track(publisher.publish(topic_path, data), message_id)
+    total_messages += 1
+    total_bytes += len(data)
 
   # Wait for all the publish futures to resolve before exiting.
-  futures.wait(publish_futures, return_when=futures.ALL_COMPLETED)
-
+  pending = tracker.wait(timeout=PUBLISH_TIMEOUT_S)
+  elapsed = max(time.monotonic() - start, 1e-6)
   logging.info(
-      "END - Published %d messages to topic: %s...", len(messages), topic_path
+      "END - Published %d of %d messages (%d bytes) to topic %s in %.2fs:"
+      " %.1f messages/s, %.1f bytes/s.",
+      tracker.published,
+      total_messages,
+      total_bytes,
+      topic_path,
+      elapsed,
+      tracker.published / elapsed,
+      total_bytes / elapsed,
   )
 
+  failed = tracker.failed + pending
+  if failed:
+    samples = list(tracker.samples)
+    if pending:
+      samples.append(f"{pending} messages timed out")
+    logging.error(
+        "Failed to publish %d of %d messages: %s",
+        failed,
+        total_messages,
+        samples,
+    )
+    raise PublishError(failed, total_messages, samples)
+  return tracker.published
+
+
+def iter_json_array(
+    stream: BinaryIO, chunk_size: int = 1024 * 1024
+) -> Iterator[Any]:
+  """Incrementally parses a top-level JSON array, yielding its elements.
+
+    Only the element being parsed (plus about as much again, read ahead) is
+    held in memory, regardless of the size of the whole array. Invalid input
+    fails as soon as it is read, rather than once the stream is exhausted.
+
+    Args:
+        stream (BinaryIO): A binary stream of UTF-8 encoded JSON.
+        chunk_size (int): The minimum number of bytes to read at a time.
+
+    Yields:
+        Any: The decoded elements of the array, in order.
+
+    Raises:
+        ValueError: If the stream does not hold a valid JSON array, giving the
+          byte offset of the error.
+    """
+  decoder = json.JSONDecoder()
+  utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+  buffer = ""
+  position = 0
+  offset = 0  # The number of bytes of the stream before the buffer.
+  eof = False
+  # What may come next: "[", "first" (an element or "]"), "element" or
+  # "separator" ("," or "]").
+  expecting = "["
+
+  def read_more() -> bool:
+    nonlocal buffer, position, offset, eof
+    if eof:
+      return False
+    # Reads at least as much as is buffered, so an element spanning many
+    # chunks is only re-parsed a few times.
+    chunk = stream.read(max(chunk_size, len(buffer) - position))
+    eof = not chunk
+    offset += len(buffer[:position].encode("utf-8"))
+    buffer = buffer[position:] + utf8_decoder.decode(chunk, final=eof)
+    position = 0
+    return True
+
+  def error(message: str, at: int) -> ValueError:
+    byte = offset + len(buffer[:at].encode("utf-8"))
+    return ValueError(f"{message} at byte {byte} of the JSON array.")
+
+  while True:
+    while position < len(buffer) and buffer[position] in " \t\r\n":
+      position += 1
+    if position >= len(buffer):
+      if not read_more():
+        raise error("Unexpected end", position)
+      continue
+    char = buffer[position]
+
+    if expecting == "[":
+      if char == "\ufeff" and offset + position == 0:
+        position += 1
+        continue
+      if char != "[":
+        raise error("Expected '['", position)
+      expecting = "first"
+      position += 1
+      continue
+    if expecting == "separator":
+      if char == "]":
+        return
+      if char != ",":
+        raise error("Expected ',' or ']'", position)
+      expecting = "element"
+      position += 1
+      continue
+    if char == "]" and expecting == "first":
+      return
+    if char in ",]":
+      raise error("Expected an element", position)
+
+    try:
+      element, end = decoder.raw_decode(buffer, position)
+    except json.JSONDecodeError as e:
+      # Errors at the end of the buffer (or in a string running up to it) may
+      # just be an element continuing in the next chunk.
+      incomplete = (
+          e.msg.startswith("Unterminated string") or len(buffer) - e.pos <= 16
+      )
+      if incomplete and read_more():
+        continue
+      raise error(f"Invalid element ({e.msg})", e.pos) from e
+    if end == len(buffer) and read_more():
+      continue  # A number may continue in the next chunk.
+    position = end
+    expecting = "separator"
+    yield element
+
+
+def build_messages(
+    video_configs: Iterable[Dict[str, Any]], batch_size: int = 1
+) -> Iterator[str]:
+  """Serializes video configs into render messages, lazily.
+
+    Args:
+        video_configs (Iterable[Dict[str, Any]]): The video configs to render.
+        batch_size (int): The maximum number of configs sharing the same
+          template (video and audio) to group into one batch message, which the
+          runner renders with a single decode of the template. Values below 2
+          create one message per config.
+
+    Yields:
+        str: The serialized messages. Batches are emitted as soon as they are
+          full, so at most one pending batch per template is held in memory.
+    """
+  if batch_size <= 1:
+    for video_config in video_configs:
+      yield json.dumps(video_config)
+    return
+
+  batches = {}
+  for video_config in video_configs:
+    template = (
+        video_config.get("template_video"),
+        video_config.get("template_audio"),
+    )
+    batch = batches.setdefault(template, [])
+    batch.append(video_config)
+    if len(batch) >= batch_size:
+      yield json.dumps({"variants": batch})
+      del batches[template]
+
+  for batch in batches.values():
+    yield json.dumps({"variants": batch})
+
+
+def output_gcs_path(video_config: Dict[str, Any]) -> str:
+  """Returns the path the runner uploads a video config's video to."""
+  output_path = video_config.get("output_path", ".")
+  folder = f"{output_path}/" if output_path != "." else ""
+  _, video_ext = os.path.splitext(video_config.get("template_video", ""))
+  return f"{folder}{video_config.get('ad_group')}{video_ext}"
+
+
+class ManifestDiff:
+  """Diffs video configs against the manifest of a previous config.
+
+    The manifest maps each row key (the ad group, which names the output) to
+    the hash of the row and the path of its video. The runner records the hash
+    of the row it rendered on the video, so rows are only unchanged once their
+    video exists and was rendered for the same hash: rows whose render failed
+    are published again with the next config.
+
+    Attributes:
+        previous (Dict[str, Dict[str, str]]): The previous manifest rows.
+        current (Dict[str, Dict[str, str]]): The rows seen so far.
+        added (int): The number of rows not in the previous manifest.
+        changed (int): The number of rows whose hash changed, or whose video
+          is missing or outdated.
+        unchanged (int): The number of rows skipped.
+    """
+
+  def __init__(
+      self,
+      bucket: storage.Bucket,
+      previous: Dict[str, Dict[str, str]],
+      existing_outputs: Dict[str, Optional[str]],
+  ):
+    """Initializes the diff.
+
+      Args:
+          bucket (storage.Bucket): The bucket holding the templates and fonts.
+          previous (Dict[str, Dict[str, str]]): The previous manifest rows.
+          existing_outputs (Dict[str, Optional[str]]): The row hash recorded
+            on each existing video (None if there is none), by path.
+      """
+    self.previous = previous
+    self.current = {}
+    self.added = 0
+    self.changed = 0
+    self.unchanged = 0
+    self._bucket = bucket
+    self._existing_outputs = existing_outputs
+    self._generations = {}
+
+  def _generation(self, path: Optional[str]) -> Optional[int]:
+    """Returns the generation of a file, so replacing it re-renders."""
+    if not path:
+      return None
+    if path not in self._generations:
+      blob = self._bucket.get_blob(path)
+      self._generations[path] = blob.generation if blob else None
+    return self._generations[path]
+
+  def row_hash(self, video_config: Dict[str, Any]) -> str:
+    """Hashes a row with the generations of its templates and fonts.
+
+      Images are only known by their URL: serve changed images under a new URL
+      (e.g. with a version parameter) for their rows to be rendered again.
+      """
+    fonts = sorted({
+        placement["text_font"]
+        for content in video_config.get("content") or []
+        for placement in content.get("placements") or []
+        if isinstance(placement, dict) and placement.get("text_font")
+    })
+    canonical = json.dumps(
+        {
+            "version": MANIFEST_VERSION,
+            "config": video_config,
+            "template_video": self._generation(
+                video_config.get("template_video")
+            ),
+            "template_audio": self._generation(
+                video_config.get("template_audio")
+            ),
+            "fonts": {font: self._generation(font) for font in fonts},
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+  def filter(
+      self, video_configs: Iterable[Dict[str, Any]]
+  ) -> Iterator[Dict[str, Any]]:
+    """Yields the configs to render, recording all of them.
+
+      Configs are tagged with their row hash for the runner to record on their
+      video, and flagged to replace any existing video.
+      """
+    for video_config in video_configs:
+      key = str(video_config.get("ad_group"))
+      entry = {
+          "hash": self.row_hash(video_config),
+          "output": output_gcs_path(video_config),
+      }
+      self.current[key] = entry
+      if self._existing_outputs.get(entry["output"]) == entry["hash"]:
+        self.unchanged += 1
+        continue
+      if key in self.previous:
+        self.changed += 1
+      else:
+        self.added += 1
+      video_config = dict(video_config, row_hash=entry["hash"])
+      if entry["output"] in self._existing_outputs:
+        video_config["replace_output"] = True
+      yield video_config
+
+  def removed(self) -> Dict[str, Dict[str, str]]:
+    """Returns the previous rows missing from the configs seen so far."""
+    return {
+        key: entry
+        for key, entry in self.previous.items()
+        if key not in self.current
+    }
+
+
+def load_manifest(
+    bucket: storage.Bucket, path: str
+) -> Dict[str, Dict[str, str]]:
+  """Loads the rows of a manifest, or none if it's missing or unusable."""
+  blob = bucket.get_blob(path)
+  if blob is None:
+    return {}
+  try:
+    manifest = json.loads(blob.download_as_bytes())
+    if manifest.get("version") != MANIFEST_VERSION:
+      logging.info("Ignoring manifest %s with an outdated version.", path)
+      return {}
+    rows = manifest.get("rows", {})
+    if not isinstance(rows, dict):
+      raise ValueError("rows is not an object")
+    return rows
+  except (ValueError, AttributeError) as e:
+    logging.warning("Ignoring unreadable manifest %s: %s", path, e)
+    return {}
+
+
+def save_manifest(
+    bucket: storage.Bucket, path: str, rows: Dict[str, Dict[str, str]]
+) -> None:
+  bucket.blob(path).upload_from_string(
+      json.dumps({"version": MANIFEST_VERSION, "rows": rows}),
+      content_type="application/json",
+  )
+
+
+def delete_outputs(
+    bucket: storage.Bucket, rows: Dict[str, Dict[str, str]]
+) -> None:
+  """Deletes the videos of the given manifest rows, if they still exist."""
+  for entry in rows.values():
+    blob = bucket.get_blob(entry["output"])
+    if blob is not None:
+      blob.delete()
+      logging.info("Deleted output of removed row: %s", entry["output"])
+
 
 @functions_framework.cloud_event
 def gcs_file_uploaded(cloud_event: Dict[str, Any]):
   """Triggered by a change in a storage bucket.
 
+    The config is streamed from GCS and each video config is published as
+    soon as it is parsed, so memory use does not depend on the config size.
+
     Args:
       cloud_event: The Eventarc trigger event.
     """
@@ -106,20 +538,54 @@ def gcs_file_uploaded(cloud_event: Dict[str, Any]):
     config_folder_path = str(
         pathlib.Path(os.path.splitext(filepath)[0]).parents[0]
     )
-    # Read the config file from GCS
+    publisher = create_publisher()
+    topic_path = publisher.topic_path(
+        os.environ["GCP_PROJECT_ID"], os.environ["PUBSUB_TOPIC"]
+    )
+
+    # Read the config file from GCS, writing to the PubSub topic as we go.
     storage_client = storage.Client()
     bucket = storage_client.get_bucket(data["bucket"])
     blob = bucket.blob(filepath)
-    config_data = json.loads(blob.download_as_string())
-    logging.info("END - Finished processing uploaded file: %s.", filepath)
 
-    # Write to PubSub topic.
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(
-        os.environ["GCP_PROJECT_ID"], os.environ["PUBSUB_TOPIC"]
+    manifest_path = str(
+        pathlib.PurePosixPath(config_folder_path) / MANIFEST_FILE_NAME
     )
-    messages = []
-    for video_config in config_data:
-      video_config["output_path"] = config_folder_path
-      messages.append(json.dumps(video_config))
-    publish_messages(publisher, topic_path, messages)
+    previous = {}
+    existing_outputs = {}
+    if INCREMENTAL_RENDER:
+      previous = load_manifest(bucket, manifest_path)
+      prefix = f"{config_folder_path}/" if config_folder_path != "." else ""
+      existing_outputs = {
+          output.name: (output.metadata or {}).get("row_hash")
+          for output in storage_client.list_blobs(bucket, prefix=prefix)
+      }
+    diff = ManifestDiff(bucket, previous, existing_outputs)
+
+    with blob.open("rb", chunk_size=CONFIG_READ_CHUNK_BYTES) as config_file:
+      video_configs = (
+          dict(video_config, output_path=config_folder_path)
+          for video_config in iter_json_array(
+              config_file, CONFIG_READ_CHUNK_BYTES
+          )
+      )
+      if INCREMENTAL_RENDER:
+        video_configs = diff.filter(video_configs)
+      messages = build_messages(video_configs, RENDER_BATCH_SIZE)
+      publish_messages(publisher, topic_path, messages)
+
+    if INCREMENTAL_RENDER:
+      removed = diff.removed()
+      logging.info(
+          "Manifest diff: %d added, %d changed, %d unchanged, %d removed.",
+          diff.added,
+          diff.changed,
+          diff.unchanged,
+          len(removed),
+      )
+      # Only used to find removed rows: rows are skipped based on the row
+      # hash the runner records on their video once it's rendered.
+      save_manifest(bucket, manifest_path, diff.current)
+      if DELETE_REMOVED_OUTPUTS:
+        delete_outputs(bucket, removed)
+    logging.info("END - Finished processing uploaded file: %s.", filepath)
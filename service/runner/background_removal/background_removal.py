@@ -0,0 +1,176 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite background removal service.
+
+This module wraps rembg, keeping its ONNX session warm and caching cut-outs.
+rembg is imported lazily, so renders without background removal don't pay
+for loading it.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from typing import Optional
+
+import storage as StorageService
+from PIL import Image
+
+# One session per model and process; rembg sessions are safe to share between
+# threads.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(model_name: str, threads: int = 0):
+  """Returns the process-wide rembg session for a model, creating it once.
+
+  Args:
+    model_name: The rembg model to load.
+    threads: The onnxruntime thread limit to create the session with, or 0
+      for onnxruntime's default. Ignored if the session already exists.
+
+  Returns:
+    The rembg session.
+  """
+  with _sessions_lock:
+    if model_name not in _sessions:
+      logging.info('Loading rembg model "%s"...', model_name)
+      _sessions[model_name] = _new_session(model_name, threads)
+    return _sessions[model_name]
+
+
+def _new_session(model_name: str, threads: int):
+  # pylint: disable=g-import-not-at-top
+  from rembg import new_session
+  from rembg.sessions import sessions_class
+  import onnxruntime
+  # pylint: enable=g-import-not-at-top
+
+  if threads <= 0:
+    return new_session(model_name)
+  # rembg only limits threads through OMP_NUM_THREADS, which is process-wide,
+  # so the session is created with its own options instead.
+  for session_class in sessions_class:
+    if session_class.name() == model_name:
+      options = onnxruntime.SessionOptions()
+      options.inter_op_num_threads = threads
+      options.intra_op_num_threads = threads
+      return session_class(model_name, options)
+  raise ValueError(f'Unknown rembg model "{model_name}".')
+
+
+def remove_background_file(
+    input_path: str, output_path: str, model_name: str, threads: int = 0
+) -> str:
+  """Removes the background of an image in the current process.
+
+  Args:
+    input_path: The image to remove the background from.
+    output_path: Where to write the resulting PNG to.
+    model_name: The rembg model to use.
+    threads: The onnxruntime thread limit, see `get_session`.
+
+  Returns:
+    The output path.
+  """
+  from rembg import remove  # pylint: disable=g-import-not-at-top
+
+  with Image.open(input_path) as input_image:
+    output_image = remove(
+        input_image, session=get_session(model_name, threads)
+    )
+  output_image.save(output_path)
+  return output_path
+
+
+def _init_worker(model_name: str, threads: int) -> None:
+  # Loads the model once per worker, rather than on its first image.
+  get_session(model_name, threads)
+
+
+class BackgroundRemover:
+  """Removes image backgrounds, caching the results by source content.
+
+  Attributes:
+    cache: The local cache of cut-outs, keyed by model and source digest.
+    model_name: The rembg model to use.
+    processes: The number of worker processes to run removals in, or 0 to run
+      them in the calling process.
+    threads: The onnxruntime thread limit of the session in each process
+      running removals, or 0 for onnxruntime's default.
+  """
+
+  def __init__(
+      self,
+      cache: StorageService.LocalFileCache,
+      model_name: str,
+      processes: int = 0,
+      threads: int = 0,
+  ):
+    self.cache = cache
+    self.model_name = model_name
+    self.processes = processes
+    self.threads = threads
+    self._pool = None
+    self._pool_lock = threading.Lock()
+
+  def remove(self, input_path: str, output_path: Optional[str] = None) -> str:
+    """Removes the background of an image.
+
+    Args:
+      input_path: The image to remove the background from.
+      output_path: Where to write the resulting PNG to. Defaults to the input
+        path with an added '.png' extension.
+
+    Returns:
+      The output path.
+    """
+    output_path = output_path or f'{input_path}.png'
+    key = f'{self.model_name}:{StorageService.file_digest(input_path)}'
+    if self.cache.copy_to(key, output_path):
+      logging.debug('Reusing cut-out of %s.', input_path)
+      return output_path
+
+    if self.processes > 0:
+      self._get_pool().submit(
+          remove_background_file, input_path, output_path, self.model_name,
+          self.threads
+      ).result()
+    else:
+      remove_background_file(
+          input_path, output_path, self.model_name, self.threads
+      )
+
+    staging_path = self.cache.staging_path()
+    shutil.copyfile(output_path, staging_path)
+    if self.cache.put_file(key, staging_path) is None:
+      os.remove(staging_path)
+    return output_path
+
+  def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+    with self._pool_lock:
+      if self._pool is None:
+        # Workers are spawned rather than forked, as forking copies the
+        # state of the gRPC and logging threads running by then.
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.model_name, self.threads),
+        )
+      return self._pool
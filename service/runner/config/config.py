@@ -19,7 +19,145 @@ PVA Lite.
 """
 
 import os
+import tempfile
 
 GCP_PROJECT_ID = os.environ.get('GCP_PROJECT_ID', 'pva-lite')
 GCS_BUCKET = os.environ.get('GCS_BUCKET', 'pva-lite-bucket')
 PUBSUB_TOPIC = os.environ.get('PUBSUB_TOPC', 'pva-lite')
+
+# Local cache for files fetched from GCS (templates, audio, fonts, images).
+CACHE_ROOT_DIR = os.environ.get(
+    'CACHE_ROOT_DIR', os.path.join(tempfile.gettempdir(), 'pva_lite_cache')
+)
+ASSET_CACHE_DIR = os.path.join(CACHE_ROOT_DIR, 'assets')
+ASSET_CACHE_MAX_BYTES = int(
+    os.environ.get('ASSET_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+)
+TEXT_CACHE_DIR = os.path.join(CACHE_ROOT_DIR, 'text')
+TEXT_CACHE_MAX_BYTES = int(
+    os.environ.get('TEXT_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+)
+# Folder in GCS_BUCKET to share rendered text images between instances through.
+# Sharing is disabled if empty. When enabled, every text image missing from the
+# local cache costs a GCS lookup (and an upload once rendered), so it pays off
+# when labels repeat across instances and rendering them is slow.
+TEXT_CACHE_GCS_PREFIX = os.environ.get('TEXT_CACHE_GCS_PREFIX', '')
+FONT_METRICS_SIDECAR_PATH = os.path.join(CACHE_ROOT_DIR, 'font_metrics.json')
+
+# Backend rasterizing text placements: 'imagemagick' or 'pillow' (in-process).
+TEXT_RENDERER = os.environ.get('TEXT_RENDERER', 'imagemagick')
+# How many times larger than its size text is rendered before ffmpeg scales it
+# down. Higher is smoother but costs more memory and CPU per label, 1 renders
+# text at its size (still antialiased).
+TEXT_SUPERSAMPLING = max(1, int(os.environ.get('TEXT_SUPERSAMPLING', 4)))
+
+# Number of assets downloaded in parallel before laying out a video.
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 8))
+
+# Background removal (rembg) settings.
+REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+REMBG_CACHE_DIR = os.path.join(CACHE_ROOT_DIR, 'rembg')
+REMBG_CACHE_MAX_BYTES = int(
+    os.environ.get('REMBG_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+)
+# Worker processes to remove backgrounds in, 0 to use the calling process.
+REMBG_PROCESSES = int(os.environ.get('REMBG_PROCESSES', 0))
+# onnxruntime threads per background removal session, 0 for its default.
+REMBG_THREADS = int(os.environ.get('REMBG_THREADS', 0))
+
+# Fetching images from http(s) URLs.
+HTTP_CACHE_DIR = os.path.join(CACHE_ROOT_DIR, 'http')
+HTTP_CACHE_MAX_BYTES = int(
+    os.environ.get('HTTP_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+)
+HTTP_MAX_IMAGE_BYTES = int(
+    os.environ.get('HTTP_MAX_IMAGE_BYTES', 50 * 1024 * 1024)
+)
+HTTP_TIMEOUT_S = float(os.environ.get('HTTP_TIMEOUT_S', 30))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(
+    os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', 4)
+)
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+
+# Image overlays scaled to their final size, by source digest and size.
+PRESCALE_CACHE_DIR = os.path.join(CACHE_ROOT_DIR, 'scaled')
+PRESCALE_CACHE_MAX_BYTES = int(
+    os.environ.get('PRESCALE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+)
+# Number of processes scaling image overlays, 0 to scale them in the calling
+# process. Each holds full-resolution decoded images, so the default is capped
+# to keep the pool's memory use independent of the core count.
+PRESCALE_PROCESSES = int(
+    os.environ.get('PRESCALE_PROCESSES', min(4, os.cpu_count() or 1))
+)
+
+# Maximum number of variants of a batch message rendered by one ffmpeg run.
+RENDER_MAX_BATCH_SIZE = int(os.environ.get('RENDER_MAX_BATCH_SIZE', 8))
+
+# Composite overlays sharing the same time window into a single layer before
+# running ffmpeg, so each frame blends one layer per window. Opt-in, as layers
+# are composited with Pillow rather than ffmpeg's overlay filter.
+PRECOMPOSE_LAYERS = (
+    os.environ.get('PRECOMPOSE_LAYERS', 'false').lower() == 'true'
+)
+
+# Only re-encode the template where overlays are shown, stream-copying the
+# rest. Requires H.264 templates whose profile, level and reference frames
+# libx264 can reproduce, others are always rendered in full.
+SMART_RENDER = os.environ.get('SMART_RENDER', 'false').lower() == 'true'
+# Minimum duration of the template that must be stream-copied for smart
+# rendering to be used.
+SMART_RENDER_MIN_COPY_S = float(
+    os.environ.get('SMART_RENDER_MIN_COPY_S', 2)
+)
+
+# Number of chunks of the timeline to render in parallel ffmpeg runs, 0 to
+# use one per available core, 1 to render in a single run. Experimental: its
+# speedup hasn't been measured yet, see benchmarks/chunked_render_benchmark.py.
+PARALLEL_CHUNKS = int(os.environ.get('PARALLEL_CHUNKS', 1))
+# Minimum duration of each of these chunks, at least 0.1s (also for 0, i.e.
+# no minimum).
+PARALLEL_CHUNK_MIN_S = max(
+    float(os.environ.get('PARALLEL_CHUNK_MIN_S', 5)), 0.1
+)
+
+# Encoding profile used by messages not selecting one, see
+# pva_video.ENCODING_PROFILES.
+ENCODING_PROFILE = os.environ.get('ENCODING_PROFILE', 'balanced')
+# Copy the template's (or template_audio's) audio stream instead of
+# re-encoding it when the output container supports its codec.
+AUDIO_PASSTHROUGH = (
+    os.environ.get('AUDIO_PASSTHROUGH', 'true').lower() == 'true'
+)
+
+# Reuse earlier renders of identical messages instead of rendering them again.
+RENDER_DEDUP = os.environ.get('RENDER_DEDUP', 'true').lower() == 'true'
+# Folder in GCS_BUCKET mapping render hashes to the videos rendered for them.
+RENDER_INDEX_PREFIX = os.environ.get('RENDER_INDEX_PREFIX', '.pva_lite/renders')
+
+# Also export the spans timing each render's stages to OpenTelemetry, over
+# OTLP as configured by the OTEL_EXPORTER_OTLP_* variables. Requires the
+# opentelemetry-sdk and opentelemetry-exporter-otlp packages.
+RENDER_TRACING = os.environ.get('RENDER_TRACING', 'false').lower() == 'true'
+
+# Stop ffmpeg runs taking longer than this, so hung renders fail before the
+# function's own timeout; 0 for no limit.
+FFMPEG_TIMEOUT_S = float(os.environ.get('FFMPEG_TIMEOUT_S', 480))
+# Time a message may take overall, shared by its ffmpeg runs: each is stopped
+# once the message runs past it (leaving time to fail before the function's
+# 540s timeout); 0 for no limit.
+MESSAGE_DEADLINE_S = float(os.environ.get('MESSAGE_DEADLINE_S', 500))
+# Stop ffmpeg runs making no progress for this long; 0 for no limit.
+FFMPEG_STALL_TIMEOUT_S = float(os.environ.get('FFMPEG_STALL_TIMEOUT_S', 60))
+
+# Pub/Sub subscription pulled by the long-lived worker (see worker.py), by
+# name within GCP_PROJECT_ID or as a full path.
+WORKER_SUBSCRIPTION = os.environ.get('WORKER_SUBSCRIPTION', '')
+# Number of messages the worker renders at once, 0 to size it to the cores
+# and memory available, set aside per render as below.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 0))
+WORKER_CORES_PER_RENDER = int(os.environ.get('WORKER_CORES_PER_RENDER', 2))
+WORKER_MEMORY_PER_RENDER = int(
+    os.environ.get('WORKER_MEMORY_PER_RENDER', 4 * 1024 * 1024 * 1024)
+)
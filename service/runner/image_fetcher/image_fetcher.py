@@ -0,0 +1,232 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite image fetcher.
+
+This module downloads images from http(s) URLs through a shared, pooled
+session, revalidating previously fetched images instead of downloading them
+again.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+import render_metrics as RenderMetricsService
+import requests
+import storage as StorageService
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+USER_AGENT = (
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML,'
+    ' like Gecko) Chrome/90.0.4430.72 Safari/537.36 '
+)
+
+
+class ImageTooLargeError(ValueError):
+  """Raised when an image exceeds the configured maximum size."""
+
+
+class ImageFetcher:
+  """Downloads images over http(s), caching them locally.
+
+  Cached images are revalidated with their ETag / Last-Modified validators,
+  so unchanged images cost a round trip but no transfer. Requests go through
+  one session with a connection pool per host and are retried with
+  exponential backoff on connection errors and transient HTTP statuses.
+
+  Attributes:
+    cache: The local cache of image contents and their HTTP validators.
+    max_bytes: The maximum size of a single image.
+    timeout: The connect/read timeout of each request, in seconds.
+    max_per_host: The maximum number of concurrent requests per host.
+  """
+
+  def __init__(
+      self,
+      cache: StorageService.LocalFileCache,
+      max_bytes: int,
+      timeout: float = 30,
+      max_per_host: int = 4,
+      max_retries: int = 3,
+      backoff_factor: float = 0.5,
+  ):
+    self.cache = cache
+    self.max_bytes = max_bytes
+    self.timeout = timeout
+    self.max_per_host = max_per_host
+    self._host_slots = collections.defaultdict(
+        lambda: threading.BoundedSemaphore(max_per_host)
+    )
+    self._host_slots_lock = threading.Lock()
+
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET',),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=max_per_host, max_retries=retry)
+    self.session = requests.Session()
+    self.session.headers['User-Agent'] = USER_AGENT
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def fetch(self, url: str, output_dir: str) -> str:
+    """Downloads an image to a new file in `output_dir`.
+
+    Args:
+      url: The http(s) URL of the image.
+      output_dir: The directory to write the image to.
+
+    Returns:
+      The path of the downloaded image, with an extension matching its
+      content type.
+
+    Raises:
+      requests.exceptions.RequestException: If the image can't be fetched.
+      ImageTooLargeError: If the image is larger than `max_bytes`.
+    """
+    output_path = self._fetch(url, output_dir, revalidate=True)
+    if output_path is None:
+      # The cached copy was evicted while being revalidated.
+      output_path = self._fetch(url, output_dir, revalidate=False)
+    return output_path
+
+  def _fetch(
+      self, url: str, output_dir: str, revalidate: bool
+  ) -> Optional[str]:
+    """Fetches an image, or returns None if a 304 found no cached copy."""
+    metadata = self._load_metadata(url) if revalidate else None
+    headers = {}
+    # Hits are only counted once the server confirms the cached copy.
+    if metadata and self.cache.contains(url):
+      if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+      if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+
+    with self._host_slot(url):
+      with self.session.get(
+          url, headers=headers, stream=True, timeout=self.timeout
+      ) as r:
+        if r.status_code == 304 and headers:
+          output_path = _new_file(output_dir, metadata['extension'])
+          if not self.cache.copy_to(url, output_path):
+            os.remove(output_path)
+            return None
+          logging.debug('FETCH - "%s" not modified, using cached copy.', url)
+          RenderMetricsService.increment('http_not_modified')
+          return output_path
+        r.raise_for_status()
+        self.cache.count_miss()
+
+        content_length = int(r.headers.get('content-length') or 0)
+        if content_length > self.max_bytes:
+          raise ImageTooLargeError(
+              f'Image {url} is {content_length} bytes, the limit is'
+              f' {self.max_bytes}.'
+          )
+        metadata = {
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified'),
+            'extension': _guess_extension(r.headers.get('content-type')),
+        }
+        staging_path = self.cache.staging_path()
+        try:
+          self._stream_to_file(r, url, staging_path)
+        except Exception:
+          os.remove(staging_path)
+          raise
+
+    output_path = _new_file(output_dir, metadata['extension'])
+    shutil.copyfile(staging_path, output_path)
+    can_revalidate = metadata['etag'] or metadata['last_modified']
+    if not can_revalidate or self.cache.put_file(url, staging_path) is None:
+      os.remove(staging_path)
+    else:
+      self._save_metadata(url, metadata)
+    logging.info('FETCH - Downloaded "%s".', url)
+    return output_path
+
+  def _stream_to_file(
+      self, r: requests.Response, url: str, file_path: str
+  ) -> None:
+    size = 0
+    with open(file_path, 'wb') as f:
+      for chunk in r.iter_content(chunk_size=64 * 1024):
+        size += len(chunk)
+        if size > self.max_bytes:
+          raise ImageTooLargeError(
+              f'Image {url} exceeds the limit of {self.max_bytes} bytes.'
+          )
+        f.write(chunk)
+    RenderMetricsService.increment('http_download_bytes', size)
+
+  @contextlib.contextmanager
+  def _host_slot(self, url: str):
+    with self._host_slots_lock:
+      slot = self._host_slots[urlparse(url).netloc]
+    with slot:
+      yield
+
+  def _load_metadata(self, url: str) -> Optional[Dict[str, Any]]:
+    try:
+      contents = self.cache.read_bytes(f'{url}#metadata', count=False)
+      return json.loads(contents) if contents else None
+    except (OSError, ValueError):
+      return None
+
+  def _save_metadata(self, url: str, metadata: Dict[str, Any]) -> None:
+    staging_path = self.cache.staging_path()
+    with open(staging_path, 'w', encoding='utf-8') as f:
+      json.dump(metadata, f)
+    if self.cache.put_file(f'{url}#metadata', staging_path) is None:
+      os.remove(staging_path)
+
+
+def _guess_extension(content_type: Optional[str]) -> str:
+  # Get content type and guess extension
+  extension = mimetypes.guess_extension(
+      content_type.split(';')[0].strip()
+  ) if content_type else '.img'  # Default extension if type unknown
+
+  # If guessed extension is None or odd
+  if extension is None:
+    extension = '.img'  # Use default extension
+  elif extension == '.jpe':
+    extension = '.jpg'
+
+  if not extension.startswith('.'):
+    extension = '.' + extension
+  return extension
+
+
+def _new_file(output_dir: str, extension: str) -> str:
+  # Construct a safe, unique filename (images may be fetched in parallel)
+  fd, output_path = tempfile.mkstemp(
+      prefix='img_', suffix=extension, dir=output_dir
+  )
+  os.close(fd)
+  return output_path
@@ -0,0 +1,246 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite image scaling service.
+
+This module scales and rotates image overlays to their final size with Pillow
+before they are handed to ffmpeg, in a process pool and caching the results,
+so ffmpeg never decodes (or scales) images larger than they are shown.
+"""
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Optional
+
+import pva_video as VideoService
+import storage as StorageService
+from PIL import Image
+
+# Errors scaling a single image, which is then left for ffmpeg to scale.
+_SCALING_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+def scale_image_file(
+    input_path: str,
+    output_path: str,
+    width: Any,
+    height: Any,
+    keep_ratio: bool,
+    angle: Optional[Any],
+) -> tuple[int, int]:
+  """Scales and rotates an image in the current process.
+
+  Args:
+    input_path: The image to scale, in any format Pillow reads.
+    output_path: Where to write the resulting RGBA PNG to.
+    width: The overlay width, see `VideoService.scale_image`.
+    height: The overlay height, see `VideoService.scale_image`.
+    keep_ratio: Whether to fit the image in the overlay size.
+    angle: The optional clockwise rotation in degrees.
+
+  Returns:
+    The size of the resulting image.
+  """
+  with Image.open(input_path) as input_image:
+    output_image = VideoService.scale_image(
+        input_image.convert('RGBA'), width, height, keep_ratio, angle
+    )
+  output_image.save(output_path, compress_level=1)
+  return output_image.size
+
+
+class ImagePrescaler:
+  """Scales image overlays to their final size, caching the results.
+
+  Attributes:
+    cache: The local cache of scaled images, keyed by source digest and
+      overlay size, ratio and angle.
+    processes: The number of worker processes to scale images in, or 0 to
+      scale them in the calling process.
+  """
+
+  def __init__(
+      self, cache: StorageService.LocalFileCache, processes: int = 0
+  ):
+    self.cache = cache
+    self.processes = processes
+    self._pool = None
+    self._pool_lock = threading.Lock()
+
+  def prescale(
+      self, overlays: list[dict[str, Any]], output_dir: str
+  ) -> list[dict[str, Any]]:
+    """Replaces the images of overlays with copies scaled to their size.
+
+    Animated GIFs are left for ffmpeg to scale, as are images Pillow fails to
+    read.
+
+    Args:
+      overlays: The image overlay objects, see `VideoService.filter_strings`.
+      output_dir: The directory to write the scaled images to.
+
+    Returns:
+      The overlays, with scaled images that need no further scaling or
+      rotation, and positions adjusted accordingly.
+    """
+    keys = {}
+    for index, ovr in enumerate(overlays):
+      if 'image' in ovr and not VideoService.is_animated(ovr):
+        keys[index] = self._key(ovr)
+
+    scaled = {}
+    pending = {}
+    for index, key in keys.items():
+      if key in scaled or key in pending:
+        continue
+      scaled_path = self._copy_from_cache(key, output_dir)
+      if scaled_path is not None:
+        scaled[key] = scaled_path
+      else:
+        pending[key] = overlays[index]
+    cached = len(scaled)
+    scaled.update(self._scale(pending, output_dir))
+
+    result = []
+    for index, ovr in enumerate(overlays):
+      scaled_path = scaled.get(keys.get(index))
+      result.append(
+          _scaled_overlay(ovr, scaled_path) if scaled_path else ovr
+      )
+    logging.info(
+        'Pre-scaled %d images (%d cached) for %d overlays.',
+        len(scaled),
+        cached,
+        len(keys),
+    )
+    return result
+
+  def _key(self, ovr: dict[str, Any]) -> str:
+    angle = ovr.get('angle', None)
+    if not angle or str(angle) == '0':
+      angle = 0
+    keep_ratio = bool(ovr.get('keep_ratio'))
+    return (
+        f'{StorageService.file_digest(ovr["image"])}:'
+        f'{float(ovr.get("width") or -1)}x{float(ovr.get("height") or -1)}:'
+        f'{keep_ratio}:{float(angle)}'
+    )
+
+  def _scale(
+      self, pending: dict[str, dict[str, Any]], output_dir: str
+  ) -> dict[str, str]:
+    """Scales the given images, in parallel if there are several."""
+    jobs = {}
+    for key, ovr in pending.items():
+      (fd, output_path) = tempfile.mkstemp(
+          dir=output_dir, prefix='scaled_', suffix='.png'
+      )
+      os.close(fd)
+      jobs[key] = (
+          ovr['image'],
+          output_path,
+          ovr.get('width', '-1'),
+          ovr.get('height', '-1'),
+          bool(ovr.get('keep_ratio')),
+          ovr.get('angle', None),
+      )
+
+    results = {}
+    if self.processes > 0 and len(jobs) > 1:
+      pool = self._get_pool()
+      futures = {
+          key: pool.submit(scale_image_file, *args)
+          for key, args in jobs.items()
+      }
+      for key, future in futures.items():
+        try:
+          future.result()
+          results[key] = jobs[key][1]
+        except _SCALING_ERRORS as e:
+          logging.warning('Could not scale %s: %s', jobs[key][0], e)
+        except BrokenProcessPool as e:
+          # A worker died (e.g. out of memory), so the remaining images are
+          # left to ffmpeg and the next call starts a new pool.
+          logging.warning('Could not scale %s: %s', jobs[key][0], e)
+          self._reset_pool(pool)
+    else:
+      for key, args in jobs.items():
+        try:
+          scale_image_file(*args)
+          results[key] = args[1]
+        except _SCALING_ERRORS as e:
+          logging.warning('Could not scale %s: %s', args[0], e)
+
+    for key, output_path in results.items():
+      staging_path = self.cache.staging_path()
+      shutil.copyfile(output_path, staging_path)
+      if self.cache.put_file(key, staging_path) is None:
+        os.remove(staging_path)
+    return results
+
+  def _copy_from_cache(self, key: str, output_dir: str) -> Optional[str]:
+    (fd, output_path) = tempfile.mkstemp(
+        dir=output_dir, prefix='scaled_', suffix='.png'
+    )
+    os.close(fd)
+    if self.cache.copy_to(key, output_path):
+      return output_path
+    os.remove(output_path)
+    return None
+
+  def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+    with self._pool_lock:
+      if self._pool is None:
+        # Spawned rather than forked, see BackgroundRemover._get_pool.
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+      return self._pool
+
+  def _reset_pool(self, pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    with self._pool_lock:
+      if self._pool is pool:
+        self._pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _scaled_overlay(
+    ovr: dict[str, Any], scaled_path: str
+) -> dict[str, Any]:
+  """Points an overlay to its scaled image, keeping where it is shown."""
+  with Image.open(scaled_path) as scaled_image:
+    scaled_width, scaled_height = scaled_image.size
+  x, y = float(ovr['x']), float(ovr['y'])
+  width, height = ovr.get('width', '-1'), ovr.get('height', '-1')
+  # Images kept in ratio are centered in their box (see video_filter).
+  if ovr.get('keep_ratio') and float(width or 0) > 0 and float(height or 0) > 0:
+    x += (float(width) - scaled_width) / 2
+    y += (float(height) - scaled_height) / 2
+  return dict(
+      ovr,
+      image=scaled_path,
+      x=x,
+      y=y,
+      width=scaled_width,
+      height=scaled_height,
+      keep_ratio=False,
+      angle=None,
+  )
@@ -19,30 +19,83 @@ as the main entry point.
 """
 
 import base64
+import concurrent.futures
+import contextvars
+import copy
 import dataclasses
 import datetime
+import hashlib
 import imghdr
 import json
 import logging
-import mimetypes
 import os
 import pathlib
 import pyphen
 import shutil
-import subprocess
 import tempfile
-from typing import Optional, Sequence, Union
+import threading
+import time
+from typing import Any, Optional, Sequence, Union
 from urllib.parse import urlparse
 
+import background_removal as BackgroundService
 import config as ConfigService
 import functions_framework
+import image_fetcher as FetcherService
+import image_scaling as ScalingService
 import pva_video as VideoService
+import render_metrics as RenderMetricsService
 import requests
 import storage as StorageService
+import text_rendering as TextService
 from cloudevents.http import CloudEvent
 from google.cloud import logging as cloudlogging
 from PIL import Image
-from rembg import remove
+
+# Shared across invocations handled by the same instance.
+_LOGGING_CLIENT = None
+_LOGGING_CLIENT_LOCK = threading.Lock()
+# The time.monotonic() the message being handled must be done by, see
+# MESSAGE_DEADLINE_S.
+_MESSAGE_DEADLINE = contextvars.ContextVar('message_deadline', default=None)
+_ASSET_CACHE = StorageService.LocalFileCache(
+    ConfigService.ASSET_CACHE_DIR, ConfigService.ASSET_CACHE_MAX_BYTES
+)
+_FONT_METRICS = TextService.FontMetricsCache(
+    ConfigService.FONT_METRICS_SIDECAR_PATH
+)
+_TEXT_CACHE = TextService.RenderedTextCache(
+    StorageService.LocalFileCache(
+        ConfigService.TEXT_CACHE_DIR, ConfigService.TEXT_CACHE_MAX_BYTES
+    ),
+    ConfigService.GCS_BUCKET,
+    ConfigService.TEXT_CACHE_GCS_PREFIX,
+)
+_IMAGE_FETCHER = FetcherService.ImageFetcher(
+    StorageService.LocalFileCache(
+        ConfigService.HTTP_CACHE_DIR, ConfigService.HTTP_CACHE_MAX_BYTES
+    ),
+    max_bytes=ConfigService.HTTP_MAX_IMAGE_BYTES,
+    timeout=ConfigService.HTTP_TIMEOUT_S,
+    max_per_host=ConfigService.HTTP_MAX_CONNECTIONS_PER_HOST,
+    max_retries=ConfigService.HTTP_MAX_RETRIES,
+    backoff_factor=ConfigService.HTTP_BACKOFF_FACTOR,
+)
+_BACKGROUND_REMOVER = BackgroundService.BackgroundRemover(
+    StorageService.LocalFileCache(
+        ConfigService.REMBG_CACHE_DIR, ConfigService.REMBG_CACHE_MAX_BYTES
+    ),
+    ConfigService.REMBG_MODEL,
+    ConfigService.REMBG_PROCESSES,
+    ConfigService.REMBG_THREADS,
+)
+_IMAGE_PRESCALER = ScalingService.ImagePrescaler(
+    StorageService.LocalFileCache(
+        ConfigService.PRESCALE_CACHE_DIR,
+        ConfigService.PRESCALE_CACHE_MAX_BYTES,
+    ),
+    ConfigService.PRESCALE_PROCESSES,
+)
 
 
 class PvaLiteRenderMessagePlacement:
@@ -244,6 +297,13 @@ class PvaLiteRenderMessage:
         template_video: The template video for this render message.
         template_audio: The template audio for this render message.
         content: The content for this render message.
+        replace_output: Whether to replace an existing video at the output
+          path, e.g. when the row it was rendered for changed.
+        encoding_profile: The encoding profile to render with, or None for the
+          deployment's ENCODING_PROFILE.
+        row_hash: The orchestrator's hash of the config row, recorded on the
+          uploaded video so that later configs only skip the row once its
+          video was actually rendered.
       """
 
   output_path: str
@@ -251,6 +311,9 @@ class PvaLiteRenderMessage:
   template_video: str
   template_audio: Optional[str] = None
   content: Sequence[PvaLiteRenderMessageContent]
+  replace_output: bool = False
+  encoding_profile: Optional[str] = None
+  row_hash: Optional[str] = None
 
   def __init__(self, **kwargs):
     content_data = kwargs.pop('content', [])
@@ -268,33 +331,63 @@ class PvaLiteRenderMessage:
         f'ad_group={self.ad_group}, '
         f'template_video={self.template_video}, '
         f'template_audio={self.template_audio}, '
-        f'content={self.content})'
+        f'content={self.content}, '
+        f'replace_output={self.replace_output}, '
+        f'encoding_profile={self.encoding_profile}, '
+        f'row_hash={self.row_hash})'
+    )
+
+
+@dataclasses.dataclass(init=False)
+class PvaLiteRenderBatchMessage:
+  """Represents a batch of messages for rendering videos in PVA Lite.
+
+      All variants are rendered from the same template in one ffmpeg run.
+
+      Attributes:
+        variants: The messages to render, sharing template video and audio.
+      """
+
+  variants: Sequence[PvaLiteRenderMessage]
+
+  def __init__(self, **kwargs):
+    self.variants = [
+        PvaLiteRenderMessage(**v) for v in kwargs.get('variants', [])
+    ]
+
+  def __str__(self):
+    return (
+        'PvaLiteRenderBatchMessage('
+        f'variants=[{", ".join(str(v) for v in self.variants)}])'
     )
 
 
 def _get_text_dimensions(
-    output_dir: str, placement: PvaLiteRenderMessageTextPlacement
-) -> tuple[float, float, list[str]]:
+    output_dir: str,
+    placement: PvaLiteRenderMessageTextPlacement,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+) -> tuple[float, float, list[str], list[str], Optional[str]]:
   """Gets the dimensions of a text element.
 
+  Each wrapped line is rendered to the image that will be overlaid on the
+  video, so the measured width is exactly the width of what gets rendered.
+
   Args:
     output_dir: The directory to store temporary files.
     placement: The text placement object.
+    assets: Optional assets fetched by `_prefetch_assets`.
 
   Returns:
-    A tuple containing the width, height, and wrapped lines of the text element.
+    A tuple containing the width, height, wrapped lines, rendered line images
+    and font path of the text element.
   """
   # If the text is empty or just whitespace, return 0 dimensions.
   if not placement.text_value or not placement.text_value.strip():
-    return 0, 0, []
+    return 0, 0, [], [], None
 
   font_path = None
   if placement.text_font:
-    font_path = StorageService.download_gcs_file(
-        filepath=placement.text_font,
-        bucket_name=ConfigService.GCS_BUCKET,
-        output_dir=output_dir,
-    )
+    font_path = _fetch_gcs_asset(output_dir, placement.text_font, assets)
 
   # Wrap the text first to get the correct dimensions for multi-line text.
   wrapped_lines = _wrap_text(
@@ -302,69 +395,38 @@ def _get_text_dimensions(
       placement.text_width or 0,
       placement.hyphenation_language,
   )
-  multi_line_text = '\n'.join(wrapped_lines)
-
-  temp_image_name = VideoService.write_temp_image(
-      placement.text_color,
-      font_path,
-      str(placement.text_size),
-      multi_line_text,
-      placement.rotation_angle,
-      use_cropped_text_fix=True,
-  )
+
   # The height returned by measuring the actual text can be inconsistent.
   # We only reliably use the width from this measurement.
   width = 0
-  args = ['convert', temp_image_name, '-trim', '-format', '%w', 'info:']
-  try:
-    output = subprocess.check_output(args,
-                                     stderr=subprocess.STDOUT).decode('utf-8')
-    if output.strip():
-      # We use cropped_text_fix, so we need to divide by 4 to get correct width.
-      width = float(output.split()[0]) / 4.0
-  except (subprocess.CalledProcessError, IndexError, ValueError) as e:
-    logging.warning('Could not determine text width: %s', e)
-  finally:
-    os.remove(temp_image_name)
-
-  # To get a consistent and accurate height, we query ImageMagick for font
-  # metrics. This is more reliable than rendering text to an image and
-  # measuring it, which can include unwanted vertical padding (leading).
-  args_metric = [
-      'convert',
-      'xc:none',
-      '-font',
-      font_path,
-      '-pointsize',
-      str(placement.text_size),
-      '-debug',
-      'annotate',
-      'label:A',  # A simple character to trigger font metric calculation.
-      'null:',
-  ]
-  proc = subprocess.run(
-      args_metric, capture_output=True, text=True, check=False
-  )
-  stderr_output = proc.stderr
-
-  # Parse the stderr output to find ascender and descender.
-  ascender = None
-  descender = None
-  for line in stderr_output.splitlines():
-    line = line.strip()
-    if line.startswith('ascender:'):
-      try:
-        ascender = float(line.split(':')[1].strip())
-      except (ValueError, IndexError):
-        pass
-    elif line.startswith('descender:'):
-      try:
-        descender = float(line.split(':')[1].strip())
-      except (ValueError, IndexError):
-        pass
+  line_images = []
+  for line in wrapped_lines:
+    line_image = VideoService.write_temp_image(
+        placement.text_color,
+        font_path,
+        str(placement.text_size),
+        line or ' ',
+        placement.rotation_angle,
+        use_cropped_text_fix=True,
+        text_renderer=ConfigService.TEXT_RENDERER,
+        text_cache=_TEXT_CACHE,
+        supersampling=ConfigService.TEXT_SUPERSAMPLING,
+        output_dir=output_dir,
+    )
+    line_images.append(line_image)
+    # The image is already trimmed to the rendered pixels, supersampled.
+    with Image.open(line_image) as text_image:
+      width = max(
+          width, text_image.width / float(ConfigService.TEXT_SUPERSAMPLING)
+      )
 
-  if ascender is not None and descender is not None:
-    single_line_height = ascender - descender  # Descender is negative.
+  # To get a consistent and accurate height, we use the font metrics, which
+  # only depend on the font and size and are thus probed once per pair.
+  metrics = _FONT_METRICS.get_metrics(
+      font_path, placement.text_size, ConfigService.TEXT_RENDERER
+  )
+  if metrics is not None:
+    single_line_height = metrics.line_height
   else:
     # Fallback to a raw estimate if metrics can't be parsed.
     logging.warning('Could not parse font metrics. Falling back to text_size.')
@@ -379,7 +441,7 @@ def _get_text_dimensions(
   else:
     height = single_line_height
 
-  return width, height, wrapped_lines
+  return width, height, wrapped_lines, line_images, font_path
 
 
 @dataclasses.dataclass
@@ -392,6 +454,8 @@ class Element:
   absolute_x: Optional[float] = None
   absolute_y: Optional[float] = None
   wrapped_text: Optional[list[str]] = None
+  text_images: Optional[list[str]] = None
+  font_path: Optional[str] = None
 
 
 def _calculate_absolute_positions(
@@ -500,37 +564,172 @@ def subscribe(cloud_event: CloudEvent):
         cloud_event: The Pub/Sub message.
       """
 
-  lg_client = cloudlogging.Client()
-  lg_client.setup_logging()
+  setup_logging()
 
   logging.info('BEGIN - Processing Pub/Sub message... %r', cloud_event)
+  process_message(base64.b64decode(cloud_event.data['message']['data']))
+  logging.info('END - Finished processing Pub/Sub message')
+
+
+def setup_logging() -> None:
+  """Sends logs to Cloud Logging, setting up its client once per instance."""
+  global _LOGGING_CLIENT
+  with _LOGGING_CLIENT_LOCK:
+    if _LOGGING_CLIENT is None:
+      _LOGGING_CLIENT = cloudlogging.Client()
+      _LOGGING_CLIENT.setup_logging()
+
 
-  received_message = base64.b64decode(cloud_event.data['message']['data']
-                                     ).decode('utf-8')
-  received_message_json = json.loads(received_message)
-  logging.info('Received message: %s', received_message_json)
-  msg = PvaLiteRenderMessage(**received_message_json)
-  logging.info('Parsed message: %s', msg)
-  output_video_path = generate_video(msg)
-  _, video_ext = os.path.splitext(msg.template_video)
-  gcs_folder = f'{msg.output_path}/' if msg.output_path != '.' else ''
-  gcs_path = f'{gcs_folder}{msg.ad_group}{video_ext}'
-
-  StorageService.upload_gcs_file(
-      output_video_path, gcs_path, ConfigService.GCS_BUCKET
+def process_message(data: bytes) -> list[str]:
+  """Renders the videos of a render message and uploads them.
+
+  The time spent in each stage is logged as a single record once done.
+
+  Args:
+    data: The JSON message, a single or a batch message.
+
+  Returns:
+    The GCS paths of the videos of the message.
+  """
+  # Times each stage of the render, logged as one record for the message.
+  metrics = RenderMetricsService.RenderMetrics(
+      RenderMetricsService.get_tracer()
+      if ConfigService.RENDER_TRACING
+      else None
+  )
+  output_paths = []
+  status = 'error'
+  deadline_token = _MESSAGE_DEADLINE.set(
+      time.monotonic() + ConfigService.MESSAGE_DEADLINE_S
+      if ConfigService.MESSAGE_DEADLINE_S
+      else None
   )
+  try:
+    with RenderMetricsService.recording(metrics), metrics.span('message'):
+      output_paths = _handle_message(data)
+    status = 'ok'
+  finally:
+    _MESSAGE_DEADLINE.reset(deadline_token)
+    metrics.log('Render metrics', status=status, output_paths=output_paths)
+    RenderMetricsService.flush_spans()
+  return output_paths
+
+
+def _handle_message(data: bytes) -> list[str]:
+  """Renders the videos of a render message and uploads them."""
+  with RenderMetricsService.span('parse'):
+    received_message = data.decode('utf-8')
+    received_message_json = json.loads(received_message)
+    logging.info('Received message: %s', received_message_json)
+    if 'variants' in received_message_json:
+      batch = PvaLiteRenderBatchMessage(**received_message_json)
+      logging.info('Parsed batch message: %s', batch)
+      _validate_batch(batch)
+      messages = batch.variants
+    else:
+      msg = PvaLiteRenderMessage(**received_message_json)
+      logging.info('Parsed message: %s', msg)
+      messages = [msg]
+
+  # Removed once uploaded, so long-lived workers don't fill their disk.
+  with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as output_dir:
+    with RenderMetricsService.span('download') as span:
+      assets = _prefetch_assets(messages, output_dir)
+      span.set('files', len(assets))
+
+    # Skips rendering videos identical to ones that were already rendered.
+    pending = []
+    with RenderMetricsService.span('dedup') as span:
+      for msg in messages:
+        render_hash = _render_hash(msg, assets)
+        if not (render_hash and _reuse_render(msg, render_hash)):
+          pending.append((msg, render_hash))
+      span.set('reused', len(messages) - len(pending))
+
+    output_video_paths = []
+    if pending:
+      with RenderMetricsService.span('render', variants=len(pending)):
+        output_video_paths = _generate_videos(
+            [msg for msg, _ in pending], output_dir, assets
+        )
+    for (msg, render_hash), output_video_path in zip(
+        pending, output_video_paths
+    ):
+      gcs_path = _output_gcs_path(msg)
+      StorageService.upload_gcs_file(
+          output_video_path,
+          gcs_path,
+          ConfigService.GCS_BUCKET,
+          overwrite=msg.replace_output,
+          metadata=_output_metadata(msg, render_hash),
+      )
+      if render_hash:
+        StorageService.upload_gcs_contents(
+            gcs_path, _render_index_path(render_hash), ConfigService.GCS_BUCKET
+        )
 
-  logging.info('END - Finished processing Pub/Sub message')
+  logging.info('Asset cache stats: %s', _ASSET_CACHE.stats())
+  logging.info('Text cache stats: %s', _TEXT_CACHE.local_cache.stats())
+  logging.info('Image cache stats: %s', _IMAGE_FETCHER.cache.stats())
+  return [_output_gcs_path(msg) for msg in messages]
 
 
 def generate_video(message: PvaLiteRenderMessage):
-  output_dir = tempfile.mkdtemp()
+  return _generate_videos([message])[0]
+
+
+def generate_video_batch(batch: PvaLiteRenderBatchMessage) -> list[str]:
+  """Renders all variants of a batch message, returning their paths."""
+  _validate_batch(batch)
+  if not batch.variants:
+    return []
+  return _generate_videos(batch.variants)
+
+
+def _validate_batch(batch: PvaLiteRenderBatchMessage) -> None:
+  """Checks that all variants of a batch share the same template."""
+  if not batch.variants:
+    return
+  first = batch.variants[0]
+  for variant in batch.variants:
+    if (variant.template_video, variant.template_audio) != (
+        first.template_video,
+        first.template_audio,
+    ):
+      raise ValueError(
+          'All variants of a batch must share the same template, but'
+          f' "{variant.ad_group}" uses {variant.template_video} and'
+          f' {variant.template_audio} instead of {first.template_video} and'
+          f' {first.template_audio}.'
+      )
+
+
+def _generate_videos(
+    messages: Sequence[PvaLiteRenderMessage],
+    output_dir: Optional[str] = None,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+) -> list[str]:
+  """Renders messages sharing the same template, returning their paths.
+
+  Args:
+    messages: The messages to render.
+    output_dir: The directory to store temporary files, a new one if None.
+    assets: Assets already fetched by `_prefetch_assets` for these messages,
+      or None to fetch them.
+
+  Returns:
+    The paths of the rendered videos.
+  """
+  message = messages[0]
+  if output_dir is None:
+    output_dir = tempfile.mkdtemp()
   # No need to create ad_group subdir if output_video_path includes it
   # os.mkdir(f'{output_dir}/{message.ad_group}')
-  input_video_path = StorageService.download_gcs_file(
-      filepath=message.template_video,
-      bucket_name=ConfigService.GCS_BUCKET,
-      output_dir=output_dir,
+  if assets is None:
+    assets = _prefetch_assets(messages, output_dir)
+  _remove_backgrounds(messages, assets)
+  input_video_path = _fetch_gcs_asset(
+      output_dir, message.template_video, assets
   )
   if not input_video_path:
     raise ValueError(
@@ -540,35 +739,821 @@ def generate_video(message: PvaLiteRenderMessage):
 
   input_audio_path = None
   if message.template_audio:
-    input_audio_path = StorageService.download_gcs_file(
-        filepath=message.template_audio,
-        bucket_name=ConfigService.GCS_BUCKET,
-        output_dir=output_dir,
+    input_audio_path = _fetch_gcs_asset(
+        output_dir, message.template_audio, assets
     )
 
   # Ensure the parent directory exists for the output path
   output_video_filename = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.mp4"
-  output_video_path = pathlib.Path(
-      output_dir, message.ad_group, output_video_filename
-  )
-  output_video_path.parent.mkdir(parents=True, exist_ok=True)
+  output_video_paths = []
+  for index, variant in enumerate(messages):
+    # Variants of a batch get their own folder, in case ad groups repeat.
+    variant_dir = str(index) if len(messages) > 1 else ''
+    output_video_path = pathlib.Path(
+        output_dir, variant_dir, variant.ad_group, output_video_filename
+    )
+    output_video_path.parent.mkdir(parents=True, exist_ok=True)
+    output_video_paths.append(str(output_video_path))
 
-  return process_video(
-      message.content,
+  return process_video_batch(
+      [variant.content for variant in messages],
       output_dir,
       input_video_path,
-      str(output_video_path),
+      output_video_paths,
       input_audio_path,
+      assets,
+      [variant.encoding_profile for variant in messages],
   )
 
 
+def _output_gcs_path(message: PvaLiteRenderMessage) -> str:
+  """Returns the path in GCS_BUCKET to upload a message's video to."""
+  _, video_ext = os.path.splitext(message.template_video)
+  gcs_folder = f'{message.output_path}/' if message.output_path != '.' else ''
+  return f'{gcs_folder}{message.ad_group}{video_ext}'
+
+
+# Bump whenever rendering changes in a way that makes old renders stale.
+_RENDER_HASH_VERSION = 3
+
+
+def _render_hash(
+    message: PvaLiteRenderMessage,
+    assets: dict[tuple[str, str], Optional[str]],
+) -> Optional[str]:
+  """Computes a canonical hash of everything that determines a render.
+
+  This covers the template and audio generations, the contents of fonts and
+  images, all placements and the settings they are rendered with (including
+  the background removal model and the image size limit), but not where the
+  video is written to.
+
+  Args:
+    message: The message to hash.
+    assets: The assets fetched by `_prefetch_assets` for the message.
+
+  Returns:
+    The hex digest, or None if rendering deduplication is disabled or the
+    message can't be hashed (e.g. an asset is missing).
+  """
+  if not ConfigService.RENDER_DEDUP:
+    return None
+
+  def asset_digest(kind: str, ref: Optional[str]) -> Optional[str]:
+    path = assets.get((kind, ref)) if ref else None
+    return StorageService.file_digest(path) if path else None
+
+  content = []
+  removes_backgrounds = False
+  for placement_content in message.content:
+    placements = []
+    for placement in placement_content.placements:
+      fields = {
+          f.name: getattr(placement, f.name, None)
+          for f in dataclasses.fields(placement)
+      }
+      if isinstance(placement, PvaLiteRenderMessageImagePlacement):
+        fields['image_url'] = asset_digest(_ASSET_URL, placement.image_url)
+        if not fields['image_url']:
+          return None
+        removes_backgrounds |= placement.remove_background == 'Yes'
+      elif placement.text_font:
+        fields['text_font'] = asset_digest(_ASSET_GCS, placement.text_font)
+      placements.append(fields)
+    content.append({
+        'offset_s': placement_content.offset_s,
+        'duration_s': placement_content.duration_s,
+        'placements': placements,
+    })
+
+  template_generation = StorageService.get_gcs_file_generation(
+      message.template_video, ConfigService.GCS_BUCKET
+  )
+  if template_generation is None:
+    return None
+  audio_generation = None
+  if message.template_audio:
+    audio_generation = StorageService.get_gcs_file_generation(
+        message.template_audio, ConfigService.GCS_BUCKET
+    )
+
+  canonical = json.dumps(
+      {
+          'version': _RENDER_HASH_VERSION,
+          'text_renderer': ConfigService.TEXT_RENDERER,
+          'text_supersampling': ConfigService.TEXT_SUPERSAMPLING,
+          'encoding_profile': (
+              message.encoding_profile or ConfigService.ENCODING_PROFILE
+          ),
+          'audio_passthrough': ConfigService.AUDIO_PASSTHROUGH,
+          'precompose_layers': ConfigService.PRECOMPOSE_LAYERS,
+          'smart_render': ConfigService.SMART_RENDER,
+          'parallel_chunks': ConfigService.PARALLEL_CHUNKS,
+          'rembg_model': (
+              ConfigService.REMBG_MODEL if removes_backgrounds else None
+          ),
+          'http_max_image_bytes': ConfigService.HTTP_MAX_IMAGE_BYTES,
+          'template_video': [message.template_video, template_generation],
+          'template_audio': [message.template_audio, audio_generation],
+          'content': content,
+      },
+      sort_keys=True,
+      default=str,
+  )
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _output_metadata(
+    message: PvaLiteRenderMessage, render_hash: Optional[str]
+) -> Optional[dict[str, str]]:
+  """Returns the custom metadata to record on a message's video."""
+  metadata = {}
+  if render_hash:
+    metadata['render_hash'] = render_hash
+  if message.row_hash:
+    metadata['row_hash'] = message.row_hash
+  return metadata or None
+
+
+def _render_index_path(render_hash: str) -> str:
+  return f'{ConfigService.RENDER_INDEX_PREFIX}/{render_hash}'
+
+
+def _reuse_render(message: PvaLiteRenderMessage, render_hash: str) -> bool:
+  """Copies an earlier render with the same hash to the message's output.
+
+  Args:
+    message: The message to find an earlier render for.
+    render_hash: The message's render hash.
+
+  Returns:
+    Whether an earlier render was found and copied.
+  """
+  earlier_path = StorageService.download_gcs_file(
+      filepath=_render_index_path(render_hash),
+      bucket_name=ConfigService.GCS_BUCKET,
+      fetch_contents=True,
+  )
+  if not earlier_path:
+    return False
+  earlier_path = earlier_path.decode('utf-8')
+  # The output is only reused if it still holds the indexed render.
+  reused = StorageService.copy_gcs_file(
+      earlier_path,
+      _output_gcs_path(message),
+      ConfigService.GCS_BUCKET,
+      overwrite=message.replace_output,
+      metadata_match={'render_hash': render_hash},
+      metadata=_output_metadata(message, render_hash),
+  )
+  if reused:
+    logging.info(
+        'Reused render of "%s" from "%s".', message.ad_group, earlier_path
+    )
+  return reused
+
+
+_ASSET_GCS = 'gcs'
+_ASSET_URL = 'url'
+_ASSET_CUTOUT = 'cutout'
+
+
+def _prefetch_assets(
+    messages: Sequence[PvaLiteRenderMessage], output_dir: str
+) -> dict[tuple[str, str], Optional[str]]:
+  """Downloads all assets referenced by messages concurrently.
+
+  References are deduplicated, so an asset used by several placements is only
+  fetched once.
+
+  Args:
+    messages: The messages to fetch assets for.
+    output_dir: The directory to store the assets in.
+
+  Returns:
+    A dictionary of local paths (or None for missing GCS files), keyed by
+    (_ASSET_GCS, path in GCS_BUCKET) or (_ASSET_URL, image URL).
+  """
+  gcs_paths = set()
+  image_urls = set()
+  for message in messages:
+    gcs_paths.add(message.template_video)
+    if message.template_audio:
+      gcs_paths.add(message.template_audio)
+  for content in (c for message in messages for c in message.content):
+    for placement in content.placements:
+      if isinstance(placement, PvaLiteRenderMessageImagePlacement):
+        if placement.image_url:
+          image_urls.add(placement.image_url)
+      elif placement.text_font and (placement.text_value or '').strip():
+        gcs_paths.add(placement.text_font)
+
+  logging.info(
+      'Prefetching %d GCS files and %d images...',
+      len(gcs_paths),
+      len(image_urls),
+  )
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=ConfigService.PREFETCH_WORKERS
+  ) as executor:
+    downloads = {}
+    for path in gcs_paths:
+      downloads[(_ASSET_GCS, path)] = executor.submit(
+          RenderMetricsService.in_context(StorageService.download_gcs_file),
+          filepath=path,
+          bucket_name=ConfigService.GCS_BUCKET,
+          output_dir=output_dir,
+          cache=_ASSET_CACHE,
+      )
+    for url in image_urls:
+      downloads[(_ASSET_URL, url)] = executor.submit(
+          RenderMetricsService.in_context(_download_image_to_file),
+          output_dir,
+          url,
+      )
+    return {key: download.result() for key, download in downloads.items()}
+
+
+def _remove_backgrounds(
+    messages: Sequence[PvaLiteRenderMessage],
+    assets: dict[tuple[str, str], Optional[str]],
+) -> None:
+  """Removes the backgrounds of all prefetched images that need it.
+
+  Each distinct image is processed once, concurrently when background removal
+  runs in a process pool. Results are added to `assets` under
+  (_ASSET_CUTOUT, image URL).
+
+  Args:
+    messages: The messages to remove image backgrounds for.
+    assets: The assets fetched by `_prefetch_assets`.
+  """
+  image_urls = {
+      placement.image_url
+      for message in messages
+      for content in message.content
+      for placement in content.placements
+      if isinstance(placement, PvaLiteRenderMessageImagePlacement)
+      and placement.remove_background == 'Yes'
+      and assets.get((_ASSET_URL, placement.image_url))
+      and (_ASSET_CUTOUT, placement.image_url) not in assets
+  }
+  if not image_urls:
+    return
+
+  logging.info('Removing background from %d images...', len(image_urls))
+  with RenderMetricsService.span(
+      'remove_backgrounds', images=len(image_urls)
+  ), concurrent.futures.ThreadPoolExecutor(
+      max_workers=max(1, ConfigService.REMBG_PROCESSES)
+  ) as executor:
+    removals = {
+        url: executor.submit(remove_background, assets[(_ASSET_URL, url)])
+        for url in image_urls
+    }
+    for url, removal in removals.items():
+      assets[(_ASSET_CUTOUT, url)] = removal.result()
+
+
+def _fetch_gcs_asset(
+    output_dir: str,
+    filepath: str,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+) -> Optional[str]:
+  """Returns the local path of a GCS file, downloading it if not prefetched."""
+  if assets and (_ASSET_GCS, filepath) in assets:
+    return assets[(_ASSET_GCS, filepath)]
+  return StorageService.download_gcs_file(
+      filepath=filepath,
+      bucket_name=ConfigService.GCS_BUCKET,
+      output_dir=output_dir,
+      cache=_ASSET_CACHE,
+  )
+
+
+def _fetch_image_asset(
+    output_dir: str,
+    url: str,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+) -> str:
+  """Returns the local path of an image, downloading it if not prefetched."""
+  if assets and (_ASSET_URL, url) in assets:
+    return assets[(_ASSET_URL, url)]
+  return _download_image_to_file(output_dir, url)
+
+
 def process_video(
     content: Sequence[PvaLiteRenderMessageContent],
     output_dir: str,
     input_video_path: str,
     output_video_path: str,
     input_audio_path: Optional[str] = None,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+    encoding_profile: Optional[str] = None,
 ):
+  return process_video_batch(
+      [content],
+      output_dir,
+      input_video_path,
+      [output_video_path],
+      input_audio_path,
+      assets,
+      [encoding_profile],
+  )[0]
+
+
+def process_video_batch(
+    contents: Sequence[Sequence[PvaLiteRenderMessageContent]],
+    output_dir: str,
+    input_video_path: str,
+    output_video_paths: Sequence[str],
+    input_audio_path: Optional[str] = None,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+    encoding_profiles: Optional[Sequence[Optional[str]]] = None,
+) -> Sequence[str]:
+  """Renders several variants of the same template.
+
+  Variants are rendered RENDER_MAX_BATCH_SIZE at a time, each chunk in a single
+  ffmpeg run that decodes the template once and splits it into one overlay
+  chain per variant.
+
+  Args:
+    contents: The content of each variant.
+    output_dir: The directory to store temporary files.
+    input_video_path: The template video.
+    output_video_paths: The output video of each variant.
+    input_audio_path: Optional audio to use instead of the template's.
+    assets: Optional assets fetched by `_prefetch_assets`.
+    encoding_profiles: Optional encoding profile of each variant, None for
+      the deployment's ENCODING_PROFILE.
+
+  Returns:
+    The output video paths.
+  """
+  encoding_profiles = [
+      profile or ConfigService.ENCODING_PROFILE
+      for profile in encoding_profiles or [None] * len(contents)
+  ]
+  # The audio is mapped to the outputs unfiltered, so it can be copied as-is
+  # if the output container supports its codec.
+  audio_codec = None
+  if ConfigService.AUDIO_PASSTHROUGH:
+    audio_codec = VideoService.probe_audio_codec(
+        input_audio_path or input_video_path
+    )
+  video_stream = None
+  if ConfigService.SMART_RENDER or ConfigService.PARALLEL_CHUNKS != 1:
+    video_stream = VideoService.probe_video_stream(input_video_path)
+  batch_size = max(1, ConfigService.RENDER_MAX_BATCH_SIZE)
+  for start in range(0, len(contents), batch_size):
+    chunk = (
+        contents[start:start + batch_size],
+        output_dir,
+        input_video_path,
+        output_video_paths[start:start + batch_size],
+        input_audio_path,
+        assets,
+        encoding_profiles[start:start + batch_size],
+        audio_codec,
+    )
+    if video_stream:
+      if ConfigService.SMART_RENDER and _smart_render_variants(
+          *chunk, video_stream
+      ):
+        continue
+      if ConfigService.PARALLEL_CHUNKS != 1 and _chunked_render_variants(
+          *chunk, video_stream
+      ):
+        continue
+    _render_variants(*chunk)
+  return output_video_paths
+
+
+def _smart_render_variants(
+    contents: Sequence[Sequence[PvaLiteRenderMessageContent]],
+    output_dir: str,
+    input_video_path: str,
+    output_video_paths: Sequence[str],
+    input_audio_path: Optional[str],
+    assets: Optional[dict[tuple[str, str], Optional[str]]],
+    encoding_profiles: Sequence[str],
+    audio_codec: Optional[str],
+    video_stream: dict[str, Any],
+) -> bool:
+  """Renders variants, only re-encoding the template where overlays are shown.
+
+  The template is split at keyframes: ranges showing any variant's overlays
+  are rendered like `_render_variants` does, the others are stream-copied,
+  and each variant's ranges are then concatenated with the audio.
+
+  Args:
+    video_stream: The template's video stream, from
+      `VideoService.probe_video_stream`.
+    See `_render_variants` for the other arguments.
+
+  Returns:
+    Whether the variants were rendered, False if the template can't be split
+    (e.g. it is not H.264, overlays cover most of it or the rendered ranges
+    can't be encoded with the template's parameters) and must be rendered in
+    full instead.
+  """
+  # Rendered ranges are encoded with the template's profile, level and
+  # reference frames, as copied and rendered ranges end up sharing a single
+  # decoder setup in the output.
+  matching_args = VideoService.matching_video_args(video_stream)
+  if matching_args is None or any(
+      not VideoService.encoding_args(profile, path)
+      for profile, path in zip(encoding_profiles, output_video_paths)
+  ):
+    return False
+  windows = [
+      (placement_content.offset_s,
+       placement_content.offset_s + placement_content.duration_s)
+      for content in contents
+      for placement_content in content
+  ]
+  segments = VideoService.plan_segments(
+      windows,
+      video_stream['keyframes'],
+      video_stream['duration'],
+      ConfigService.SMART_RENDER_MIN_COPY_S,
+  )
+  if not segments:
+    return False
+  logging.info('Smart rendering segments: %s', segments)
+
+  segments_dir = tempfile.mkdtemp(dir=output_dir, prefix='segments_')
+  variant_segments = [[] for _ in contents]
+  rendered_paths = []
+  # Renders first, so nothing is copied if the template can't be matched.
+  for index, (start, end, render) in enumerate(segments):
+    if not render:
+      continue
+    segment_paths = [
+        os.path.join(segments_dir, f'{index}_{variant}.ts')
+        for variant in range(len(contents))
+    ]
+    _render_variants(
+        _shift_contents(contents, start, end),
+        output_dir,
+        input_video_path,
+        segment_paths,
+        assets=assets,
+        encoding_profiles=encoding_profiles,
+        segment=(start, end, video_stream['pix_fmt']),
+        segment_args=matching_args,
+    )
+    rendered_paths += segment_paths
+  for segment_path in rendered_paths:
+    rendered_stream = VideoService.probe_video_stream(
+        segment_path, keyframes=False
+    )
+    if not rendered_stream or not VideoService.same_stream_parameters(
+        video_stream, rendered_stream
+    ):
+      logging.warning(
+          'Rendered segment %s does not match the stream parameters of the'
+          ' template, rendering in full instead.',
+          segment_path,
+      )
+      shutil.rmtree(segments_dir, ignore_errors=True)
+      return False
+
+  for index, (start, end, render) in enumerate(segments):
+    if render:
+      for variant, paths in enumerate(variant_segments):
+        paths.append(os.path.join(segments_dir, f'{index}_{variant}.ts'))
+      continue
+    segment_path = os.path.join(segments_dir, f'{index}.ts')
+    VideoService.copy_segment(
+        input_video_path, start, end, segment_path, **_ffmpeg_limits()
+    )
+    for paths in variant_segments:
+      paths.append(segment_path)
+
+  _concat_variant_segments(
+      variant_segments,
+      input_video_path,
+      output_video_paths,
+      input_audio_path,
+      encoding_profiles,
+      audio_codec,
+  )
+  return True
+
+
+def _chunked_render_variants(
+    contents: Sequence[Sequence[PvaLiteRenderMessageContent]],
+    output_dir: str,
+    input_video_path: str,
+    output_video_paths: Sequence[str],
+    input_audio_path: Optional[str],
+    assets: Optional[dict[tuple[str, str], Optional[str]]],
+    encoding_profiles: Sequence[str],
+    audio_codec: Optional[str],
+    video_stream: dict[str, Any],
+) -> bool:
+  """Renders variants as chunks of the timeline encoded in parallel.
+
+  Each chunk only gets the overlays shown in it, and chunks are rendered by
+  concurrent ffmpeg runs (which individually can't keep many cores busy with
+  a heavy filter graph), then concatenated without re-encoding.
+
+  Args:
+    video_stream: The template's video stream, from
+      `VideoService.probe_video_stream`.
+    See `_render_variants` for the other arguments.
+
+  Returns:
+    Whether the variants were rendered, False if the template is too short
+    to be split and must be rendered in a single run instead.
+  """
+  cores = _available_cores()
+  count = ConfigService.PARALLEL_CHUNKS or cores
+  count = min(
+      count,
+      int(video_stream['duration'] // ConfigService.PARALLEL_CHUNK_MIN_S),
+  )
+  if count < 2 or any(
+      not VideoService.encoding_args(profile, path)
+      for profile, path in zip(encoding_profiles, output_video_paths)
+  ):
+    return False
+  chunks = VideoService.plan_chunks(
+      video_stream['duration'], count, video_stream['frame_rate']
+  )
+  logging.info('Rendering in %d parallel chunks: %s', len(chunks), chunks)
+
+  # Laying out is done up front, only the ffmpeg runs are parallel.
+  segments_dir = tempfile.mkdtemp(dir=output_dir, prefix='chunks_')
+  variant_segments = [[] for _ in contents]
+  jobs = []
+  for index, (start, end) in enumerate(chunks):
+    segment_paths = [
+        os.path.join(segments_dir, f'{index}_{variant}.ts')
+        for variant in range(len(contents))
+    ]
+    jobs.append(
+        _build_render_job(
+            _shift_contents(contents, start, end),
+            output_dir,
+            input_video_path,
+            segment_paths,
+            assets=assets,
+            encoding_profiles=encoding_profiles,
+            segment=(start, end, video_stream['pix_fmt']),
+            segment_args=['-threads', max(1, cores // len(chunks))],
+        )
+    )
+    for paths, segment_path in zip(variant_segments, segment_paths):
+      paths.append(segment_path)
+
+  with concurrent.futures.ThreadPoolExecutor(len(jobs)) as executor:
+    runs = [
+        executor.submit(
+            RenderMetricsService.in_context(VideoService.run_ffmpeg_batch),
+            **dict(job, **_ffmpeg_limits()),
+        )
+        for job in jobs
+    ]
+    for run in runs:
+      logging.debug('ffmpeg ran with output %s:', run.result())
+
+  _concat_variant_segments(
+      variant_segments,
+      input_video_path,
+      output_video_paths,
+      input_audio_path,
+      encoding_profiles,
+      audio_codec,
+  )
+  return True
+
+
+def _available_cores() -> int:
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+
+def _shift_contents(
+    contents: Sequence[Sequence[PvaLiteRenderMessageContent]],
+    start: float,
+    end: float,
+) -> list[list[PvaLiteRenderMessageContent]]:
+  """Keeps the content shown in a range, shifted to the range's timeline.
+
+  Content starting before the range keeps its (now negative) offset, so its
+  fades stay where they were.
+  """
+  shifted_contents = []
+  for content in contents:
+    shifted_content = []
+    for placement_content in content:
+      content_end = placement_content.offset_s + placement_content.duration_s
+      if placement_content.offset_s < end and content_end >= start:
+        placement_content = copy.copy(placement_content)
+        placement_content.offset_s -= start
+        shifted_content.append(placement_content)
+    shifted_contents.append(shifted_content)
+  return shifted_contents
+
+
+def _concat_variant_segments(
+    variant_segments: Sequence[Sequence[str]],
+    input_video_path: str,
+    output_video_paths: Sequence[str],
+    input_audio_path: Optional[str],
+    encoding_profiles: Sequence[str],
+    audio_codec: Optional[str],
+) -> None:
+  """Concatenates each variant's segments, adding the template's audio."""
+  for paths, output_video_path, profile in zip(
+      variant_segments, output_video_paths, encoding_profiles
+  ):
+    VideoService.concat_segments(
+        paths,
+        input_audio_path or input_video_path,
+        '1:a' if input_audio_path else '1:a?',
+        output_video_path,
+        VideoService.audio_encoding_args(
+            profile, output_video_path, audio_codec
+        ),
+        **_ffmpeg_limits(),
+    )
+
+
+def _ffmpeg_limits() -> dict[str, Optional[float]]:
+  """Returns the limits ffmpeg runs are stopped at, see `execute_ffmpeg`.
+
+  Each run gets at most what is left of the message's deadline, so call this
+  right before starting it.
+
+  Raises:
+    TimeoutError: If the message is already past its deadline.
+  """
+  timeout_s = ConfigService.FFMPEG_TIMEOUT_S or None
+  deadline = _MESSAGE_DEADLINE.get()
+  if deadline is not None:
+    remaining_s = deadline - time.monotonic()
+    if remaining_s <= 0:
+      raise TimeoutError(
+          'The message ran past its deadline of'
+          f' {ConfigService.MESSAGE_DEADLINE_S}s.'
+      )
+    timeout_s = min(timeout_s or remaining_s, remaining_s)
+  return {
+      'timeout_s': timeout_s,
+      'stall_timeout_s': ConfigService.FFMPEG_STALL_TIMEOUT_S or None,
+  }
+
+
+def _render_variants(*args, **kwargs) -> None:
+  """Renders variants of the same template in a single ffmpeg run.
+
+  See `_build_render_job` for the arguments.
+  """
+  ffmpeg_output = VideoService.run_ffmpeg_batch(
+      **_build_render_job(*args, **kwargs)
+  )
+  logging.debug('ffmpeg ran with output %s:', ffmpeg_output)
+
+
+def _build_render_job(
+    contents: Sequence[Sequence[PvaLiteRenderMessageContent]],
+    output_dir: str,
+    input_video_path: str,
+    output_video_paths: Sequence[str],
+    input_audio_path: Optional[str] = None,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+    encoding_profiles: Optional[Sequence[str]] = None,
+    audio_codec: Optional[str] = None,
+    segment: Optional[tuple[float, float, Optional[str]]] = None,
+    segment_args: Optional[list[str]] = None,
+) -> dict[str, Any]:
+  """Lays out variants of the same template and builds their ffmpeg run.
+
+  Args:
+    segment: Optional (start, end, pixel format) of a range of the template to
+      render as video-only MPEG-TS segments (see `_smart_render_variants`),
+      instead of rendering it in full.
+    segment_args: Optional extra output arguments for the segments.
+    See `process_video_batch` for the other arguments.
+
+  Returns:
+    The keyword arguments to run the job with `VideoService.run_ffmpeg_batch`.
+  """
+  filter_complex = []
+  if len(contents) > 1:
+    split, base_streams = VideoService.split_filter(len(contents))
+    filter_complex.append(split)
+  else:
+    base_streams = ['0:v']
+
+  overlay_args = []
+  video_outputs = []
+  num_assets = 0
+  for index, content in enumerate(contents):
+    with RenderMetricsService.span(
+        'layout', placements=sum(len(c.placements) for c in content)
+    ):
+      image_or_videos_overlays, text_overlays = _layout_overlays(
+          content, output_dir, assets
+      )
+    with RenderMetricsService.span(
+        'prescale', overlays=len(image_or_videos_overlays)
+    ):
+      image_or_videos_overlays = _IMAGE_PRESCALER.prescale(
+          image_or_videos_overlays, output_dir
+      )
+    with RenderMetricsService.span('filter_graph') as span:
+      if ConfigService.PRECOMPOSE_LAYERS:
+        image_or_videos_overlays, text_overlays = (
+            VideoService.precompose_layers(
+                image_or_videos_overlays, text_overlays, output_dir
+            )
+        )
+      (img_overlays, text_imgs, out_video
+      ) = VideoService.filter_strings(
+          image_or_videos_overlays,
+          text_overlays,
+          ConfigService.TEXT_RENDERER,
+          _TEXT_CACHE,
+          input_offset=num_assets,
+          base_stream=base_streams[index],
+          stream_prefix=f'v{index}' if len(contents) > 1 else '',
+          input_label='src%d',
+          output_dir=output_dir,
+      )
+      span.set('overlays', len(image_or_videos_overlays) + len(text_imgs))
+    overlay_args += VideoService.overlay_inputs(
+        image_or_videos_overlays, text_imgs
+    )
+    num_assets += len(image_or_videos_overlays) + len(text_imgs)
+    filter_complex += img_overlays
+    video_outputs.append(out_video)
+
+  # Each distinct image is input once and split between its overlays.
+  assets_args, input_filters = VideoService.share_inputs(
+      overlay_args, label='src%d'
+  )
+  filter_complex = input_filters + filter_complex
+  logging.info(
+      'Sharing %d inputs between %d overlays.', len(input_filters), num_assets
+  )
+
+  # forces input audio to output
+  if segment:
+    out_audio = None
+  elif input_audio_path:
+    audio_index = len(input_filters) + 1
+    out_audio = f'{audio_index}:a'
+    assets_args += ['-i', input_audio_path]
+  else:
+    out_audio = '0:a?'
+
+  # Group all args and runs ffmpeg
+  if encoding_profiles is None:
+    encoding_profiles = [ConfigService.ENCODING_PROFILE] * len(contents)
+  input_video_args = None
+  if segment:
+    start, end, pix_fmt = segment
+    input_video_args = ['-ss', start, '-t', end - start]
+    output_args = [
+        VideoService.video_encoding_args(profile, pix_fmt)
+        + (segment_args or [])
+        + ['-f', 'mpegts']
+        for profile in encoding_profiles
+    ]
+  else:
+    output_args = [
+        VideoService.encoding_args(profile, output_video_path, audio_codec)
+        for output_video_path, profile in zip(
+            output_video_paths, encoding_profiles
+        )
+    ]
+  return {
+      'outputs': [
+          (out_video, out_audio, output_video_path, args)
+          for out_video, output_video_path, args in zip(
+              video_outputs, output_video_paths, output_args
+          )
+      ],
+      'assets_args': assets_args,
+      'filters': filter_complex,
+      'input_video': input_video_path,
+      'input_video_args': input_video_args,
+      **_ffmpeg_limits(),
+  }
+
+
+def _layout_overlays(
+    content: Sequence[PvaLiteRenderMessageContent],
+    output_dir: str,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+  """Lays out the placements of a video, returning its image and text overlays."""
   image_or_videos_overlays = []
   text_overlays = []
 
@@ -587,15 +1572,19 @@ def process_video(
         width = placement.image_width
         height = placement.image_height
         wrapped_lines = None
+        line_images = None
+        font_path = None
       else:
-        width, height, wrapped_lines = _get_text_dimensions(
-            output_dir, placement
+        width, height, wrapped_lines, line_images, font_path = (
+            _get_text_dimensions(output_dir, placement, assets)
         )
       elements[placement.element_id] = Element(
           width=width,
           height=height,
           placement=placement,
           wrapped_text=wrapped_lines,
+          text_images=line_images,
+          font_path=font_path,
       )
 
     elements = _calculate_absolute_positions(elements)
@@ -611,6 +1600,7 @@ def process_video(
                 offset,
                 duration,
                 element,
+                assets,
             )
         )
       else:
@@ -625,39 +1615,7 @@ def process_video(
 
   logging.info('image_or_videos_overlays: %s', image_or_videos_overlays)
   logging.info('text_overlays: %s', text_overlays)
-  (img_overlays, text_imgs, out_video
-  ) = VideoService.filter_strings(image_or_videos_overlays, text_overlays)
-  img_args = VideoService.image_and_video_inputs(
-      image_or_videos_overlays, text_imgs
-  )
-
-  # forces input audio to output
-  num_assets = len(image_or_videos_overlays) + len(text_imgs)
-  if input_audio_path:
-    audio_index = num_assets + 1
-    out_audio = f'{audio_index}:a'
-    audio_args = ['-i', input_audio_path]
-  else:
-    out_audio = '0:a?'
-    audio_args = []
-
-  # assets_args
-  assets_args = img_args + audio_args
-  filter_complex = img_overlays
-
-  # Group all args and runs ffmpeg
-  ffmpeg_output = VideoService.run_ffmpeg(
-      out_video,
-      out_audio,
-      assets_args,
-      filter_complex,
-      input_video_path,
-      output_video_path,
-  )
-
-  logging.debug('ffmpeg ran with output %s:', ffmpeg_output)
-
-  return output_video_path
+  return image_or_videos_overlays, text_overlays
 
 
 def convert_text_overlay(
@@ -668,14 +1626,6 @@ def convert_text_overlay(
 ):
   placement = element.placement
   wrapped_lines = element.wrapped_text
-  font_path = None
-
-  if placement.text_font:
-    font_path = StorageService.download_gcs_file(
-        filepath=placement.text_font,
-        bucket_name=ConfigService.GCS_BUCKET,
-        output_dir=output_dir,
-    )
 
   # Create overlays to all lines broken down.
   texts = []
@@ -690,9 +1640,11 @@ def convert_text_overlay(
         (1.2 * i * placement.text_size),  # Add new line to wrap text.
         'angle': placement.rotation_angle,
         'text': line,
-        'font': font_path,
+        'rendered_image': element.text_images[i],
+        'font': element.font_path,
         'font_color': placement.text_color,
         'font_size': placement.text_size,
+        'supersampling': ConfigService.TEXT_SUPERSAMPLING,
     })
 
   return texts
@@ -796,11 +1748,7 @@ def _wrap_text(text, characters_per_line, hyphenation_language=None):
 
 
 def remove_background(input_path):
-  input_image = Image.open(input_path)
-  output_image = remove(input_image)
-  output_path = f'{input_path}.png'
-  output_image.save(output_path)
-  return output_path
+  return _BACKGROUND_REMOVER.remove(input_path)
 
 
 def convert_image_overlay(
@@ -808,16 +1756,22 @@ def convert_image_overlay(
     offset: float,
     duration: float,
     element: Element,
+    assets: Optional[dict[tuple[str, str], Optional[str]]] = None,
 ):
   placement = element.placement
   logging.debug('Downloading image %s...', placement.image_url)
 
-  # Download image from url to local temp file
-  tmp_file_name = _download_image_to_file(output_dir, placement.image_url)
+  # Download image from url to local temp file, unless it was prefetched
+  tmp_file_name = _fetch_image_asset(output_dir, placement.image_url, assets)
 
   if placement.remove_background == 'Yes':
-    logging.debug('Removing background from image %s...', placement.image_url)
-    tmp_file_name = remove_background(tmp_file_name)
+    if assets and (_ASSET_CUTOUT, placement.image_url) in assets:
+      tmp_file_name = assets[(_ASSET_CUTOUT, placement.image_url)]
+    else:
+      logging.debug(
+          'Removing background from image %s...', placement.image_url
+      )
+      tmp_file_name = remove_background(tmp_file_name)
 
   # Find out file's extension
   extension = imghdr.what(tmp_file_name) or 'tmp'
@@ -849,44 +1803,14 @@ def _download_image_to_file(output_dir, url):
         filepath=file_path,
         bucket_name=ConfigService.GCS_BUCKET,
         output_dir=output_dir,
+        cache=_ASSET_CACHE,
     )
   # Downloads image from https/https urls
   elif url.startswith('http://') or url.startswith('https://'):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) '
-        'Chrome/90.0.4430.72 Safari/537.36 '
-    }
-
     try:
-      r = requests.get(url, stream=True, headers=headers, timeout=30)
-      r.raise_for_status()
-
-      # Get content type and guess extension
-      content_type = r.headers.get('content-type')
-      extension = mimetypes.guess_extension(
-          content_type
-      ) if content_type else '.img'  # Default extension if type unknown
-
-      # If guessed extension is None or odd
-      if extension is None:
-        extension = '.img'  # Use default extension
-      elif extension == '.jpe':
-        extension = '.jpg'
-
-      if not extension.startswith('.'):
-        extension = '.' + extension
-
-      # Construct a safe filename
-      timestamp = datetime.datetime.now().timestamp()
-      base_filename = f'img_{timestamp}{extension}'
-      tmp_file_name = os.path.join(output_dir, base_filename)
-
-      r.raw.decode_content = True
-      with open(tmp_file_name, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
-
+      tmp_file_name = _IMAGE_FETCHER.fetch(url, output_dir)
     except requests.exceptions.RequestException as e:
-      print(f'Error downloading image from {url}: {e}')
+      logging.error('Error downloading image from %s: %s', url, e)
       raise
 
   else:
@@ -18,18 +18,89 @@ All code calling the video manipulation library (currently ffmpeg) should be
 here.
 """
 
+import bisect
+import collections
+import fractions
+import hashlib
+import json
 import logging
+import math
 import os
 import subprocess
 import tempfile
-
-
-def filter_strings(images_and_videos, text_lines):
+import threading
+import time
+
+import render_metrics as RenderMetricsService
+from PIL import Image, ImageDraw, ImageFont
+
+TEXT_RENDERER_IMAGEMAGICK = 'imagemagick'
+TEXT_RENDERER_PILLOW = 'pillow'
+# Text is rendered this many times larger than its size, then scaled down by
+# ffmpeg for smoother edges.
+DEFAULT_SUPERSAMPLING = 4
+
+# Named encoding settings, trading render time for quality and size.
+ENCODING_PROFILES = {
+    'fast-preview': {
+        'video_codec': 'libx264',
+        'preset': 'veryfast',
+        'crf': 28,
+        'audio_codec': 'aac',
+        'audio_bitrate': '96k',
+    },
+    # Same as ffmpeg's defaults for H.264 outputs.
+    'balanced': {
+        'video_codec': 'libx264',
+        'preset': 'medium',
+        'crf': 23,
+        'audio_codec': 'aac',
+        'audio_bitrate': '128k',
+    },
+    'archival': {
+        'video_codec': 'libx264',
+        'preset': 'slow',
+        'crf': 18,
+        'audio_codec': 'aac',
+        'audio_bitrate': '192k',
+    },
+}
+
+# Containers the profiles' codecs can be written to, with the audio codecs
+# they can hold as-is. None means any audio codec.
+_H264_CONTAINERS = {
+    '.mp4': {'aac', 'mp3', 'alac', 'ac3', 'eac3'},
+    '.m4v': {'aac', 'mp3', 'alac', 'ac3', 'eac3'},
+    '.mov': {'aac', 'mp3', 'alac', 'ac3', 'eac3', 'pcm_s16le'},
+    '.mkv': None,
+}
+
+
+def filter_strings(
+    images_and_videos,
+    text_lines,
+    text_renderer=TEXT_RENDERER_IMAGEMAGICK,
+    text_cache=None,
+    input_offset=0,
+    base_stream='0:v',
+    stream_prefix='',
+    input_label='%d:v',
+    output_dir=None,
+):
   """Generates a complex filter specification for ffmpeg.
 
   Args:
     images_and_videos: a list of image overlay objects
     text_lines: a list of text overlay objects
+    text_renderer: the backend used to rasterize text (see write_temp_image)
+    text_cache: optional cache of rendered text images (see write_temp_image)
+    input_offset: number of ffmpeg inputs preceding this video's overlays,
+      besides the template (used when rendering several videos at once)
+    base_stream: the stream to overlay on, the template by default
+    stream_prefix: prefix for the names of the intermediate output streams
+    input_label: format of the stream each overlay is read from, given its
+      input index (see share_inputs)
+    output_dir: the directory to write text images to (see write_temp_image)
 
   Returns:
     A string that represents a complex filter specification, ready to be
@@ -38,25 +109,42 @@ def filter_strings(images_and_videos, text_lines):
   # groups overlays and creates the first to loop in
   retval = []
   overlays = [*images_and_videos, *text_lines]
-  input_stream = '0:v'
+  input_stream = base_stream
   output_stream = None
   text_imgs = []
   # loops concatenating other overlays to the first
   for i, ovr in enumerate(overlays):
-    output_stream = f'vidout{i}'
+    output_stream = f'{stream_prefix}vidout{i}'
+    stream_index = input_offset + i + 1
     use_cropped_text_fix = True  # Enable the pre-rotation fix for text (handled in write_temp_image)
 
+    source_stream = input_label % stream_index
+
     # if it is an image overlay, renames it to 'vidX'
     if 'image' in ovr:
-      f = f'[{i+1}:v] copy [vid{i+1}];'
+      f = f'[{source_stream}] copy [vid{stream_index}];'
+
+    # if it is a pre-composed layer, it is input like a text image
+    elif 'layer' in ovr:
+      f = f'[{source_stream}] copy [vid{stream_index}];'
+      text_imgs.append({
+          'path': ovr['layer'],
+          'start_time': ovr['start_time'],
+          'end_time': ovr['end_time'],
+      })
 
     # if it is a text overlay, convert text to img and name overlay as 'imgX'
     else:
-      f, text_img = text_filter((i + 1), ovr['text'], ovr['font'],
+      f, text_img = text_filter(stream_index, ovr['text'], ovr['font'],
                                 ovr['font_size'], ovr['font_color'],
                                 ovr['align'],
                                 ovr['start_time'], ovr['end_time'],
-                                ovr.get('angle', None), use_cropped_text_fix)
+                                ovr.get('angle', None), use_cropped_text_fix,
+                                text_renderer, text_cache,
+                                ovr.get('rendered_image', None),
+                                ovr.get('supersampling',
+                                        DEFAULT_SUPERSAMPLING),
+                                source_stream, output_dir)
       text_imgs.append(text_img)
 
     # Angle should be passed normally, except if we're creating text with
@@ -66,12 +154,13 @@ def filter_strings(images_and_videos, text_lines):
 
     # Applies ffmpeg effects to images and text generated images
     f += video_filter(
-        input_stream, (i + 1), ovr['x'], ovr['y'], ovr.get('width', '-1'),
+        input_stream, stream_index, ovr['x'], ovr['y'], ovr.get('width', '-1'),
         ovr.get('height',
                 '-1'), ovr['start_time'], ovr['end_time'], output_stream,
         (ovr.get('angle', None) if not angle_already_used else None),
         ovr.get('fade_in_duration', 0.1), ovr.get('fade_out_duration', 0.1),
-        ovr.get('align', None), ovr.get('keep_ratio', None)
+        ovr.get('align', None), ovr.get('keep_ratio', None),
+        'image' not in ovr or not is_animated(ovr)
     )
     retval.append(f)
 
@@ -81,13 +170,221 @@ def filter_strings(images_and_videos, text_lines):
   # maps last output to final video, or input video if there are no filters
   if output_stream:
     out_video = f'[{output_stream}]'
-  else:
+  elif base_stream == '0:v':
     out_video = '0:v'
+  else:
+    out_video = f'[{base_stream}]'
 
   # returns all overlays
   return (retval, text_imgs, out_video)
 
 
+def precompose_layers(images_and_videos, text_lines, output_dir=None):
+  """Composites overlays sharing the same time window into single layers.
+
+  Overlays shown from the same start to the same end time, with the same
+  fades, are composited with Pillow into one RGBA image covering their
+  bounding box, which ffmpeg then overlays (and fades) once per frame
+  instead of once per overlay.
+
+  A window's overlays are only merged if no other overlay visible at the same
+  time is stacked between them, so the result looks the same (up to where
+  merged overlays overlap each other while fading). Animated images and
+  videos are never merged.
+
+  Args:
+    images_and_videos: a list of image overlay objects
+    text_lines: a list of text overlay objects, with their rendered images
+    output_dir: the directory to write the layers to, the system's temporary
+      directory if None
+
+  Returns:
+    The image overlays and text overlays to render, where the text overlays
+    may now include layer overlays (with a 'layer' image path) as understood
+    by filter_strings.
+  """
+  overlays = [*images_and_videos, *text_lines]
+  num_images = len(images_and_videos)
+
+  def window(ovr):
+    return (
+        float(ovr['start_time']),
+        float(ovr['end_time']),
+        float(ovr.get('fade_in_duration', 0.1)),
+        float(ovr.get('fade_out_duration', 0.1)),
+    )
+
+  groups = {}
+  for i, ovr in enumerate(overlays):
+    if _can_precompose(ovr):
+      groups.setdefault(window(ovr), []).append(i)
+
+  # Layers are inserted before the overlay at the given index, in the text
+  # overlays as they are input like text images.
+  layers = {}
+  merged = set()
+  for (start, end, fade_in, fade_out), members in groups.items():
+    if len(members) < 2:
+      continue
+    position = max(members[-1], num_images)
+    member_set = set(members)
+    if any(
+        i not in member_set
+        and float(overlays[i]['start_time']) < end
+        and start < float(overlays[i]['end_time'])
+        for i in range(members[0], position)
+    ):
+      continue
+
+    try:
+      layer = _composite_layer([overlays[i] for i in members], output_dir)
+    except (OSError, ValueError) as e:
+      logging.warning('Could not pre-compose overlays, skipping: %s', e)
+      continue
+    layer.update({
+        'start_time': overlays[members[0]]['start_time'],
+        'end_time': overlays[members[0]]['end_time'],
+        'fade_in_duration': fade_in,
+        'fade_out_duration': fade_out,
+    })
+    layers.setdefault(position, []).append(layer)
+    merged |= member_set
+
+  if not merged:
+    return images_and_videos, text_lines
+  logging.info(
+      'Pre-composed %d overlays into %d layers.',
+      len(merged),
+      sum(len(l) for l in layers.values()),
+  )
+
+  new_images = [
+      ovr for i, ovr in enumerate(images_and_videos) if i not in merged
+  ]
+  new_texts = []
+  for i in range(num_images, len(overlays) + 1):
+    new_texts += layers.get(i, [])
+    if i < len(overlays) and i not in merged:
+      new_texts.append(overlays[i])
+  return new_images, new_texts
+
+
+def _can_precompose(ovr):
+  """Returns whether an overlay is a still image Pillow can composite."""
+  if 'text' in ovr:
+    return bool(ovr.get('rendered_image'))
+  if 'image' not in ovr or ovr['image'].lower().endswith('.gif'):
+    return False
+  try:
+    with Image.open(ovr['image']) as img:
+      return not getattr(img, 'is_animated', False)
+  except OSError:
+    return False
+
+
+def _even(value):
+  # ffmpeg's overlay aligns positions to the chroma subsampling of yuv420p.
+  return int(math.floor(float(value))) & ~1
+
+
+def _scaled_size(src_width, src_height, width, height):
+  """Resolves a `scale=width:height` size, where -1 keeps the aspect ratio."""
+  width = int(float(width)) if width not in (None, '', 0) else -1
+  height = int(float(height)) if height not in (None, '', 0) else -1
+  if width < 0 and height < 0:
+    return src_width, src_height
+  if width < 0:
+    return max(1, round(src_width * height / src_height)), height
+  if height < 0:
+    return width, max(1, round(src_height * width / src_width))
+  return width, height
+
+
+def scale_image(img, width, height, keep_ratio=False, angle=None):
+  """Scales and rotates an image like video_filter does.
+
+  Args:
+    img: the RGBA image
+    width: the overlay width, -1 (or empty) to keep the aspect ratio
+    height: the overlay height, -1 (or empty) to keep the aspect ratio
+    keep_ratio: whether to fit the image in width x height instead of
+      stretching it
+    angle: optional clockwise rotation in degrees, expanding the image
+
+  Returns:
+    The scaled and rotated image.
+  """
+  if keep_ratio and float(width or 0) > 0 and float(height or 0) > 0:
+    box_width, box_height = float(width), float(height)
+    if img.width / img.height > box_width / box_height:
+      size = _scaled_size(img.width, img.height, box_width, -1)
+    else:
+      size = _scaled_size(img.width, img.height, -1, box_height)
+  else:
+    size = _scaled_size(img.width, img.height, width, height)
+  if size != img.size:
+    img = img.resize(size, Image.Resampling.BICUBIC)
+
+  if angle and str(angle) != '0':
+    # ffmpeg rotates clockwise, Pillow counterclockwise.
+    img = img.rotate(
+        -float(angle), resample=Image.Resampling.BICUBIC, expand=True
+    )
+  return img
+
+
+def _overlay_image(ovr):
+  """Renders an overlay as ffmpeg would, returning it and its position."""
+  if 'text' in ovr:
+    # Text is rendered supersampled and already rotated (see text_filter).
+    img = Image.open(ovr['rendered_image']).convert('RGBA')
+    supersampling = int(ovr.get('supersampling', DEFAULT_SUPERSAMPLING))
+    if supersampling > 1:
+      img = img.resize(
+          (
+              max(1, img.width // supersampling),
+              max(1, img.height // supersampling),
+          ),
+          Image.Resampling.LANCZOS,
+      )
+    return img, _even(ovr['x']), _even(ovr['y'])
+
+  width, height = ovr.get('width', '-1'), ovr.get('height', '-1')
+  x, y = float(ovr['x']), float(ovr['y'])
+  img = scale_image(
+      Image.open(ovr['image']).convert('RGBA'),
+      width,
+      height,
+      ovr.get('keep_ratio'),
+      ovr.get('angle', None),
+  )
+  if ovr.get('keep_ratio') and float(width or 0) > 0 and float(height or 0) > 0:
+    x += (float(width) - img.width) / 2
+    y += (float(height) - img.height) / 2
+  return img, _even(x), _even(y)
+
+
+def _composite_layer(overlays, output_dir=None):
+  """Composites overlays into a temporary PNG covering their bounding box.
+
+  Returns:
+    A layer overlay object, without its timing.
+  """
+  placed = [_overlay_image(ovr) for ovr in overlays]
+  left = min(x for _, x, _ in placed)
+  top = min(y for _, _, y in placed)
+  right = max(x + img.width for img, x, _ in placed)
+  bottom = max(y + img.height for img, _, y in placed)
+
+  layer = Image.new('RGBA', (right - left, bottom - top))
+  for img, x, y in placed:
+    layer.alpha_composite(img, dest=(x - left, y - top))
+
+  layer_path = _new_png(output_dir, 'pva_lite_layer_')
+  layer.save(layer_path, compress_level=1)
+  return {'layer': layer_path, 'x': left, 'y': top}
+
+
 def text_filter(
     text_stream_index,
     text,
@@ -99,6 +396,12 @@ def text_filter(
     t_end,
     angle,
     use_cropped_text_fix=False,
+    text_renderer=TEXT_RENDERER_IMAGEMAGICK,
+    text_cache=None,
+    rendered_image=None,
+    supersampling=DEFAULT_SUPERSAMPLING,
+    input_stream=None,
+    output_dir=None,
 ):
   """Generates a ffmeg filter specification for a text overlay.
 
@@ -111,13 +414,22 @@ def text_filter(
       align: text alignment ("left" or "center")
       t_start: start time of the image's appearance
       t_end: end time of the image's appearance
+      text_renderer: the backend used to rasterize the text
+      text_cache: optional cache of rendered text images
+      rendered_image: optional image of the text rendered (with
+        write_temp_image) while laying it out, used instead of rendering again
+      supersampling: how many times larger than its size the text is rendered
+      input_stream: the stream the text image is read from, the input at
+        `text_stream_index` by default
+      output_dir: the directory to write the text image to, see
+        write_temp_image
 
     Returns:
       A string that represents a text filter specification, ready to be
       passed in to ffmpeg.
     """
 
-  input_str = '[%s:v]' % text_stream_index
+  input_str = '[%s]' % (input_stream or '%s:v' % text_stream_index)
   out_str = '[vid%s]' % text_stream_index
 
   # If the text is empty, returns a "noop" filter, otherwise ffmpeg will
@@ -129,19 +441,32 @@ def text_filter(
   # http://xkcd.com/1638/
   # text_file_name = write_to_temp_file(text)
 
-  # creates an image with the text 4x its size
-  temp_image_name = write_temp_image(
-      font_color,
-      font,
-      str(font_size),
-      text, #text_file_name, # TODO: check if we really need the text_file_name
-      angle,
-      use_cropped_text_fix,
-  )
+  # creates an image with the text supersampled, unless the layout already did
+  if rendered_image:
+    temp_image_name = rendered_image
+  else:
+    temp_image_name = write_temp_image(
+        font_color,
+        font,
+        str(font_size),
+        text, #text_file_name, # TODO: check if we really need the text_file_name
+        angle,
+        use_cropped_text_fix,
+        text_renderer,
+        text_cache,
+        supersampling,
+        output_dir,
+    )
 
-  # returns ffmpeg command reducing img in 1/4, for better rendering.
+  # returns ffmpeg command reducing the supersampled img, for better rendering.
+  if int(supersampling) > 1:
+    f = '%s scale=iw/%d:ih/%d %s;' % (
+        input_str, int(supersampling), int(supersampling), out_str
+    )
+  else:
+    f = '%s copy %s;' % (input_str, out_str)
   return (
-      '%s scale=iw/4:ih/4 %s;' % (input_str, out_str), {
+      f, {
           'path': temp_image_name,
           'start_time': t_start,
           'end_time': t_end
@@ -164,6 +489,7 @@ def video_filter(
     fade_out_duration,
     align,
     keep_ratio,
+    hold=False,
 ):
   """Generates a ffmpeg filter specification for an image input.
 
@@ -178,6 +504,8 @@ def video_filter(
     fade_in_duration: float of representing how many seconds should fade in
     fade_out_duration: float of representing how many seconds should fade out
     align: align, for texts made image
+    hold: whether the input is a single frame to hold during its overlay
+      time, which is then scaled and rotated once rather than on every frame
 
   Returns:
     A string that represents an image filter specification, ready to be
@@ -224,6 +552,16 @@ def video_filter(
   else:
     rotate_str = resize_str
 
+  # repeats the (scaled and rotated) frame during the overlay time
+  if hold:
+    held_str = '[vid%sheld]' % image_stream_index
+    hold_start = max(0.0, float(t_start))
+    img += (
+        '%s loop=loop=-1:size=1,trim=end=%s,setpts=PTS-STARTPTS+%s/TB %s;'
+        % (rotate_str, float(t_end) - hold_start, hold_start, held_str)
+    )
+    rotate_str = held_str
+
   # adds fade in to image
   if float(fade_in_duration) > 0:
     fadein_start = t_start
@@ -267,6 +605,13 @@ def write_to_temp_file(text):
   return text_file_name
 
 
+def _new_png(output_dir, prefix):
+  """Creates an empty PNG file to write to, returning its path."""
+  (fd, path) = tempfile.mkstemp(prefix=prefix, suffix='.png', dir=output_dir)
+  os.close(fd)
+  return path
+
+
 def write_temp_image(
     t_color,
     t_font,
@@ -274,11 +619,82 @@ def write_temp_image(
     text,
     angle,
     use_cropped_text_fix=False,
+    text_renderer=TEXT_RENDERER_IMAGEMAGICK,
+    text_cache=None,
+    supersampling=DEFAULT_SUPERSAMPLING,
+    output_dir=None,
 ):
-  """Writes a text to a temporary image with transparent background."""
+  """Writes a text to a temporary image with transparent background.
+
+  The text is rendered `supersampling` times larger than its size, to be
+  scaled down by ffmpeg for better quality. The image is only as large as the
+  rendered (and rotated) text, so its cost grows with the text.
+
+  Args:
+    t_color: font color, as understood by ImageMagick (e.g. '#ff0000')
+    t_font: the file name of the font to be used, or None for the default
+    t_size: font size in dots
+    text: the text to render, possibly spanning multiple lines
+    angle: clockwise rotation in degrees, only applied with the cropped fix
+    use_cropped_text_fix: whether to rotate the text and trim the image to the
+      rendered pixels
+    text_renderer: TEXT_RENDERER_IMAGEMAGICK to run ImageMagick's `convert`,
+      or TEXT_RENDERER_PILLOW to render in-process with Pillow
+    text_cache: optional cache of rendered images (a
+      `text_rendering.RenderedTextCache`), consulted before rendering
+    supersampling: how many times larger than its size to render the text, 1
+      to render it at its size (still antialiased)
+    output_dir: the directory to write the image to, e.g. the message's
+      temporary directory so it is removed along with it; the system's
+      temporary directory if None
+
+  Returns:
+    The path of the generated PNG file.
+  """
 
   # creates temp file
-  temp_file_name = tempfile.mktemp(prefix='pva_lite_', suffix='.png')
+  temp_file_name = _new_png(output_dir, 'pva_lite_')
+
+  cache_key = None
+  if text_cache is not None:
+    cache_key = text_cache.key(
+        text, t_font, t_size, t_color, angle, use_cropped_text_fix,
+        text_renderer, supersampling
+    )
+    if text_cache.fetch(cache_key, temp_file_name):
+      return temp_file_name
+
+  if text_renderer == TEXT_RENDERER_PILLOW:
+    _write_text_image_pillow(
+        temp_file_name, t_color, t_font, t_size, text, angle,
+        use_cropped_text_fix, supersampling
+    )
+  elif text_renderer == TEXT_RENDERER_IMAGEMAGICK:
+    _write_text_image_imagemagick(
+        temp_file_name, t_color, t_font, t_size, text, angle,
+        use_cropped_text_fix, supersampling
+    )
+  else:
+    raise ValueError(f'Unsupported text renderer: {text_renderer}')
+
+  if cache_key is not None:
+    text_cache.store(cache_key, temp_file_name)
+
+  # return generated file name
+  return temp_file_name
+
+
+def _write_text_image_imagemagick(
+    temp_file_name,
+    t_color,
+    t_font,
+    t_size,
+    text,
+    angle,
+    use_cropped_text_fix,
+    supersampling=DEFAULT_SUPERSAMPLING,
+):
+  """Renders text for write_temp_image by running ImageMagick's `convert`."""
 
   # If text is empty or just whitespace, create a 1x1 transparent png
   # to avoid errors with imagemagick's label:.
@@ -294,7 +710,7 @@ def write_temp_image(
     args += ['-background', 'transparent', '-colorspace', 'sRGB']
     if t_font:
       args += ['-font', t_font]
-    args += ['-pointsize', str(float(t_size) * 4)]
+    args += ['-pointsize', str(float(t_size) * int(supersampling))]
     # The code below adds a thin border around the text. It was introduced as a
     # workaround for a light border on dark text that used to appear in some
     # projects. Since we're not seeing that issue anymore and some users are
@@ -303,15 +719,17 @@ def write_temp_image(
     # args += ['-strokewidth', str(float(t_size) / 10)]
     args += ['-fill', t_color]
 
+    # The label's canvas fits the text, and `+distort` grows it to fit the
+    # rotated text, instead of drawing on a fixed 8000x8000 canvas.
     if use_cropped_text_fix:
-      args += ['-size', '8000x8000']
       args += ['-gravity', 'center']
 
     args += ['label:' + text.replace('%', '%%')]  # label:@text_file_name
 
     if use_cropped_text_fix:
       if angle and str(angle) != '0':
-        args += ['-distort', 'SRT', str(angle)]
+        args += ['-virtual-pixel', 'background']
+        args += ['+distort', 'SRT', str(angle)]
       args += ['-trim']
 
     args += [escape_path(temp_file_name)]
@@ -321,6 +739,7 @@ def write_temp_image(
       ' '.join([str(arg) for arg in args])
   )  # Ensure all args are strings for logging
 
+  RenderMetricsService.increment('subprocesses')
   try:
     output = subprocess.check_output(args, stderr=subprocess.STDOUT)
     if output:
@@ -328,8 +747,73 @@ def write_temp_image(
   except subprocess.CalledProcessError as e:
     raise FFMpegExecutionError(args, e.output) from e  # Pass args as list
 
-  # return generated file name
-  return temp_file_name
+
+def load_font(t_font, size):
+  """Loads a font with Pillow, falling back to Pillow's default font."""
+  if t_font:
+    return ImageFont.truetype(t_font, size)
+  return ImageFont.load_default(size)
+
+
+def _write_text_image_pillow(
+    output_path,
+    t_color,
+    t_font,
+    t_size,
+    text,
+    angle,
+    use_cropped_text_fix,
+    supersampling=DEFAULT_SUPERSAMPLING,
+):
+  """Renders text like write_temp_image's ImageMagick backend, in-process.
+
+  Mirrors `convert label:` (supersampled point size, centered lines under the
+  cropped text fix), `+distort SRT` (clockwise rotation around the center)
+  and `-trim`, without spawning a process.
+  """
+  if not text.strip():
+    Image.new('RGBA', (1, 1), (0, 0, 0, 0)).save(output_path)
+    return
+
+  font = load_font(t_font, float(t_size) * int(supersampling))
+  align = 'center' if use_cropped_text_fix else 'left'
+  measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+  ascent, descent = font.getmetrics()
+  # `label:` advances lines by the font's line height, Pillow by the height of
+  # an 'A' plus the given spacing.
+  spacing = ascent + descent - measure.textbbox((0, 0), 'A', font=font)[3]
+  left, top, right, bottom = measure.multiline_textbbox(
+      (0, 0), text, font=font, align=align, spacing=spacing
+  )
+
+  if use_cropped_text_fix:
+    # Pads the canvas so that antialiased edges are never clipped; the
+    # padding is trimmed away below.
+    pad = max(1, math.ceil(float(t_size) * int(supersampling) / 8))
+    width = math.ceil(right - min(left, 0)) + 2 * pad
+    height = math.ceil(bottom - min(top, 0)) + 2 * pad
+    origin = (pad - min(left, 0), pad - min(top, 0))
+  else:
+    # `label:` keeps the full line box (advance width, ascent plus descent).
+    width = max(1, math.ceil(right))
+    height = max(1, math.ceil(max(bottom, ascent + descent)))
+    origin = (0, 0)
+
+  image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+  ImageDraw.Draw(image).multiline_text(
+      origin, text, font=font, fill=t_color, align=align, spacing=spacing
+  )
+
+  if use_cropped_text_fix:
+    if angle and str(angle) != '0':
+      # Pillow rotates counter-clockwise, ImageMagick's SRT clockwise.
+      image = image.rotate(
+          -float(angle), resample=Image.Resampling.BICUBIC, expand=True
+      )
+    bbox = image.getchannel('A').getbbox()
+    image = image.crop(bbox) if bbox else Image.new('RGBA', (1, 1))
+
+  image.save(output_path)
 
 
 def escape_path(path):
@@ -342,30 +826,43 @@ def escape_path(path):
 
 def image_and_video_inputs(images_and_videos, text_tmp_images):
   """Generates a list of input arguments for ffmpeg with the given images."""
+  return [
+      arg
+      for input_args in overlay_inputs(images_and_videos, text_tmp_images)
+      for arg in input_args
+  ]
+
+
+def overlay_inputs(images_and_videos, text_tmp_images):
+  """Generates the input arguments for each of the given images.
+
+  Images should already be scaled to their overlay size (see
+  `image_scaling.ImagePrescaler`), so ffmpeg doesn't decode larger images
+  than needed.
+
+  Args:
+    images_and_videos: a list of image overlay objects
+    text_tmp_images: a list of text images, as returned by filter_strings
+
+  Returns:
+    A list with the input arguments of each image (ending with '-i' and its
+    file name), in the order filter_strings reads them.
+  """
   include_cmd = []
-  resized_images = set()
 
   # adds images as video starting on overlay time and finishing on overlay end
   for ovl in images_and_videos:
     filename = ovl['image']
 
-    duration = str(float(ovl['end_time']) - float(ovl['start_time']))
-
     is_gif = filename.lower().endswith('.gif')
-    has_fade = (
-        float(ovl.get('fade_in_duration', 0))
-        + float(ovl.get('fade_out_duration', 0))
-    ) > 0
-
-    # A GIF with no fade is treated as an animated GIF should.
-    # It works even if it is not animated.
-    # An animated GIF cannot have fade in or out effects.
-    if is_gif and not has_fade:
+
+    # Animated GIFs are streamed during their overlay time, anything else is
+    # a single frame held by the filter graph (see video_filter).
+    if is_animated(ovl):
       include_args = ['-ignore_loop', '0']
+      include_args += _input_timing_args(ovl)
     else:
-      include_args = ['-f', 'image2', '-loop', '1']
-
-    include_args += ['-itsoffset', str(ovl['start_time']), '-t', duration]
+      include_args = ['-f', 'image2']
 
     # GIFs should have a special input decoder for FFMPEG.
     if is_gif:
@@ -375,16 +872,7 @@ def image_and_video_inputs(images_and_videos, text_tmp_images):
     # include_args += ['-thread_queue_size', str(self.thread_queue_size), '-re']
     include_args += ['-i']
 
-    # Resize all images to avoid FFMPEG to run with unecessary large images
-    if (filename not in resized_images) and filename.endswith('png'):
-      resize_images(
-          filename, filename, ovl.get('width', -1), ovl.get('height', -1),
-          ovl.get('keep_ratio', True)
-      )
-
-      resized_images.add(filename)  # Add the potentially new filename
-
-    include_cmd += include_args + ['%s'%filename]
+    include_cmd.append(include_args + ['%s'%filename])
 
     # treats video overlays
     # else:
@@ -393,37 +881,473 @@ def image_and_video_inputs(images_and_videos, text_tmp_images):
     #    include_args += ['-i']
     #    include_cmd += include_args + ['%s' % (filename)]
 
-  # adds texts as video starting and finishing on their overlay timing
+  # adds texts as single frames, held during their overlay time
   for img2 in text_tmp_images:
-    duration = str(float(img2['end_time']) - float(img2['start_time']))
-
-    include_args = ['-f', 'image2', '-loop', '1']
-    include_args += ['-itsoffset', str(img2['start_time']), '-t', duration]
+    include_args = ['-f', 'image2']
     include_args += ['-i']
 
-    include_cmd += include_args + [str(img2['path'])]
+    include_cmd.append(include_args + [str(img2['path'])])
 
   return include_cmd
 
 
-def resize_images(
-    input_file, output_file, width, height, keep_ratio, executable='convert'
+def share_inputs(input_args, input_offset=0, label='src%d'):
+  """Opens identical inputs once, splitting them for each overlay using them.
+
+  Still images are identified by their contents, so the same image (or text
+  raster) is decoded once however many overlays, content segments or variants
+  show it. Streamed inputs (animated GIFs) must also have the same timing.
+
+  Args:
+    input_args: the input arguments of each overlay, from overlay_inputs
+    input_offset: number of ffmpeg inputs preceding these, besides the
+      template
+    label: format of the stream names to create for each overlay, given its
+      input index as filter_strings numbers them (see its `input_label`)
+
+  Returns:
+    A tuple of the (deduplicated) input arguments and the filter
+    specifications creating each overlay's stream from them.
+  """
+  unique_args = []
+  users = {}
+  for index, args in enumerate(input_args):
+    *options, filename = args
+    if '-itsoffset' in options:
+      key = (tuple(options), filename)
+    else:
+      key = (tuple(options), _file_identity(filename))
+    if key not in users:
+      users[key] = []
+      unique_args += args
+    users[key].append(input_offset + index + 1)
+
+  filters = []
+  for input_index, streams in enumerate(users.values(), input_offset + 1):
+    outputs = ''.join(f'[{label % stream}]' for stream in streams)
+    if len(streams) > 1:
+      filters.append(f'[{input_index}:v] split={len(streams)} {outputs}')
+    else:
+      filters.append(f'[{input_index}:v] null {outputs}')
+  return unique_args, filters
+
+
+def _file_identity(path):
+  """Returns a digest of a file's contents (overlay images are small)."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def is_animated(ovl):
+  """Returns whether an image overlay is streamed rather than held.
+
+  A GIF with no fade is treated as an animated GIF should. It works even if it
+  is not animated. An animated GIF cannot have fade in or out effects.
+  """
+  has_fade = (
+      float(ovl.get('fade_in_duration', 0))
+      + float(ovl.get('fade_out_duration', 0))
+  ) > 0
+  return ovl['image'].lower().endswith('.gif') and not has_fade
+
+
+def _input_timing_args(ovl):
+  """Generates the arguments streaming an input during its overlay time.
+
+  Overlays may start before the video does (when rendering a chunk of it), in
+  which case the input starts with the video, seeked to where the overlay is
+  at that point rather than restarting from its first frame.
+  """
+  start = float(ovl['start_time'])
+  duration = float(ovl['end_time']) - max(0.0, start)
+  args = []
+  if start < 0:
+    args += ['-ss', str(-start)]
+  return args + ['-itsoffset', str(max(0.0, start)), '-t', str(duration)]
+
+
+def probe_audio_codec(input_file, executable='ffprobe'):
+  """Returns the codec name of the first audio stream of a file.
+
+  Args:
+    input_file: the file to probe
+    executable: the full or relative path to the ffprobe executable
+  Returns:
+    The codec name (e.g. 'aac'), or None if the file has no audio stream or
+    can't be probed.
+  """
+  args = [
+      executable,
+      '-v', 'error',
+      '-select_streams', 'a:0',
+      '-show_entries', 'stream=codec_name',
+      '-of', 'default=noprint_wrappers=1:nokey=1',
+      input_file,
+  ]
+  RenderMetricsService.increment('subprocesses')
+  try:
+    output = subprocess.check_output(args, stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError) as e:
+    logging.warning('Could not probe audio codec of %s: %s', input_file, e)
+    return None
+  return output.decode('utf-8').strip() or None
+
+
+def encoding_args(profile_name, output_video, audio_codec=None):
+  """Generates the output arguments encoding a video with a profile.
+
+  Args:
+    profile_name: the name of one of the ENCODING_PROFILES
+    output_video: output video file name, whose extension is the container
+    audio_codec: the codec of the (unfiltered) audio stream mapped to the
+      output, which is copied instead of re-encoded if the container supports
+      it, or None to always re-encode it
+  Returns:
+    A list of ffmpeg output arguments
+  Raises:
+    ValueError: if the profile does not exist
+  """
+  if profile_name not in ENCODING_PROFILES:
+    raise ValueError(
+        f'Unknown encoding profile "{profile_name}", expected one of:'
+        f' {", ".join(ENCODING_PROFILES)}'
+    )
+  container = os.path.splitext(output_video)[1].lower()
+  if container not in _H264_CONTAINERS:
+    # Leaves the codecs to ffmpeg's defaults for the container.
+    logging.warning(
+        'Encoding profile "%s" does not support %s outputs, ignoring it.',
+        profile_name,
+        container,
+    )
+    return []
+  return video_encoding_args(profile_name) + audio_encoding_args(
+      profile_name, output_video, audio_codec
+  )
+
+
+def video_encoding_args(profile_name, pix_fmt=None):
+  """Generates the output arguments encoding video with a profile.
+
+  Args:
+    profile_name: the name of one of the ENCODING_PROFILES
+    pix_fmt: optional pixel format to encode to
+  Returns:
+    A list of ffmpeg output arguments
+  Raises:
+    ValueError: if the profile does not exist
+  """
+  if profile_name not in ENCODING_PROFILES:
+    raise ValueError(
+        f'Unknown encoding profile "{profile_name}", expected one of:'
+        f' {", ".join(ENCODING_PROFILES)}'
+    )
+  profile = ENCODING_PROFILES[profile_name]
+  args = [
+      '-c:v', profile['video_codec'],
+      '-preset', profile['preset'],
+      '-crf', profile['crf'],
+  ]
+  if pix_fmt:
+    args += ['-pix_fmt', pix_fmt]
+  return args
+
+
+def audio_encoding_args(profile_name, output_video, audio_codec=None):
+  """Generates the output arguments encoding audio with a profile.
+
+  See encoding_args, of which this is the audio part.
+  """
+  profile = ENCODING_PROFILES[profile_name]
+  container = os.path.splitext(output_video)[1].lower()
+  audio_codecs = _H264_CONTAINERS.get(container, set())
+  if audio_codec and (audio_codecs is None or audio_codec in audio_codecs):
+    return ['-c:a', 'copy']
+  return ['-c:a', profile['audio_codec'], '-b:a', profile['audio_bitrate']]
+
+
+# The stream parameters segments must share to be concatenated without
+# re-encoding, as the output only keeps the first segment's decoder setup.
+_STREAM_PARAMETERS = (
+    'codec_name',
+    'profile',
+    'level',
+    'width',
+    'height',
+    'pix_fmt',
+    'sample_aspect_ratio',
+    'refs',
+)
+
+# libx264's names of the H.264 profiles, by ffprobe's names.
+_X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+
+
+def probe_video_stream(input_file, executable='ffprobe', keyframes=True):
+  """Probes the first video stream of a file for smart rendering.
+
+  Args:
+    input_file: the file to probe
+    executable: the full or relative path to the ffprobe executable
+    keyframes: whether to also list the stream's keyframes, which reads all
+      of its packets
+  Returns:
+    A dict with the stream's 'codec_name', 'profile', 'level', 'width',
+    'height', 'pix_fmt', 'sample_aspect_ratio', 'refs', 'frame_rate' (a
+    Fraction, or None if unknown), the file's 'duration' in seconds and the
+    sorted presentation times of its 'keyframes' (empty if not listed), or
+    None if the file has no video stream or can't be probed.
+  """
+  stream_args = [
+      executable,
+      '-v', 'error',
+      '-select_streams', 'v:0',
+      '-show_entries',
+      'stream=' + ','.join(_STREAM_PARAMETERS + ('avg_frame_rate',))
+      + ':format=duration',
+      '-of', 'json',
+      input_file,
+  ]
+  keyframe_args = [
+      executable,
+      '-v', 'error',
+      '-select_streams', 'v:0',
+      '-show_entries', 'packet=pts_time,flags',
+      '-of', 'csv=print_section=0',
+      input_file,
+  ]
+  RenderMetricsService.increment('subprocesses', 2 if keyframes else 1)
+  try:
+    info = json.loads(
+        subprocess.check_output(stream_args, stderr=subprocess.DEVNULL)
+    )
+    packets = ''
+    if keyframes:
+      packets = subprocess.check_output(
+          keyframe_args, stderr=subprocess.DEVNULL
+      ).decode('utf-8')
+  except (OSError, ValueError, subprocess.CalledProcessError) as e:
+    logging.warning('Could not probe video stream of %s: %s', input_file, e)
+    return None
+  if not info.get('streams'):
+    return None
+
+  keyframe_times = set()
+  for line in packets.splitlines():
+    pts_time, _, flags = line.partition(',')
+    if 'K' in flags and pts_time not in ('', 'N/A'):
+      keyframe_times.add(float(pts_time))
+  stream = info['streams'][0]
+  frame_rate = None
+  try:
+    frame_rate = fractions.Fraction(stream['avg_frame_rate'])
+  except (KeyError, ValueError, ZeroDivisionError):
+    pass
+  video_stream = {key: stream.get(key) for key in _STREAM_PARAMETERS}
+  video_stream.update({
+      'frame_rate': frame_rate or None,
+      'duration': float(info.get('format', {}).get('duration', 0)),
+      'keyframes': sorted(keyframe_times),
+  })
+  return video_stream
+
+
+def matching_video_args(video_stream):
+  """Generates libx264 arguments matching the parameters of an H.264 stream.
+
+  Segments encoded with these can be concatenated with segments stream-copied
+  from the probed video (see same_stream_parameters).
+
+  Args:
+    video_stream: the stream, from probe_video_stream
+  Returns:
+    A list of ffmpeg output arguments, or None if libx264 can't encode the
+    stream's profile.
+  """
+  profile = _X264_PROFILES.get(video_stream.get('profile'))
+  if video_stream.get('codec_name') != 'h264' or profile is None:
+    return None
+  args = ['-profile:v', profile]
+  if video_stream.get('level') and video_stream['level'] > 0:
+    args += ['-level:v', f'{video_stream["level"] / 10:g}']
+  if video_stream.get('refs'):
+    args += ['-x264-params', f'ref={video_stream["refs"]}']
+  return args
+
+
+def same_stream_parameters(video_stream, other_stream):
+  """Tells whether segments of two streams can be concatenated as-is."""
+  return all(
+      video_stream.get(key) == other_stream.get(key)
+      for key in _STREAM_PARAMETERS
+  )
+
+
+def plan_segments(windows, keyframes, duration, min_copy_duration=0):
+  """Splits a video at keyframes into ranges to render and ranges to copy.
+
+  Args:
+    windows: a list of (start, end) times where overlays are shown
+    keyframes: the sorted presentation times of the video's keyframes
+    duration: the duration of the video
+    min_copy_duration: the minimum total duration that must be copied for
+      the split to be worth it
+  Returns:
+    A list of (start, end, render) tuples covering the whole video, where
+    `render` tells whether the range must be rendered (it intersects a
+    window) or can be stream-copied, with copied ranges starting and ending
+    on keyframes. None if nothing can be copied.
+  """
+  if not keyframes or keyframes[0] > 0.001 or duration <= 0:
+    return None
+
+  dirty = []
+  for start, end in sorted(windows):
+    start = max(0.0, float(start))
+    end = min(float(duration), float(end))
+    if end < start:
+      continue
+    # Ranges start on the last keyframe at or before the window and end on
+    # the first keyframe after it, as overlays are enabled on both ends.
+    range_start = keyframes[bisect.bisect_right(keyframes, start) - 1]
+    next_keyframe = bisect.bisect_right(keyframes, end)
+    range_end = (
+        keyframes[next_keyframe] if next_keyframe < len(keyframes)
+        else float(duration)
+    )
+    if dirty and range_start <= dirty[-1][1]:
+      dirty[-1][1] = max(dirty[-1][1], range_end)
+    else:
+      dirty.append([range_start, range_end])
+
+  segments = []
+  position = 0.0
+  for start, end in dirty:
+    if start > position:
+      segments.append((position, start, False))
+    segments.append((start, end, True))
+    position = end
+  if position < duration:
+    segments.append((position, float(duration), False))
+
+  copied = sum(end - start for start, end, render in segments if not render)
+  if copied <= 0 or copied < min_copy_duration:
+    return None
+  return segments
+
+
+def plan_chunks(duration, count, frame_rate=None):
+  """Splits a video into chunks of about the same duration.
+
+  Args:
+    duration: the duration of the video
+    count: the number of chunks
+    frame_rate: optional frame rate (a Fraction) the chunk boundaries are
+      aligned to, so no frame is split between chunks
+  Returns:
+    A list of (start, end) tuples covering the whole video.
+  """
+  boundaries = [0.0]
+  for index in range(1, count):
+    boundary = duration * index / count
+    if frame_rate:
+      boundary = float(round(boundary * frame_rate) / frame_rate)
+    if boundary > boundaries[-1]:
+      boundaries.append(boundary)
+  boundaries.append(float(duration))
+  return list(zip(boundaries, boundaries[1:]))
+
+
+def copy_segment(
+    input_video,
+    start,
+    end,
+    output_video,
+    executable='ffmpeg',
+    timeout_s=None,
+    stall_timeout_s=None,
 ):
+  """Stream-copies the video of a keyframe-aligned range to an MPEG-TS file.
+
+  See execute_ffmpeg for the timeouts.
 
+  Raises:
+    FFMpegExecutionError: if the ffmpeg process returns an error
+  """
   args = [
-      executable, input_file, '-resize',
-      '%dx%d%s' % (width, height, '>' if keep_ratio else '!'), '-quality', '95',
-      '-depth', '8', output_file
+      executable,
+      '-ss', start,
+      '-to', end,
+      '-i', input_video,
+      '-map', '0:v:0',
+      '-c', 'copy',
+      '-f', 'mpegts',
+      '-y', output_video,
   ]
+  args = [str(arg) for arg in args]
+  logging.debug('Running ffmpeg with args: %s', ' '.join(args))
+  with RenderMetricsService.span('ffmpeg_copy', duration_s=end - start):
+    return execute_ffmpeg(args, timeout_s, stall_timeout_s)
 
-  logging.debug('Running imagemagick to resize image with args:')
-  logging.debug(' '.join(args))
 
-  # Returns results or raises an exception
+def concat_segments(
+    segments,
+    audio_input,
+    out_audio,
+    output_video,
+    output_args=None,
+    executable='ffmpeg',
+    timeout_s=None,
+    stall_timeout_s=None,
+):
+  """Concatenates video segments without re-encoding them, adding audio.
+
+  Args:
+    segments: the MPEG-TS video segments, in order
+    audio_input: the file to take the audio from, or None for no audio
+    out_audio: the audio stream of `audio_input` to map (e.g. '1:a?')
+    output_video: output video file name
+    output_args: optional output arguments for the audio (see
+      audio_encoding_args)
+    executable: the full or relative path to the ffmpeg executable
+    timeout_s: optional wall-clock limit, see execute_ffmpeg
+    stall_timeout_s: optional limit without progress, see execute_ffmpeg
+  Returns:
+    The output of the ffmpeg process
+  Raises:
+    FFMpegExecutionError: if the ffmpeg process returns an error
+  """
+  (fd, list_file) = tempfile.mkstemp(prefix='pva_lite_', suffix='.txt')
+  with os.fdopen(fd, 'w') as f:
+    for segment in segments:
+      escaped = str(segment).replace("'", "'\\''")
+      f.write(f"file '{escaped}'\n")
+
+  args = [executable, '-f', 'concat', '-safe', '0', '-i', list_file]
+  if audio_input:
+    args += ['-i', audio_input, '-map', '0:v', '-map', out_audio]
+  else:
+    args += ['-map', '0:v']
+  args += ['-c:v', 'copy'] + (output_args or [])
+  args += ['-shortest', '-y', output_video]
+  args = [str(arg) for arg in args]
+  logging.info('Running ffmpeg with args:')
+  logging.info(' '.join(args))
   try:
-    return subprocess.check_output(args, stderr=subprocess.STDOUT)
-  except subprocess.CalledProcessError as e:
-    raise FFMpegExecutionError(args, e.output) from e
+    with RenderMetricsService.span('ffmpeg_concat', segments=len(segments)):
+      return execute_ffmpeg(args, timeout_s, stall_timeout_s)
+  finally:
+    os.remove(list_file)
 
 
 def run_ffmpeg(
@@ -434,6 +1358,9 @@ def run_ffmpeg(
     input_video,
     output_video,
     executable='ffmpeg',
+    output_args=None,
+    timeout_s=None,
+    stall_timeout_s=None,
 ):
   """Runs the ffmpeg executable for the given input and filter spec.
 
@@ -443,34 +1370,265 @@ def run_ffmpeg(
     input_video: main input video file name
     output_video: output video file name
     executable: the full or relative path to the ffmpeg executable
+    output_args: optional output arguments, e.g. from encoding_args
+    timeout_s: optional wall-clock limit, see execute_ffmpeg
+    stall_timeout_s: optional limit without progress, see execute_ffmpeg
   Returns:
     The output of the ffmpeg process
   Raises:
     VideoGenerationError: if the ffmpeg process returns an error
   """
+  return run_ffmpeg_batch(
+      [(out_video, out_audio, output_video, output_args or [])],
+      assets_args,
+      filters,
+      input_video,
+      executable,
+      timeout_s=timeout_s,
+      stall_timeout_s=stall_timeout_s,
+  )
+
+
+def split_filter(count, prefix='base'):
+  """Generates a filter splitting the template video into `count` streams.
+
+  Returns:
+    A tuple of the filter specification and the names of the split streams.
+  """
+  streams = [f'{prefix}{i}' for i in range(count)]
+  return (
+      '[0:v] split=%d %s' % (count, ''.join(f'[{s}]' for s in streams)),
+      streams,
+  )
+
+
+def run_ffmpeg_batch(
+    outputs,
+    assets_args,
+    filters,
+    input_video,
+    executable='ffmpeg',
+    input_video_args=None,
+    timeout_s=None,
+    stall_timeout_s=None,
+    progress_callback=None,
+):
+  """Runs a single ffmpeg process writing one or more output videos.
+
+  Rendering several videos from the same template in one process decodes the
+  template only once (see split_filter).
 
-  # Setup command line arguments
-  extra_end_args = []
-  extra_end_args += ['-map', out_video]
-  extra_end_args += ['-map', out_audio]
-  extra_end_args += ['-shortest', '-y']  # , '-c:a', 'libfdk_aac']
+  Args:
+    outputs: a list of (video stream, audio stream or None, output file name)
+      tuples, optionally followed by a list of output arguments (see
+      encoding_args)
+    assets_args: a list of '-i' input arguments for the images
+    filters: complex filter specification
+    input_video: main input video file name
+    executable: the full or relative path to the ffmpeg executable
+    input_video_args: optional input arguments for the main input video,
+      e.g. to only render a range of it
+    timeout_s: optional wall-clock limit, see execute_ffmpeg
+    stall_timeout_s: optional limit without progress, see execute_ffmpeg
+    progress_callback: optional function called with each progress report,
+      see execute_ffmpeg
+  Returns:
+    The output of the ffmpeg process
+  Raises:
+    VideoGenerationError: if the ffmpeg process returns an error
+  """
 
-  args = [executable, '-i', input_video] + assets_args
+  args = [executable] + (input_video_args or []) + ['-i', input_video]
+  args += assets_args
 
   if filters:
     args += ['-filter_complex', '%s' % ';'.join(filters)]
 
-  args += extra_end_args
-  args += [output_video]
+  # Setup command line arguments, which apply to the output file following them
+  for out_video, out_audio, output_video, *output_args in outputs:
+    args += ['-map', out_video]
+    if out_audio:
+      args += ['-map', out_audio]
+    args += ['-shortest', '-y']
+    for extra_args in output_args:
+      args += extra_args
+    args += [output_video]
+
   args = [str(arg) for arg in args]
   logging.info('Running ffmpeg with args:')
   logging.info(' '.join(args))
 
   # Returns results or raises an exception
+  with RenderMetricsService.span(
+      'ffmpeg',
+      outputs=len(outputs),
+      inputs=assets_args.count('-i') + 1,
+      filters=len(filters or []),
+      filter_graph_bytes=len(';'.join(filters or [])),
+  ):
+    return execute_ffmpeg(
+        args, timeout_s, stall_timeout_s, progress_callback
+    )
+
+
+# Lines of ffmpeg's stderr kept to report errors with.
+STDERR_TAIL_LINES = 200
+# Time given to ffmpeg to exit after being asked to stop, before killing it.
+_TERMINATE_GRACE_S = 5
+# Minimum interval between two logged progress reports.
+_PROGRESS_LOG_INTERVAL_S = 10
+
+
+def execute_ffmpeg(
+    args, timeout_s=None, stall_timeout_s=None, progress_callback=None
+):
+  """Runs ffmpeg, following its progress and keeping the tail of its stderr.
+
+  ffmpeg reports its progress on stdout (see `-progress`), which is parsed as
+  it runs and logged periodically. Only the last STDERR_TAIL_LINES lines of
+  its stderr are kept, to report errors with. ffmpeg is stopped, and killed if
+  it doesn't exit, when it runs out of time or stalls.
+
+  Args:
+    args: the ffmpeg command line, starting with the executable
+    timeout_s: optional limit on the run's wall time, in seconds
+    stall_timeout_s: optional limit on the time ffmpeg may go without making
+      progress (encoding frames or advancing its output), in seconds
+    progress_callback: optional function called with each progress report, a
+      dict of the frame, fps, speed, out_time_s and total_size reported
+  Returns:
+    The last lines of ffmpeg's stderr
+  Raises:
+    FFMpegTimeoutError: if ffmpeg ran out of time or stalled
+    FFMpegExecutionError: if the ffmpeg process returns an error
+  """
+  args = [args[0], '-nostats', '-progress', 'pipe:1'] + list(args[1:])
+  RenderMetricsService.increment('subprocesses')
+  process = subprocess.Popen(
+      args,
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+  )
+  stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+  stderr_reader = threading.Thread(
+      target=stderr_tail.extend, args=(process.stderr,), daemon=True
+  )
+  stderr_reader.start()
+  watchdog = _FFmpegWatchdog(process, timeout_s, stall_timeout_s)
+  watchdog.start()
+
+  progress = {}
   try:
-    return subprocess.check_output(args, stderr=subprocess.STDOUT)
-  except subprocess.CalledProcessError as e:
-    raise FFMpegExecutionError(' '.join(args), e.output) from e
+    report = {}
+    last_logged = time.monotonic()
+    for line in process.stdout:
+      key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+      if key != 'progress':
+        report[key] = value
+        continue
+      # A report ends with its progress (continue or end).
+      previous, progress = progress, _parse_progress(report)
+      report = {}
+      if (progress.get('frame'), progress.get('out_time_s')) != (
+          previous.get('frame'), previous.get('out_time_s')
+      ):
+        watchdog.progressed()
+      if progress_callback:
+        progress_callback(progress)
+      if time.monotonic() - last_logged >= _PROGRESS_LOG_INTERVAL_S:
+        last_logged = time.monotonic()
+        logging.info('ffmpeg progress: %s', progress)
+    returncode = process.wait()
+  except BaseException:
+    _stop_process(process)
+    raise
+  finally:
+    watchdog.stop()
+    stderr_reader.join()
+    process.stdout.close()
+    process.stderr.close()
+
+  RenderMetricsService.increment('ffmpeg_frames', progress.get('frame', 0))
+  output = b''.join(stderr_tail)
+  if watchdog.reason:
+    RenderMetricsService.increment('ffmpeg_timeouts')
+    raise FFMpegTimeoutError(' '.join(args), output, watchdog.reason)
+  if returncode:
+    raise FFMpegExecutionError(' '.join(args), output)
+  return output
+
+
+def _parse_progress(report):
+  """Converts the values of an ffmpeg progress report, skipping N/A ones."""
+  conversions = {
+      'frame': ('frame', int),
+      'fps': ('fps', float),
+      'speed': ('speed', lambda v: float(v.rstrip('x'))),
+      'out_time_us': ('out_time_s', lambda v: int(v) / 1e6),
+      'total_size': ('total_size', int),
+  }
+  progress = {}
+  for key, value in report.items():
+    if key in conversions:
+      name, convert = conversions[key]
+      try:
+        progress[name] = convert(value)
+      except ValueError:
+        pass
+  return progress
+
+
+def _stop_process(process):
+  """Asks a process to exit, killing it if it doesn't in time."""
+  if process.poll() is not None:
+    return
+  process.terminate()
+  try:
+    process.wait(_TERMINATE_GRACE_S)
+  except subprocess.TimeoutExpired:
+    process.kill()
+    process.wait()
+
+
+class _FFmpegWatchdog(threading.Thread):
+  """Stops an ffmpeg process running out of time or making no progress."""
+
+  def __init__(self, process, timeout_s=None, stall_timeout_s=None):
+    super().__init__(daemon=True)
+    self.process = process
+    self.timeout_s = timeout_s
+    self.stall_timeout_s = stall_timeout_s
+    self.reason = None
+    self._started_at = time.monotonic()
+    self._progressed_at = self._started_at
+    self._stopped = threading.Event()
+
+  def progressed(self):
+    self._progressed_at = time.monotonic()
+
+  def run(self):
+    if not self.timeout_s and not self.stall_timeout_s:
+      return
+    while not self._stopped.wait(1):
+      now = time.monotonic()
+      if self.timeout_s and now - self._started_at > self.timeout_s:
+        self.reason = f'ffmpeg ran for more than {self.timeout_s}s'
+      elif (
+          self.stall_timeout_s
+          and now - self._progressed_at > self.stall_timeout_s
+      ):
+        self.reason = (
+            f'ffmpeg made no progress for {self.stall_timeout_s}s'
+        )
+      if self.reason:
+        logging.error('%s, stopping it.', self.reason)
+        _stop_process(self.process)
+        return
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
 
 
 class FFMpegExecutionError(Exception):
@@ -482,3 +1640,14 @@ class FFMpegExecutionError(Exception):
 
   def __str__(self):
     return repr(self.ffmpeg_output)
+
+
+class FFMpegTimeoutError(FFMpegExecutionError):
+  """Raised when ffmpeg was stopped for running too long or stalling."""
+
+  def __init__(self, ffmpeg_args, ffmpeg_output, reason):
+    super(FFMpegTimeoutError, self).__init__(ffmpeg_args, ffmpeg_output)
+    self.reason = reason
+
+  def __str__(self):
+    return f'{self.reason}: {self.ffmpeg_output!r}'
@@ -0,0 +1,290 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite render metrics service.
+
+This module times the stages of a render as spans and counts what they do
+(bytes moved, subprocesses spawned...), so that each message can be logged as
+a single structured record and, optionally, exported as OpenTelemetry spans.
+
+Spans and counters go to the metrics recorded in the current context (see
+`recording`) and are dropped when there are none, so code can be instrumented
+whether or not it runs as part of a render.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+_current_metrics = contextvars.ContextVar('render_metrics', default=None)
+_current_span = contextvars.ContextVar('render_span', default=None)
+
+# OpenTelemetry is set up once per process, on first use.
+_tracer_provider = None
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+class Span:
+  """A timed stage of a render.
+
+  Attributes:
+    name: The name of the stage.
+    parent: The name of the stage it is part of, or None.
+    start_s: When the stage started, relative to the start of the render.
+    duration_s: How long the stage took, or None while it runs.
+    attributes: Details of the stage, e.g. sizes and counts. Counters
+      incremented during the stage are added once it ends.
+  """
+
+  def __init__(
+      self,
+      name: str,
+      parent: Optional[str] = None,
+      start_s: float = 0,
+      attributes: Optional[dict[str, Any]] = None,
+  ):
+    self.name = name
+    self.parent = parent
+    self.start_s = start_s
+    self.duration_s = None
+    self.attributes = attributes or {}
+
+  def set(self, key: str, value: Any) -> None:
+    self.attributes[key] = value
+
+  def as_dict(self) -> dict[str, Any]:
+    return {
+        'name': self.name,
+        'parent': self.parent,
+        'start_s': round(self.start_s, 6),
+        'duration_s': round(self.duration_s or 0, 6),
+        'attributes': self.attributes,
+    }
+
+
+class RenderMetrics:
+  """The spans and counters recorded while handling a message.
+
+  Attributes:
+    tracer: The OpenTelemetry tracer to also export spans with, or None.
+  """
+
+  def __init__(self, tracer: Optional[Any] = None):
+    self.tracer = tracer
+    self._start = time.perf_counter()
+    self._spans = []
+    self._counters = collections.Counter()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def span(self, name: str, **attributes) -> Iterator[Span]:
+    """Times the enclosed stage of the render.
+
+    Args:
+      name: The name of the stage.
+      **attributes: Details of the stage, more can be set on the span.
+
+    Yields:
+      The span of the stage.
+    """
+    parent = _current_span.get()
+    span = Span(
+        name,
+        parent.name if parent else None,
+        time.perf_counter() - self._start,
+        attributes,
+    )
+    counters_before = self.counters()
+    token = _current_span.set(span)
+    with contextlib.ExitStack() as stack:
+      otel_span = None
+      if self.tracer is not None:
+        otel_span = stack.enter_context(
+            self.tracer.start_as_current_span(name)
+        )
+      start = time.perf_counter()
+      try:
+        yield span
+      except Exception as e:
+        span.set('error', type(e).__name__)
+        raise
+      finally:
+        span.duration_s = time.perf_counter() - start
+        for counter, value in self.counters().items():
+          if value != counters_before.get(counter, 0):
+            span.attributes.setdefault(
+                counter, value - counters_before.get(counter, 0)
+            )
+        _current_span.reset(token)
+        with self._lock:
+          self._spans.append(span)
+        if otel_span is not None:
+          otel_span.set_attributes(_otel_attributes(span.attributes))
+
+  def increment(self, counter: str, value: int = 1) -> None:
+    with self._lock:
+      self._counters[counter] += value
+
+  def counters(self) -> dict[str, int]:
+    with self._lock:
+      return dict(self._counters)
+
+  def as_dict(self) -> dict[str, Any]:
+    """Returns the metrics as a JSON-serializable dictionary.
+
+    Besides the spans themselves, `stages` sums the time spent in spans of
+    the same name, e.g. all the ffmpeg runs of a message.
+    """
+    with self._lock:
+      spans = sorted(self._spans, key=lambda s: s.start_s)
+      counters = dict(self._counters)
+    stages = {}
+    for span in spans:
+      stage = stages.setdefault(span.name, {'count': 0, 'duration_s': 0})
+      stage['count'] += 1
+      stage['duration_s'] = round(
+          stage['duration_s'] + (span.duration_s or 0), 6
+      )
+    return {
+        'duration_s': round(time.perf_counter() - self._start, 6),
+        'stages': stages,
+        'counters': counters,
+        'spans': [span.as_dict() for span in spans],
+    }
+
+  def log(self, message: str, **fields) -> None:
+    """Logs the metrics as a single structured record.
+
+    Args:
+      message: The message of the log entry.
+      **fields: Other fields to add to the record, e.g. the output paths.
+    """
+    record = dict(fields, **self.as_dict())
+    logging.info(
+        '%s (%.3fs): %s',
+        message,
+        record['duration_s'],
+        ', '.join(
+            f'{name} {stage["duration_s"]:.3f}s'
+            for name, stage in record['stages'].items()
+        ),
+        extra={'json_fields': record},
+    )
+
+
+@contextlib.contextmanager
+def recording(metrics: RenderMetrics) -> Iterator[RenderMetrics]:
+  """Records spans and counters of the enclosed code into `metrics`."""
+  token = _current_metrics.set(metrics)
+  try:
+    yield metrics
+  finally:
+    _current_metrics.reset(token)
+
+
+def current() -> Optional[RenderMetrics]:
+  """Returns the metrics being recorded in the current context, if any."""
+  return _current_metrics.get()
+
+
+def span(name: str, **attributes) -> contextlib.AbstractContextManager[Span]:
+  """Times the enclosed stage, see `RenderMetrics.span`.
+
+  When no metrics are being recorded, the span is simply discarded.
+  """
+  metrics = current()
+  if metrics is None:
+    return contextlib.nullcontext(Span(name, attributes=attributes))
+  return metrics.span(name, **attributes)
+
+
+def increment(counter: str, value: int = 1) -> None:
+  """Increments a counter of the metrics being recorded, if any."""
+  metrics = current()
+  if metrics is not None:
+    metrics.increment(counter, value)
+
+
+def in_context(function: Callable[..., Any]) -> Callable[..., Any]:
+  """Binds a function to a copy of the current context.
+
+  Threads don't inherit the context they are started from, so tasks submitted
+  to an executor must be bound to it to record into the same metrics. Bind
+  each task separately, as a context can only be entered by one thread.
+
+  Args:
+    function: The function to run in another thread.
+
+  Returns:
+    The function, running in a copy of the current context.
+  """
+  return functools.partial(contextvars.copy_context().run, function)
+
+
+def get_tracer() -> Optional[Any]:
+  """Returns the OpenTelemetry tracer to export spans with, creating it once.
+
+  Spans are exported in batches over OTLP, configured with the standard
+  OTEL_EXPORTER_OTLP_* environment variables (e.g. to a local collector).
+  OpenTelemetry is optional and imported lazily: if its SDK or OTLP exporter
+  isn't installed, spans are only logged.
+
+  Returns:
+    The tracer, or None if OpenTelemetry isn't available.
+  """
+  global _tracer, _tracer_provider
+  with _tracer_lock:
+    if _tracer is None:
+      try:
+        # pylint: disable=g-import-not-at-top
+        from opentelemetry.exporter.otlp.proto.grpc import trace_exporter
+        from opentelemetry.sdk import resources
+        from opentelemetry.sdk import trace
+        from opentelemetry.sdk.trace import export
+        # pylint: enable=g-import-not-at-top
+      except ImportError as e:
+        logging.warning('Not exporting render spans: %s', e)
+        _tracer = False
+      else:
+        _tracer_provider = trace.TracerProvider(
+            resource=resources.Resource.create(
+                {'service.name': 'pva-lite-runner'}
+            )
+        )
+        _tracer_provider.add_span_processor(
+            export.BatchSpanProcessor(trace_exporter.OTLPSpanExporter())
+        )
+        _tracer = _tracer_provider.get_tracer('pva_lite')
+    return _tracer or None
+
+
+def flush_spans(timeout_s: float = 5) -> None:
+  """Exports pending OpenTelemetry spans, before the instance is idled."""
+  if _tracer_provider is not None:
+    _tracer_provider.force_flush(int(timeout_s * 1000))
+
+
+def _otel_attributes(attributes: dict[str, Any]) -> dict[str, Any]:
+  """Keeps the attributes OpenTelemetry accepts, stringifying the others."""
+  return {
+      key: value if isinstance(value, (bool, int, float, str)) else str(value)
+      for key, value in attributes.items()
+      if value is not None
+  }
@@ -17,20 +17,290 @@
 This module provides methods for interacting with Google Cloud Storage.
 """
 
+import collections
+import hashlib
 import logging
 import os
 import pathlib
-from typing import Optional, Union
-
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple, Union
+
+import render_metrics as RenderMetricsService
+from google.api_core import exceptions
 from google.cloud import storage
 from google.cloud.storage import transfer_manager
 
 
+class LocalFileCache:
+  """A size-bounded, LRU-evicted cache of files on local disk.
+
+  Entries are addressed by an arbitrary string key (e.g. a GCS path plus its
+  generation) and stored under a digest of that key, so the cache survives
+  across invocations served by the same (warm) instance. All methods are safe
+  to call from multiple threads.
+
+  Attributes:
+    cache_dir: The directory holding the cached files.
+    max_bytes: The disk budget; least recently used entries are evicted once
+      the cached files exceed it. A budget of 0 disables the cache.
+    hits: The number of successful lookups.
+    misses: The number of failed lookups.
+    bytes_saved: The total size of the files served from the cache.
+  """
+
+  _STAGING_PREFIX = '.staging_'
+  # Staging files older than this were left by a crashed process; younger ones
+  # may still be written to by another process sharing the directory.
+  _STALE_STAGING_S = 24 * 60 * 60
+
+  def __init__(self, cache_dir: str, max_bytes: int):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.bytes_saved = 0
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._total_bytes = 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Picks up entries left behind by previous invocations, oldest first, and
+    # drops anything a crashed invocation left half-written.
+    existing = []
+    for entry in os.scandir(cache_dir):
+      if not entry.is_file():
+        continue
+      if entry.name.startswith(self._STAGING_PREFIX):
+        try:
+          if time.time() - entry.stat().st_mtime > self._STALE_STAGING_S:
+            os.remove(entry.path)
+        except FileNotFoundError:
+          pass
+      else:
+        existing.append(entry)
+    existing.sort(key=lambda entry: entry.stat().st_mtime)
+    with self._lock:
+      for entry in existing:
+        self._entries[entry.name] = entry.stat().st_size
+        self._total_bytes += self._entries[entry.name]
+      self._evict()
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_bytes > 0
+
+  def get(self, key: str) -> Optional[str]:
+    """Returns the path of the cached file for `key`, or None if missing.
+
+    The file may be evicted or replaced by another thread at any time, so use
+    `copy_to` or `read_bytes` to get at its contents.
+    """
+    with self._lock:
+      return self._lookup(key)
+
+  def contains(self, key: str) -> bool:
+    """Returns whether `key` is cached, without counting a hit or a miss.
+
+    For callers that only know whether an entry is usable after checking it,
+    e.g. revalidating it; see `count_miss`.
+    """
+    with self._lock:
+      return self._lookup(key, count=False) is not None
+
+  def count_miss(self) -> None:
+    """Counts a miss for an entry checked with `contains` but not used."""
+    with self._lock:
+      self.misses += 1
+
+  def copy_to(self, key: str, destination_path: str) -> bool:
+    """Copies the cached file for `key` to `destination_path`, if there is one.
+
+    The entry is pinned with a hard link while it is copied, so it can be
+    evicted or replaced concurrently without affecting the copy.
+
+    Args:
+      key: The key of the file to copy.
+      destination_path: Where to copy the file to.
+
+    Returns:
+      Whether the file was in the cache.
+    """
+    with self._lock:
+      path = self._lookup(key)
+      if path is None:
+        return False
+      pin_path = os.path.join(
+          self.cache_dir, f'{self._STAGING_PREFIX}pin_{uuid.uuid4().hex}'
+      )
+      try:
+        os.link(path, pin_path)
+      except OSError:
+        # No hard links on this filesystem, so copies while holding the lock.
+        shutil.copyfile(path, destination_path)
+        return True
+    try:
+      shutil.copyfile(pin_path, destination_path)
+    finally:
+      os.remove(pin_path)
+    return True
+
+  def read_bytes(self, key: str, count: bool = True) -> Optional[bytes]:
+    """Returns the contents of the cached file for `key`, or None if missing.
+
+    Meant for small entries, as the file is read while holding the lock.
+
+    Args:
+      key: The key of the file to read.
+      count: Whether to count the lookup as a hit or a miss, e.g. not for
+        metadata kept next to an entry.
+    """
+    with self._lock:
+      path = self._lookup(key, count)
+      if path is None:
+        return None
+      with open(path, 'rb') as f:
+        return f.read()
+
+  def _lookup(self, key: str, count: bool = True) -> Optional[str]:
+    # Must be called with the lock held.
+    name = _digest(key)
+    path = os.path.join(self.cache_dir, name)
+    if name in self._entries and not os.path.exists(path):
+      self._total_bytes -= self._entries.pop(name)
+    if name not in self._entries:
+      if count:
+        self.misses += 1
+      return None
+    self._entries.move_to_end(name)
+    os.utime(path)
+    if count:
+      self.hits += 1
+      self.bytes_saved += self._entries[name]
+    return path
+
+  def put_file(self, key: str, source_path: str) -> Optional[str]:
+    """Moves a file into the cache under `key` and returns its cached path.
+
+    Args:
+      key: The key to store the file under.
+      source_path: The file to move into the cache.
+
+    Returns:
+      The path of the cached file, or None (leaving `source_path` untouched)
+      if the cache is disabled or the file is larger than the whole budget.
+    """
+    size = os.path.getsize(source_path)
+    if not self.enabled or size > self.max_bytes:
+      return None
+
+    name = _digest(key)
+    path = os.path.join(self.cache_dir, name)
+    with self._lock:
+      shutil.move(source_path, path)
+      if name in self._entries:
+        self._total_bytes -= self._entries.pop(name)
+      self._entries[name] = size
+      self._total_bytes += size
+      self._evict()
+    return path
+
+  def staging_path(self) -> str:
+    """Returns a fresh path inside the cache dir to write a new entry to.
+
+    Staging on the same filesystem lets `put_file` move entries atomically
+    instead of copying them.
+    """
+    fd, path = tempfile.mkstemp(prefix=self._STAGING_PREFIX,
+                                dir=self.cache_dir)
+    os.close(fd)
+    return path
+
+  def stats(self) -> Dict[str, int]:
+    """Returns the cache counters."""
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'bytes_saved': self.bytes_saved,
+          'entries': len(self._entries),
+          'bytes_used': self._total_bytes,
+      }
+
+  def _evict(self) -> None:
+    # Must be called with the lock held. The most recently used entry is never
+    # evicted, as put_file guarantees it fits in the budget on its own.
+    while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+      name, size = self._entries.popitem(last=False)
+      self._total_bytes -= size
+      try:
+        os.remove(os.path.join(self.cache_dir, name))
+      except FileNotFoundError:
+        pass
+      logging.debug('CACHE - Evicted "%s" from "%s".', name, self.cache_dir)
+
+
+def _digest(key: str) -> str:
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def file_digest(file_path: str) -> str:
+  """Returns the sha256 hex digest of a file's contents.
+
+  Digests are memoized per path, size and modification time, so assets used
+  by many placements are only hashed once. Only the most recently used
+  _FILE_DIGESTS_MAX_ENTRIES are kept, as long-lived workers see new paths
+  with every message.
+  """
+  stat = os.stat(file_path)
+  key = (file_path, stat.st_size, stat.st_mtime_ns)
+  with _file_digests_lock:
+    if key in _file_digests:
+      _file_digests.move_to_end(key)
+      return _file_digests[key]
+  sha = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      sha.update(chunk)
+  digest = sha.hexdigest()
+  with _file_digests_lock:
+    _file_digests[key] = digest
+    while len(_file_digests) > _FILE_DIGESTS_MAX_ENTRIES:
+      _file_digests.popitem(last=False)
+  return digest
+
+
+_FILE_DIGESTS_MAX_ENTRIES = 4096
+_file_digests: collections.OrderedDict[Tuple[str, int, int], str] = (
+    collections.OrderedDict()
+)
+_file_digests_lock = threading.Lock()
+
+
+# Creating a client resolves credentials and opens an HTTP session, so all
+# calls made by the process share one.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> storage.Client:
+  """Returns the storage client shared by this process, creating it once."""
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = storage.Client()
+    return _client
+
+
 def download_gcs_file(
     filepath: str,
     bucket_name: str,
     output_dir: Optional[str] = None,
     fetch_contents: bool = False,
+    cache: Optional[LocalFileCache] = None,
 ) -> Union[Optional[str], Optional[bytes]]:
   """Downloads a file from the given GCS bucket and returns its path.
 
@@ -41,18 +311,21 @@ def download_gcs_file(
       fetch_contents is False, this will cause an error.
     fetch_contents: Whether to fetch the file contents instead of writing to a
       file.
+    cache: Optional local cache to serve the file from. Entries are keyed by
+      bucket, path and generation, so an overwritten file is fetched again.
 
   Returns:
     The retrieved file path or contents based on `fetch_contents`, or None if
     the file was not found.
   """
-  storage_client = storage.Client()
+  storage_client = get_client()
   bucket = storage_client.bucket(bucket_name)
 
-  blob = bucket.blob(filepath)
+  # Fetches the metadata (incl. generation) and checks existence in one call.
+  blob = bucket.get_blob(filepath)
   result = None
 
-  if not blob.exists():
+  if blob is None:
     logging.warning(
         'DOWNLOAD - Could not find file "%s" in bucket "%s".',
         filepath,
@@ -61,6 +334,7 @@ def download_gcs_file(
   else:
     if fetch_contents:
       result = blob.download_as_bytes()
+      RenderMetricsService.increment('gcs_download_bytes', len(result))
     else:
       # Ensure output_dir is provided if not fetching contents
       if output_dir is None:
@@ -77,8 +351,13 @@ def download_gcs_file(
       # Create the local directory structure if it doesn't exist
       os.makedirs(destination_directory, exist_ok=True)
 
-      # Now download the file; the directory is guaranteed to exist
-      blob.download_to_filename(destination_file_name)
+      if cache is not None and cache.enabled:
+        _download_through_cache(blob, bucket_name, destination_file_name,
+                                cache)
+      else:
+        # Now download the file; the directory is guaranteed to exist
+        blob.download_to_filename(destination_file_name)
+        RenderMetricsService.increment('gcs_download_bytes', blob.size or 0)
       result = destination_file_name
 
     logging.info(
@@ -89,11 +368,39 @@ def download_gcs_file(
   return result
 
 
+def _download_through_cache(
+    blob: storage.Blob,
+    bucket_name: str,
+    destination_file_name: str,
+    cache: LocalFileCache,
+) -> None:
+  """Copies a blob to the destination, downloading it only on a cache miss."""
+  key = f'gs://{bucket_name}/{blob.name}#{blob.generation}'
+  # Callers may modify their copy in place (e.g. resizing), so never hand out
+  # the cached file itself.
+  if cache.copy_to(key, destination_file_name):
+    logging.info('DOWNLOAD - Cache hit for "%s".', key)
+    RenderMetricsService.increment('gcs_cache_hits')
+    return
+
+  staging_path = cache.staging_path()
+  try:
+    blob.download_to_filename(staging_path)
+  except Exception:
+    os.remove(staging_path)
+    raise
+  RenderMetricsService.increment('gcs_download_bytes', blob.size or 0)
+  shutil.copyfile(staging_path, destination_file_name)
+  if cache.put_file(key, staging_path) is None:
+    os.remove(staging_path)
+
+
 def upload_gcs_file(
     file_path: str,
     destination_file_name: str,
     bucket_name: str,
     overwrite: bool = False,
+    metadata: Optional[Dict[str, str]] = None,
 ) -> None:
   """Uploads a file to the given GCS bucket.
 
@@ -103,16 +410,22 @@ def upload_gcs_file(
     bucket_name: The name of the bucket to upload the file to.
     overwrite: If True, allows overwriting an existing file in GCS.
                If False (default), fails if the destination blob already exists.
+    metadata: Optional custom metadata to set on the uploaded file.
   """
-  storage_client = storage.Client()
+  storage_client = get_client()
   bucket = storage_client.bucket(bucket_name)
 
   blob = bucket.blob(destination_file_name)
+  if metadata:
+    blob.metadata = metadata
 
   gen_match = None if overwrite else 0
 
   try:
-    blob.upload_from_filename(file_path, if_generation_match=gen_match)
+    with RenderMetricsService.span(
+        'upload', bytes=os.path.getsize(file_path)
+    ):
+      blob.upload_from_filename(file_path, if_generation_match=gen_match)
     logging.info(
         'UPLOAD - Uploaded "%s" to "%s" in bucket "%s".',
         file_path,
@@ -131,6 +444,121 @@ def upload_gcs_file(
     raise
 
 
+def upload_gcs_file_once(
+    file_path: str, destination_file_name: str, bucket_name: str
+) -> bool:
+  """Uploads a file to the given GCS bucket, unless it already exists there.
+
+  Meant for content-addressed files several instances may write at once, so
+  losing that race is expected and not logged as an error.
+
+  Args:
+    file_path: The path of the file to upload.
+    destination_file_name: The name of the file to upload as.
+    bucket_name: The name of the bucket to upload the file to.
+
+  Returns:
+    Whether the file was uploaded, False if it already existed.
+  """
+  blob = get_client().bucket(bucket_name).blob(destination_file_name)
+  try:
+    blob.upload_from_filename(file_path, if_generation_match=0)
+  except exceptions.PreconditionFailed:
+    return False
+  logging.info(
+      'UPLOAD - Uploaded "%s" to "%s" in bucket "%s".',
+      file_path,
+      destination_file_name,
+      bucket_name,
+  )
+  return True
+
+
+def upload_gcs_contents(
+    contents: Union[str, bytes],
+    destination_file_name: str,
+    bucket_name: str,
+) -> None:
+  """Writes the given contents to a file in the given GCS bucket.
+
+  Args:
+    contents: The contents to write.
+    destination_file_name: The name of the file to write, overwritten if it
+      exists.
+    bucket_name: The name of the bucket to write the file to.
+  """
+  storage_client = get_client()
+  bucket = storage_client.bucket(bucket_name)
+  bucket.blob(destination_file_name).upload_from_string(contents)
+  logging.info(
+      'UPLOAD - Wrote "%s" in bucket "%s".', destination_file_name, bucket_name
+  )
+
+
+def get_gcs_file_generation(filepath: str, bucket_name: str) -> Optional[int]:
+  """Returns the generation of a file in GCS, or None if it does not exist."""
+  storage_client = get_client()
+  blob = storage_client.bucket(bucket_name).get_blob(filepath)
+  return blob.generation if blob is not None else None
+
+
+def copy_gcs_file(
+    source_file_name: str,
+    destination_file_name: str,
+    bucket_name: str,
+    overwrite: bool = False,
+    metadata_match: Optional[Dict[str, str]] = None,
+    metadata: Optional[Dict[str, str]] = None,
+) -> bool:
+  """Copies a file within the given GCS bucket, without downloading it.
+
+  Args:
+    source_file_name: The name of the file to copy.
+    destination_file_name: The name to copy the file to.
+    bucket_name: The name of the bucket holding the file.
+    overwrite: If True, allows overwriting an existing file in GCS.
+               If False (default), fails if the destination blob already exists.
+    metadata_match: Optional custom metadata the source must have for it to be
+      copied.
+    metadata: Optional custom metadata to add to the copy.
+
+  Returns:
+    Whether the file was copied, i.e. the source exists and matches.
+  """
+  storage_client = get_client()
+  bucket = storage_client.bucket(bucket_name)
+
+  blob = bucket.get_blob(source_file_name)
+  if blob is None:
+    return False
+  for key, value in (metadata_match or {}).items():
+    if (blob.metadata or {}).get(key) != value:
+      return False
+  if source_file_name != destination_file_name:
+    blob = bucket.copy_blob(
+        blob,
+        bucket,
+        destination_file_name,
+        if_generation_match=None if overwrite else 0,
+    )
+  if metadata and any(
+      (blob.metadata or {}).get(key) != value
+      for key, value in metadata.items()
+  ):
+    blob.metadata = metadata
+    blob.patch()
+  if source_file_name == destination_file_name:
+    return True
+
+  logging.info(
+      'COPY - Copied "%s" to "%s" in bucket "%s".',
+      source_file_name,
+      destination_file_name,
+      bucket_name,
+  )
+  return True
+
+
 def upload_gcs_dir(
     source_directory: str,
     bucket_name: str,
@@ -143,7 +571,7 @@ def upload_gcs_dir(
     bucket_name: The name of the bucket to upload to.
     target_dir: The directory prefix within the bucket to upload to.
   """
-  storage_client = storage.Client()
+  storage_client = get_client()
   bucket = storage_client.bucket(bucket_name)  # Get bucket object from name
 
   directory_path = pathlib.Path(source_directory)
@@ -0,0 +1,350 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite text rendering service.
+
+This module provides font metrics and text measurement helpers used to lay out
+text placements.
+"""
+
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import render_metrics as RenderMetricsService
+import storage as StorageService
+from PIL import ImageFont
+
+DEFAULT_FONT_KEY = 'default'
+
+
+@dataclasses.dataclass(frozen=True)
+class FontMetrics:
+  """Vertical metrics of a font at a given point size.
+
+  Attributes:
+    ascender: Distance from the baseline to the top of the tallest glyph.
+    descender: Distance from the baseline to the bottom of the lowest glyph
+      (negative).
+  """
+  ascender: float
+  descender: float
+
+  @property
+  def line_height(self) -> float:
+    return self.ascender - self.descender
+
+
+def font_digest(font_path: Optional[str]) -> str:
+  """Returns a content digest of a font file, or a key for the default font."""
+  if not font_path:
+    return DEFAULT_FONT_KEY
+  return StorageService.file_digest(font_path)
+
+
+def probe_font_metrics(
+    font_path: Optional[str], text_size: float
+) -> Optional[FontMetrics]:
+  """Queries ImageMagick for the ascender and descender of a font.
+
+  This is more reliable than rendering text to an image and measuring it,
+  which can include unwanted vertical padding (leading).
+
+  Args:
+    font_path: The path of the font file, or None for the default font.
+    text_size: The point size to get metrics for.
+
+  Returns:
+    The font metrics, or None if they could not be parsed.
+  """
+  args = ['convert', 'xc:none']
+  if font_path:
+    args += ['-font', font_path]
+  args += [
+      '-pointsize',
+      str(text_size),
+      '-debug',
+      'annotate',
+      'label:A',  # A simple character to trigger font metric calculation.
+      'null:',
+  ]
+  RenderMetricsService.increment('subprocesses')
+  proc = subprocess.run(args, capture_output=True, text=True, check=False)
+
+  # Parse the stderr output to find ascender and descender.
+  ascender = None
+  descender = None
+  for line in proc.stderr.splitlines():
+    line = line.strip()
+    if line.startswith('ascender:'):
+      try:
+        ascender = float(line.split(':')[1].strip())
+      except (ValueError, IndexError):
+        pass
+    elif line.startswith('descender:'):
+      try:
+        descender = float(line.split(':')[1].strip())
+      except (ValueError, IndexError):
+        pass
+
+  if ascender is None or descender is None:
+    return None
+  return FontMetrics(ascender=ascender, descender=descender)
+
+
+def probe_font_metrics_pillow(
+    font_path: Optional[str], text_size: float
+) -> Optional[FontMetrics]:
+  """Reads the ascender and descender of a font in-process with Pillow.
+
+  Both Pillow and ImageMagick take these from the FreeType face, so the
+  result matches `probe_font_metrics` without spawning a process.
+
+  Args:
+    font_path: The path of the font file, or None for Pillow's default font.
+    text_size: The point size to get metrics for.
+
+  Returns:
+    The font metrics, or None if the font could not be loaded.
+  """
+  try:
+    if font_path:
+      font = ImageFont.truetype(font_path, float(text_size))
+    else:
+      font = ImageFont.load_default(float(text_size))
+  except OSError as e:
+    logging.warning('Could not load font "%s": %s', font_path, e)
+    return None
+  ascent, descent = font.getmetrics()
+  return FontMetrics(ascender=ascent, descender=-descent)
+
+
+# Metric probes by text renderer, see `pva_video.write_temp_image`.
+FONT_METRICS_PROBES: Dict[
+    str, Callable[[Optional[str], float], Optional[FontMetrics]]
+] = {
+    'imagemagick': probe_font_metrics,
+    'pillow': probe_font_metrics_pillow,
+}
+
+
+class FontMetricsCache:
+  """Memoizes font metrics by font content and point size.
+
+  Metrics are kept in memory and mirrored to a JSON sidecar file, so that
+  later invocations on the same instance do not have to probe the font again.
+  Failed probes are not cached.
+
+  Attributes:
+    sidecar_path: The JSON file to persist metrics in, or None to keep them in
+      memory only.
+    probes: The number of probes run by this cache.
+  """
+
+  def __init__(self, sidecar_path: Optional[str] = None):
+    self.sidecar_path = sidecar_path
+    self.probes = 0
+    self._lock = threading.Lock()
+    self._metrics = self._load_sidecar()
+
+  def get_metrics(
+      self,
+      font_path: Optional[str],
+      text_size: float,
+      renderer: str = 'imagemagick',
+  ) -> Optional[FontMetrics]:
+    """Returns the metrics of the given font and size, probing on a miss.
+
+    Args:
+      font_path: The path of the font file, or None for the default font.
+      text_size: The point size to get metrics for.
+      renderer: The text renderer whose probe to use, a key of
+        FONT_METRICS_PROBES. Default fonts differ between renderers.
+
+    Returns:
+      The font metrics, or None if they could not be determined.
+    """
+    key = f'{renderer}:{font_digest(font_path)}@{float(text_size)}'
+    with self._lock:
+      if key in self._metrics:
+        return self._metrics[key]
+
+    metrics = FONT_METRICS_PROBES[renderer](font_path, text_size)
+    with self._lock:
+      self.probes += 1
+      if metrics is not None:
+        self._metrics[key] = metrics
+        self._save_sidecar()
+    return metrics
+
+  def _load_sidecar(self) -> Dict[str, FontMetrics]:
+    if not self.sidecar_path or not os.path.exists(self.sidecar_path):
+      return {}
+    try:
+      with open(self.sidecar_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+      return {key: FontMetrics(**value) for key, value in data.items()}
+    except (OSError, ValueError, TypeError) as e:
+      logging.warning(
+          'Ignoring unreadable font metrics sidecar "%s": %s',
+          self.sidecar_path,
+          e,
+      )
+      return {}
+
+  def _save_sidecar(self) -> None:
+    # Must be called with the lock held. Merges entries written by other
+    # processes in the meantime, then replaces the file atomically. The
+    # sidecar is only an optimization, so failing to write it (e.g. on a full
+    # disk) leaves the metrics in memory only.
+    if not self.sidecar_path:
+      return
+    for key, value in self._load_sidecar().items():
+      self._metrics.setdefault(key, value)
+    directory = os.path.dirname(self.sidecar_path) or '.'
+    tmp_path = None
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(prefix='.font_metrics_', dir=directory)
+      with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(
+            {
+                key: dataclasses.asdict(value)
+                for key, value in self._metrics.items()
+            },
+            f,
+        )
+      os.replace(tmp_path, self.sidecar_path)
+    except OSError as e:
+      logging.warning(
+          'Could not write font metrics sidecar "%s": %s',
+          self.sidecar_path,
+          e,
+      )
+      if tmp_path is not None and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+class RenderedTextCache:
+  """Caches rendered text images by text content and style.
+
+  Images live in a local LRU cache and, optionally, under a prefix in a GCS
+  bucket, so that identical labels are rendered once per fleet rather than
+  once per video. Sharing costs a GCS lookup on every local miss.
+
+  Attributes:
+    local_cache: The local cache holding rendered images.
+    bucket_name: The bucket to share rendered images through, or None.
+    gcs_prefix: The folder within the bucket holding shared images.
+  """
+
+  def __init__(
+      self,
+      local_cache: StorageService.LocalFileCache,
+      bucket_name: Optional[str] = None,
+      gcs_prefix: Optional[str] = None,
+  ):
+    self.local_cache = local_cache
+    self.bucket_name = bucket_name if gcs_prefix else None
+    self.gcs_prefix = (gcs_prefix or '').strip('/')
+
+  def key(
+      self,
+      text: str,
+      font_path: Optional[str],
+      text_size: Any,
+      text_color: str,
+      angle: Any,
+      use_cropped_text_fix: bool,
+      renderer: str,
+      supersampling: int = 4,
+  ) -> str:
+    """Returns the cache key of a rendered text image."""
+    if not angle or str(angle) == '0':
+      angle = 0
+    return hashlib.sha256(
+        json.dumps([
+            renderer,
+            text,
+            font_digest(font_path),
+            float(text_size),
+            text_color,
+            float(angle),
+            bool(use_cropped_text_fix),
+            int(supersampling),
+        ]).encode('utf-8')
+    ).hexdigest()
+
+  def fetch(self, key: str, output_path: str) -> bool:
+    """Copies the cached image for `key` to `output_path`, if there is one.
+
+    Args:
+      key: The key returned by `key`.
+      output_path: Where to write the image to.
+
+    Returns:
+      Whether the image was found locally or in the shared bucket.
+    """
+    if self.local_cache.copy_to(key, output_path):
+      return True
+    return bool(self.bucket_name) and self._fetch_shared(key, output_path)
+
+  def store(self, key: str, image_path: str) -> None:
+    """Adds a copy of a freshly rendered image to the cache."""
+    staging_path = self.local_cache.staging_path()
+    shutil.copyfile(image_path, staging_path)
+    if self.local_cache.put_file(key, staging_path) is None:
+      os.remove(staging_path)
+    if self.bucket_name:
+      # Another instance may have shared the same image in the meantime,
+      # which leaves the image already shared.
+      try:
+        StorageService.upload_gcs_file_once(
+            image_path, self._gcs_path(key), self.bucket_name
+        )
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not share rendered text "%s": %s', key, e)
+
+  def _gcs_path(self, key: str) -> str:
+    return f'{self.gcs_prefix}/{key}.png'
+
+  def _fetch_shared(self, key: str, output_path: str) -> bool:
+    """Copies the shared image for `key` to `output_path`, caching it.
+
+    Missing images are expected (the image may not be rendered yet), so they
+    are looked up without the warning `download_gcs_file` logs.
+    """
+    blob = StorageService.get_client().bucket(self.bucket_name).get_blob(
+        self._gcs_path(key)
+    )
+    if blob is None:
+      return False
+    staging_path = self.local_cache.staging_path()
+    try:
+      blob.download_to_filename(staging_path)
+      RenderMetricsService.increment('gcs_download_bytes', blob.size or 0)
+      shutil.copyfile(staging_path, output_path)
+    except Exception:
+      os.remove(staging_path)
+      raise
+    if self.local_cache.put_file(key, staging_path) is None:
+      os.remove(staging_path)
+    return True
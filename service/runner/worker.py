@@ -0,0 +1,250 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""PVA Lite runner worker.
+
+Runs the runner as a long-lived process pulling render messages, instead of
+the push-triggered `subscribe` Cloud Function. Clients, caches and models stay
+warm between messages, and several messages are rendered at once (see
+WORKER_CONCURRENCY), which suits steady high-volume campaigns on fixed VMs.
+
+Messages are pulled from a Pub/Sub subscription (the Pub/Sub emulator is used
+when PUBSUB_EMULATOR_HOST is set), or read from the JSON files of a local
+directory. On SIGTERM or SIGINT the worker stops taking messages and finishes
+the ones in progress before exiting. FFMPEG_TIMEOUT_S and MESSAGE_DEADLINE_S
+still apply, and can be raised as there is no function timeout to stay under.
+
+Usage:
+
+  python3 worker.py --subscription pva-lite-runner
+  python3 worker.py --queue-dir /path/to/messages
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import pathlib
+import signal
+import threading
+from typing import Optional
+
+import config as ConfigService
+import main as RunnerService
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber import scheduler
+
+
+def concurrency() -> int:
+  """Returns the number of messages to render at once.
+
+  Unless set by WORKER_CONCURRENCY, this is as many renders as the available
+  cores and memory fit, given WORKER_CORES_PER_RENDER and
+  WORKER_MEMORY_PER_RENDER.
+  """
+  if ConfigService.WORKER_CONCURRENCY > 0:
+    return ConfigService.WORKER_CONCURRENCY
+  cores = RunnerService._available_cores()  # pylint: disable=protected-access
+  renders = cores // max(1, ConfigService.WORKER_CORES_PER_RENDER)
+  try:
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    renders = min(
+        renders, memory // max(1, ConfigService.WORKER_MEMORY_PER_RENDER)
+    )
+  except (ValueError, OSError, AttributeError):
+    logging.warning('Could not read the memory size, sizing by cores.')
+  return max(1, renders)
+
+
+def _process(data: bytes) -> bool:
+  """Renders a message, returning whether it succeeded."""
+  try:
+    RunnerService.process_message(data)
+    return True
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Failed to process message.')
+    return False
+
+
+class PubSubWorker:
+  """Renders the messages of a Pub/Sub subscription.
+
+  Failed messages are nacked, so Pub/Sub redelivers them (or dead-letters them,
+  as configured on the subscription).
+
+  Attributes:
+    subscription: The subscription's full path, or its name within
+      GCP_PROJECT_ID.
+    concurrency: The number of messages to render at once.
+  """
+
+  def __init__(self, subscription: str, concurrency: int):
+    self.subscription = subscription
+    self.concurrency = concurrency
+
+  def run(self, stop: threading.Event) -> None:
+    """Pulls and renders messages until `stop` is set, then drains."""
+    with pubsub_v1.SubscriberClient() as subscriber:
+      subscription = self.subscription
+      if '/' not in subscription:
+        subscription = subscriber.subscription_path(
+            ConfigService.GCP_PROJECT_ID, subscription
+        )
+      # Only leases as many messages as are rendered at once, leaving the
+      # others to other workers.
+      streaming_pull = subscriber.subscribe(
+          subscription,
+          callback=self._handle,
+          flow_control=pubsub_v1.types.FlowControl(
+              max_messages=self.concurrency
+          ),
+          scheduler=scheduler.ThreadScheduler(
+              concurrent.futures.ThreadPoolExecutor(self.concurrency)
+          ),
+          await_callbacks_on_shutdown=True,
+      )
+      logging.info(
+          'Pulling from %s, %d messages at a time.',
+          subscription,
+          self.concurrency,
+      )
+      while not stop.wait(1):
+        if streaming_pull.done():
+          # The subscription failed, e.g. it doesn't exist.
+          streaming_pull.result()
+      logging.info('Draining messages in progress...')
+      streaming_pull.cancel()
+      streaming_pull.result()
+
+  def _handle(self, message: pubsub_v1.subscriber.message.Message) -> None:
+    if _process(message.data):
+      message.ack()
+    else:
+      message.nack()
+
+
+class DirectoryWorker:
+  """Renders the messages of JSON files in a local directory.
+
+  A stand-in for Pub/Sub, e.g. for testing. Files are taken in name order,
+  each moved to `processing/` while rendered, then to `done/` or `failed/`.
+  Several workers can share the directory.
+
+  Attributes:
+    queue_dir: The directory to take the message files from.
+    concurrency: The number of messages to render at once.
+    poll_interval_s: How often to look for new files when idle.
+  """
+
+  def __init__(
+      self, queue_dir: str, concurrency: int, poll_interval_s: float = 1
+  ):
+    self.queue_dir = pathlib.Path(queue_dir)
+    self.concurrency = concurrency
+    self.poll_interval_s = poll_interval_s
+
+  def run(self, stop: threading.Event) -> None:
+    """Renders messages until `stop` is set, then drains."""
+    for folder in ('processing', 'done', 'failed'):
+      (self.queue_dir / folder).mkdir(exist_ok=True)
+    logging.info(
+        'Reading messages from %s, %d at a time.',
+        self.queue_dir,
+        self.concurrency,
+    )
+    slots = threading.BoundedSemaphore(self.concurrency)
+    with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+      while not stop.is_set():
+        # Only claims a file once it can be rendered, leaving the others to
+        # other workers.
+        if not slots.acquire(timeout=self.poll_interval_s):
+          continue
+        path = self._claim()
+        if path is None:
+          slots.release()
+          stop.wait(self.poll_interval_s)
+          continue
+        executor.submit(self._handle, path, slots)
+      logging.info('Draining messages in progress...')
+
+  def _claim(self) -> Optional[pathlib.Path]:
+    """Moves the next message file to `processing/`, returning its new path."""
+    for path in sorted(self.queue_dir.glob('*.json')):
+      claimed_path = self.queue_dir / 'processing' / path.name
+      try:
+        path.rename(claimed_path)
+      except FileNotFoundError:
+        continue  # Claimed by another worker.
+      return claimed_path
+    return None
+
+  def _handle(
+      self, path: pathlib.Path, slots: threading.BoundedSemaphore
+  ) -> None:
+    try:
+      try:
+        succeeded = _process(path.read_bytes())
+      except OSError:
+        logging.exception('Could not read message file %s.', path)
+        succeeded = False
+      folder = 'done' if succeeded else 'failed'
+      path.rename(self.queue_dir / folder / path.name)
+    except OSError:
+      logging.exception('Could not move message file %s.', path)
+    finally:
+      slots.release()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  source = parser.add_mutually_exclusive_group()
+  source.add_argument(
+      '--subscription',
+      default=ConfigService.WORKER_SUBSCRIPTION,
+      help='Pub/Sub subscription to pull, defaults to WORKER_SUBSCRIPTION.',
+  )
+  source.add_argument(
+      '--queue-dir', help='Directory of JSON messages to render instead.'
+  )
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=None,
+      help='Messages to render at once, defaults to WORKER_CONCURRENCY.',
+  )
+  args = parser.parse_args()
+
+  if args.queue_dir:
+    logging.basicConfig(level=logging.INFO)
+    worker = DirectoryWorker(args.queue_dir, args.concurrency or concurrency())
+  elif args.subscription:
+    RunnerService.setup_logging()
+    worker = PubSubWorker(args.subscription, args.concurrency or concurrency())
+  else:
+    parser.error('Set WORKER_SUBSCRIPTION, --subscription or --queue-dir.')
+
+  stop = threading.Event()
+
+  def _drain(signum, _):
+    logging.info('Received signal %d, stopping...', signum)
+    stop.set()
+
+  signal.signal(signal.SIGTERM, _drain)
+  signal.signal(signal.SIGINT, _drain)
+  worker.run(stop)
+  logging.info('Worker stopped.')
+
+
+if __name__ == '__main__':
+  main()